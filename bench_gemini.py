@@ -0,0 +1,471 @@
+#!/usr/bin/env python3
+# Benchmark of the Gemini routing (ai(), img2txt(), proxy pool, keys) with scripted faults.
+# Runs offline: a local fake Gemini server and fake http/socks5 proxies in front of it.
+#
+#   ./bench_gemini.py [--scenario scenario.json] [--requests 100] [--concurrency 4]
+#                     [--strategy sequential|hedged|both] [--vision]
+#                     [--record cassette.json | --replay cassette.json]
+#
+# The scenario describes the keys, Gemini and the proxies (see DEFAULT_SCENARIO),
+# the cassette keeps all random decisions of the fake servers, so the same run can be
+# repeated with another routing strategy or after a change in the code.
+#
+# It does not need cfg.py and does not touch db/ and logs/ of the bot: the config is a stub
+# and the databases, caches and logs of my_gemini are made in a temporary directory.
+# From a clean checkout with the requirements installed:
+#
+#   python3 bench_gemini.py --requests 50
+
+
+import argparse
+import atexit
+import collections
+import concurrent.futures
+import json
+import os
+import random
+import select
+import shutil
+import socket
+import socketserver
+import struct
+import sys
+import tempfile
+import threading
+import time
+import types
+import http.server
+import urllib.parse
+
+
+# the files of the bench are relative to the directory it was started in
+START_DIR = os.getcwd()
+# my_gemini and the modules it imports open their files relative to the working directory at import
+WORK_DIR = tempfile.mkdtemp(prefix='bench_gemini_')
+atexit.register(shutil.rmtree, WORK_DIR, ignore_errors=True)
+os.chdir(WORK_DIR)
+os.mkdir('db')
+os.mkdir('logs')
+
+# the real config is never used, the keys and proxies come from the scenario
+cfg = types.ModuleType('cfg')
+cfg.gemini_keys = []
+cfg.gemini_proxies = []
+cfg.translate_cache_file = ''
+sys.modules['cfg'] = cfg
+
+import my_gemini
+
+
+DEFAULT_SCENARIO = {
+    # how long the client waits for an answer, hanging routes cost so much
+    'timeout': 3,
+    # rate_limit - part of the requests answered with 429, invalid - the key is not valid
+    'keys': {
+        'key1': {'rate_limit': 0.3},
+        'key2': {'rate_limit': 0.05},
+        'key3': {'invalid': True},
+    },
+    # latency of the answer with random jitter, parts of the requests that get 503 and that hang
+    'gemini': {'latency': 0.3, 'jitter': 0.3, 'overload': 0.03, 'hang': 0.01},
+    # type - http or socks5, error - part of the connections that fail, blocked - Gemini is not available
+    # in the country of the proxy
+    'proxies': [
+        {'type': 'http', 'latency': 0.05, 'error': 0.02, 'hang': 0.0},
+        {'type': 'http', 'latency': 0.8, 'error': 0.3, 'hang': 0.1},
+        {'type': 'socks5', 'latency': 0.2, 'error': 0.1, 'hang': 0.02},
+        {'type': 'http', 'latency': 0.1, 'error': 0.0, 'hang': 0.0, 'blocked': True},
+    ],
+}
+
+# 1x1 png for the vision requests
+TEST_IMAGE = bytes.fromhex('89504e470d0a1a0a0000000d4948445200000001000000010806000000'
+                           '1f15c4890000000d49444154789c6360000002000154a24f5f0000000049454e44ae426082')
+
+BLOCKED_ANSWER = json.dumps({'error': {'code': 400, 'message': 'User location is not supported for the API use.',
+                                       'status': 'FAILED_PRECONDITION'}}).encode('utf-8')
+
+
+class Faults:
+    """
+    Random decisions of the fake servers. They are recorded to a cassette
+    or taken from it, each component has its own sequence of decisions.
+    """
+    def __init__(self, seed: int = 0, replay: str = ''):
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.tape = collections.defaultdict(list)
+        self.replay = None
+        if replay:
+            with open(replay, encoding='utf-8') as f:
+                self.replay = {k: collections.deque(v) for k, v in json.load(f).items()}
+
+    def decide(self, component: str, func):
+        """
+        Returns the next decision for the component, func(random) makes a new one.
+        """
+        with self.lock:
+            if self.replay is not None and self.replay.get(component):
+                value = self.replay[component].popleft()
+            else:
+                value = func(self.random)
+            self.tape[component].append(value)
+            return value
+
+    def save(self, file_name: str):
+        with open(file_name, 'w', encoding='utf-8') as f:
+            json.dump(self.tape, f)
+
+
+def gemini_decision(scenario: dict, key: str):
+    def decide(rnd: random.Random) -> list:
+        gemini = scenario['gemini']
+        key_ = scenario['keys'].get(key, {'invalid': True})
+        latency = max(0, gemini['latency'] + rnd.uniform(-1, 1) * gemini.get('jitter', 0))
+        if key_.get('invalid'):
+            return ['invalid', 0.05]
+        x = rnd.random()
+        for outcome in ('rate_limit', 'overload', 'hang'):
+            p = key_.get(outcome, 0) if outcome == 'rate_limit' else gemini.get(outcome, 0)
+            if x < p:
+                return [outcome, latency]
+            x -= p
+        return ['ok', latency]
+    return decide
+
+
+def proxy_decision(proxy: dict):
+    def decide(rnd: random.Random) -> list:
+        x = rnd.random()
+        if x < proxy.get('error', 0):
+            return ['error', proxy['latency']]
+        if x < proxy.get('error', 0) + proxy.get('hang', 0):
+            return ['hang', 0]
+        return ['blocked' if proxy.get('blocked') else 'ok', proxy['latency']]
+    return decide
+
+
+class FakeGemini(http.server.BaseHTTPRequestHandler):
+    """The generateContent and streamGenerateContent methods of the Gemini api."""
+    scenario = DEFAULT_SCENARIO
+    faults = None
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_HEAD(self):
+        self.send_response(200)
+        self.end_headers()
+
+    def do_POST(self):
+        url = urllib.parse.urlparse(self.path)
+        key = urllib.parse.parse_qs(url.query).get('key', [''])[0]
+        self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        outcome, latency = self.faults.decide(f'gemini:{key}', gemini_decision(self.scenario, key))
+        if outcome == 'hang':
+            time.sleep(self.scenario['timeout'] + 1)
+            return
+        time.sleep(latency)
+        if outcome == 'invalid':
+            self.answer(400, {'error': {'code': 400, 'message': 'API key not valid. Please pass a valid API key.',
+                                        'status': 'INVALID_ARGUMENT'}})
+        elif outcome == 'rate_limit':
+            self.answer(429, {'error': {'code': 429, 'message': 'Resource has been exhausted', 'status': 'RESOURCE_EXHAUSTED'}})
+        elif outcome == 'overload':
+            self.answer(503, {'error': {'code': 503, 'message': 'The model is overloaded.', 'status': 'UNAVAILABLE'}})
+        elif ':streamGenerateContent' in url.path:
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/event-stream')
+            self.end_headers()
+            for word in ('Hello', ' from', ' fake Gemini'):
+                chunk = {'candidates': [{'content': {'parts': [{'text': word}], 'role': 'model'}}]}
+                self.wfile.write(f'data: {json.dumps(chunk)}\r\n\r\n'.encode('utf-8'))
+                self.wfile.flush()
+        else:
+            self.answer(200, {'candidates': [{'content': {'parts': [{'text': 'Hello from fake Gemini'}], 'role': 'model'},
+                                              'finishReason': 'STOP'}]})
+
+    def answer(self, status: int, body: dict):
+        data = json.dumps(body).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+
+class FakeProxy(socketserver.BaseRequestHandler):
+    """
+    Http (absolute uri and CONNECT) or socks5 proxy with scripted faults.
+    The server object has the proxy settings in .proxy, the scenario and the faults.
+    """
+    def handle(self):
+        proxy = self.server.proxy
+        self.request.settimeout(self.server.scenario['timeout'] + 5)
+        try:
+            if proxy['type'] == 'socks5':
+                target, rest = self.socks5_handshake()
+            else:
+                target, rest = self.http_handshake()
+            if target is None:
+                return
+            outcome, latency = self.server.faults.decide(f'proxy:{proxy["name"]}', proxy_decision(proxy))
+            if outcome == 'hang':
+                time.sleep(self.server.scenario['timeout'] + 1)
+                return
+            time.sleep(latency)
+            if outcome == 'error':
+                self.fail()
+                return
+            if outcome == 'blocked':
+                self.answer_blocked(rest)
+                return
+            with socket.create_connection(target) as upstream:
+                if rest:
+                    upstream.sendall(rest)
+                self.pipe(upstream)
+        except OSError:
+            pass
+
+    def recv_until(self, data: bytes, end: bytes) -> bytes:
+        while end not in data:
+            chunk = self.request.recv(65536)
+            if not chunk:
+                raise ConnectionError('closed')
+            data += chunk
+        return data
+
+    def http_handshake(self) -> tuple:
+        data = self.recv_until(b'', b'\r\n\r\n')
+        head, body = data.split(b'\r\n\r\n', 1)
+        lines = head.split(b'\r\n')
+        method, uri, version = lines[0].split(b' ', 2)
+        if method == b'CONNECT':
+            host, port = uri.decode().rsplit(':', 1)
+            self.request.sendall(b'HTTP/1.1 200 Connection established\r\n\r\n')
+            self.mode = 'connect'
+            return (host, int(port)), body
+        url = urllib.parse.urlsplit(uri.decode())
+        path = url.path + ('?' + url.query if url.query else '')
+        headers = [x for x in lines[1:] if not x.lower().startswith(b'proxy-')]
+        self.mode = 'http'
+        request = b'\r\n'.join([b' '.join([method, path.encode(), version])] + headers) + b'\r\n\r\n' + body
+        return (url.hostname, url.port or 80), request
+
+    def recv_exact(self, n: int) -> bytes:
+        data = b''
+        while len(data) < n:
+            chunk = self.request.recv(n - len(data))
+            if not chunk:
+                raise ConnectionError('closed')
+            data += chunk
+        return data
+
+    def socks5_handshake(self) -> tuple:
+        self.mode = 'socks5'
+        _, n = self.recv_exact(2)
+        self.recv_exact(n)
+        self.request.sendall(b'\x05\x00')
+        _, _, _, atyp = self.recv_exact(4)
+        if atyp == 1:
+            host = socket.inet_ntoa(self.recv_exact(4))
+        elif atyp == 3:
+            host = self.recv_exact(self.recv_exact(1)[0]).decode()
+        else:
+            self.request.sendall(b'\x05\x08\x00\x01' + b'\x00' * 6)
+            return None, b''
+        port = struct.unpack('>H', self.recv_exact(2))[0]
+        return (host, port), b''
+
+    def fail(self):
+        if self.mode == 'socks5':
+            self.request.sendall(b'\x05\x01\x00\x01' + b'\x00' * 6)
+        else:
+            self.request.sendall(b'HTTP/1.1 502 Bad Gateway\r\nContent-Length: 11\r\nConnection: close\r\n\r\nBad Gateway')
+
+    def answer_blocked(self, rest: bytes):
+        """Answers like Gemini does for the countries where it is not available."""
+        if self.mode == 'socks5':
+            self.request.sendall(b'\x05\x00\x00\x01' + b'\x00' * 6)
+        if self.mode != 'http':
+            rest = b''
+        data = self.recv_until(rest, b'\r\n\r\n')
+        head, body = data.split(b'\r\n\r\n', 1)
+        length = 0
+        for line in head.split(b'\r\n')[1:]:
+            name, _, value = line.partition(b':')
+            if name.strip().lower() == b'content-length':
+                length = int(value)
+        while len(body) < length:
+            chunk = self.request.recv(65536)
+            if not chunk:
+                break
+            body += chunk
+        self.request.sendall(b'HTTP/1.1 400 Bad Request\r\nContent-Type: application/json\r\nConnection: close\r\n'
+                             + f'Content-Length: {len(BLOCKED_ANSWER)}\r\n\r\n'.encode() + BLOCKED_ANSWER)
+
+    def pipe(self, upstream: socket.socket):
+        if self.mode == 'socks5':
+            self.request.sendall(b'\x05\x00\x00\x01' + b'\x00' * 6)
+        sockets = [self.request, upstream]
+        while True:
+            readable, _, _ = select.select(sockets, [], [], self.server.scenario['timeout'] + 5)
+            if not readable:
+                return
+            for sock in readable:
+                data = sock.recv(65536)
+                if not data:
+                    return
+                (upstream if sock is self.request else self.request).sendall(data)
+
+
+class ProxyServer(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+def start_servers(scenario: dict, faults: Faults) -> tuple:
+    """
+    Starts the fake Gemini and the fake proxies on free local ports.
+
+    Returns:
+        tuple: The Gemini url and the list of the proxy urls.
+    """
+    FakeGemini.scenario = scenario
+    FakeGemini.faults = faults
+    gemini = http.server.ThreadingHTTPServer(('127.0.0.1', 0), FakeGemini)
+    gemini.daemon_threads = True
+    threading.Thread(target=gemini.serve_forever, daemon=True).start()
+
+    proxies = []
+    for i, proxy in enumerate(scenario['proxies']):
+        proxy.setdefault('name', str(i))
+        server = ProxyServer(('127.0.0.1', 0), FakeProxy)
+        server.proxy = proxy
+        server.scenario = scenario
+        server.faults = faults
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        scheme = 'socks5h' if proxy['type'] == 'socks5' else 'http'
+        proxies.append(f'{scheme}://127.0.0.1:{server.server_address[1]}')
+    return f'http://127.0.0.1:{gemini.server_address[1]}', proxies
+
+
+def reset_routing(scenario: dict, proxies: list):
+    """
+    Puts my_gemini into the initial state with the fake keys and proxies.
+    """
+    cfg.gemini_keys = list(scenario['keys'])
+    with my_gemini.KEYS_LOCK:
+        my_gemini.KEYS_STATE.clear()
+    with my_gemini.PROXY_BREAKERS_LOCK:
+        my_gemini.PROXY_BREAKERS.clear()
+    for proxy in list(my_gemini.PROXY_STATS):
+        my_gemini.remove_proxy_stats(proxy)
+    for proxy in list(my_gemini.SESSIONS):
+        my_gemini.drop_session(proxy)
+    my_gemini.PROXY_POOL = proxies[:]
+    for proxy in proxies:
+        my_gemini.add_proxy_stats(proxy)
+
+
+def percentile(values: list, p: float) -> float:
+    if not values:
+        return 0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+
+def run(strategy: str, scenario: dict, proxies: list, n: int, concurrency: int, vision: bool) -> dict:
+    """
+    Sends n user requests and measures them.
+
+    Returns:
+        dict: The results.
+    """
+    reset_routing(scenario, proxies)
+    my_gemini.HEDGE_REQUESTS = strategy == 'hedged'
+    attempts = [0]
+    lock = threading.Lock()
+    ai_request = my_gemini.ai_request
+
+    def counted_ai_request(*args, **kwargs):
+        result = ai_request(*args, **kwargs)
+        if result[1] != my_gemini.ERROR_SKIPPED:
+            with lock:
+                attempts[0] += 1
+        return result
+
+    my_gemini.ai_request = counted_ai_request
+    latencies = []
+    ok = [0]
+
+    def user_request(i: int):
+        start_time = time.time()
+        if vision:
+            result = my_gemini.img2txt(TEST_IMAGE, 'What is in the image?', 'image/png')
+        else:
+            result = my_gemini.ai(f'Hello {i}')
+        with lock:
+            latencies.append(time.time() - start_time)
+            if result:
+                ok[0] += 1
+
+    start_time = time.time()
+    try:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=concurrency) as pool:
+            list(pool.map(user_request, range(n)))
+    finally:
+        my_gemini.ai_request = ai_request
+    return {
+        'strategy': strategy,
+        'requests': n,
+        'success': ok[0] / n,
+        'p50': percentile(latencies, 50),
+        'p95': percentile(latencies, 95),
+        'p99': percentile(latencies, 99),
+        'attempts': attempts[0] / n,
+        'proxies left': len(my_gemini.PROXY_POOL),
+        'time': time.time() - start_time,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark of the Gemini routing with a fake Gemini and fake proxies')
+    parser.add_argument('--scenario', help='json file with the scenario, see DEFAULT_SCENARIO')
+    parser.add_argument('--requests', type=int, default=100)
+    parser.add_argument('--concurrency', type=int, default=4)
+    parser.add_argument('--strategy', choices=['sequential', 'hedged', 'both'], default='both')
+    parser.add_argument('--vision', action='store_true', help='benchmark img2txt() instead of ai()')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--record', help='save the decisions of the fake servers to the cassette')
+    parser.add_argument('--replay', help='take the decisions of the fake servers from the cassette')
+    args = parser.parse_args()
+    for name in ('scenario', 'record', 'replay'):
+        if getattr(args, name):
+            setattr(args, name, os.path.join(START_DIR, getattr(args, name)))
+
+    scenario = DEFAULT_SCENARIO
+    if args.scenario:
+        with open(args.scenario, encoding='utf-8') as f:
+            scenario = json.load(f)
+
+    strategies = ['sequential', 'hedged'] if args.strategy == 'both' else [args.strategy]
+    results = []
+    for strategy in strategies:
+        # every strategy gets the same faults
+        faults = Faults(args.seed, args.replay)
+        gemini, proxies = start_servers(scenario, faults)
+        my_gemini.GEMINI_HOST = gemini
+        my_gemini.REQUEST_TIMEOUT = scenario['timeout']
+        results.append(run(strategy, scenario, proxies, args.requests, args.concurrency, args.vision))
+        if args.record:
+            faults.save(args.record if len(strategies) == 1 else f'{args.record}.{strategy}')
+
+    columns = ['strategy', 'requests', 'success', 'p50', 'p95', 'p99', 'attempts', 'proxies left', 'time']
+    print(' | '.join(f'{x:>12}' for x in columns))
+    for result in results:
+        print(' | '.join(f'{result[x]:>12.3f}' if isinstance(result[x], float) else f'{result[x]:>12}' for x in columns))
+
+
+if __name__ == '__main__':
+    main()
@@ -28,3 +28,60 @@ tts_button = True
 
 # api token for huggin face
 # cfg.huggin_face_api = ['hf_xxx','hf_yyy',]
+
+# send a duplicate gemini request through the next proxy/key if the answer is late
+# gemini_hedge_requests = True
+
+# count the chat history by the estimated model tokens instead of characters
+# gemini_history_budget_mode = 'tokens'
+
+# send the answer while it is being generated, editing the message as it grows
+# stream_answers = True
+
+# cache of the translations, '' - keep them only in memory; lifetime in seconds
+# translate_cache_file = 'db/gemini_translate_cache.db'
+# translate_cache_ttl = 7 * 24 * 60 * 60
+
+# photos for the description are downloaded in the smallest size with this width or height
+# photo_min_side = 1024
+
+# cache of the image descriptions, '' - keep them only in memory; lifetime in seconds
+# img2txt_cache_file = 'db/img2txt_cache.db'
+# img2txt_cache_ttl = 3 * 24 * 60 * 60
+
+# summarize the oldest turns of a chat in background instead of dropping them
+# gemini_history_compact = True
+
+# keep a longer chat history and send only the last turns and the older ones relevant to the query
+# gemini_history_retrieval = True
+
+# Gemini api address, for example a local fake server from bench_gemini.py
+# gemini_host = 'http://127.0.0.1:8080'
+
+# export the metrics on http://127.0.0.1:9090/metrics in the Prometheus format
+# metrics_port = 9090
+
+# who can see /stats, by default everyone in users
+# admins = [123456, ]
+
+# traces of the requests longer than trace_slow_threshold seconds or with errors are saved to trace_file
+# (rotated like the logs, 10 MB and 3 backups),
+# trace_sample_rate - part of the other traces that is saved too
+# trace_file = 'logs/traces.jsonl'
+# trace_slow_threshold = 10
+# trace_sample_rate = 0.01
+
+# threads that handle the updates; waiting messages per chat and in total, the others get a busy reply
+# workers = 16
+# chat_queue_max = 10
+# queue_max = 500
+
+# receive the updates with a webhook instead of the long polling, telegram posts to the https url
+# and the reverse proxy (nginx etc) passes the requests to webhook_host:webhook_port with the same path
+# webhook_url = 'https://bot.example.com/telegram'
+# webhook_host = '127.0.0.1'
+# webhook_port = 8443
+# webhook_secret = 'random_letters_digits_and_underscores'
+
+# drop the updates that came while the bot was down, with the polling and with the webhook
+# skip_pending = True
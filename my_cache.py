@@ -0,0 +1,187 @@
+#!/usr/bin/env python3
+
+
+import collections
+import hashlib
+import threading
+import time
+
+import my_log
+
+
+# The disk tier is cleaned of the expired and extra entries on open and then once in this time, seconds
+DISK_PURGE_INTERVAL = 60 * 60
+
+
+class Cache:
+    """
+    LRU cache with expiring entries and an optional on-disk tier.
+
+    get_or_compute() coalesces concurrent calls with the same key,
+    so only the first caller computes the value and the others wait for it.
+    """
+    def __init__(self, max_items: int = 1000, ttl: float = 0, file_name: str = '', max_disk_items: int = 10000):
+        """
+        Args:
+            max_items (int, optional): How many entries to keep in memory. Defaults to 1000.
+            ttl (float, optional): Lifetime of an entry in seconds, 0 - forever. Defaults to 0.
+            file_name (str, optional): SqliteDict database for the disk tier, '' - memory only.
+            max_disk_items (int, optional): How many entries to keep on disk, the oldest are removed. Defaults to 10000.
+        """
+        self.max_items = max_items
+        self.max_disk_items = max_disk_items
+        self.ttl = ttl
+        # {key:(expires, value)}
+        self.items = collections.OrderedDict()
+        self.lock = threading.Lock()
+        # {key:[threading.Event(), value]} of the values being computed
+        self.inflight = {}
+        self.stats = {'hits': 0, 'disk_hits': 0, 'misses': 0, 'coalesced': 0, 'disk_purged': 0}
+        self.db = None
+        if file_name:
+            try:
+                from sqlitedict import SqliteDict
+                self.db = SqliteDict(file_name, autocommit=True)
+            except Exception as error:
+                my_log.log2(f'my_cache:Cache: {file_name} {error}')
+            else:
+                threading.Thread(target=self.purge_daemon, daemon=True).start()
+
+    @staticmethod
+    def disk_key(key) -> str:
+        return hashlib.sha256(repr(key).encode('utf-8')).hexdigest()
+
+    def get(self, key, default=None):
+        """
+        Returns the value from memory or from disk, or default if there is none or it expired.
+        """
+        now = time.time()
+        with self.lock:
+            item = self.items.get(key)
+            if item is not None:
+                if not item[0] or item[0] > now:
+                    self.items.move_to_end(key)
+                    self.stats['hits'] += 1
+                    return item[1]
+                del self.items[key]
+        if self.db is not None:
+            try:
+                item = self.db.get(self.disk_key(key))
+                if item is not None:
+                    if not item[0] or item[0] > now:
+                        with self.lock:
+                            self.stats['disk_hits'] += 1
+                        self.remember(key, item)
+                        return item[1]
+                    del self.db[self.disk_key(key)]
+            except Exception as error:
+                my_log.log2(f'my_cache:get: {error}')
+        with self.lock:
+            self.stats['misses'] += 1
+        return default
+
+    def set(self, key, value):
+        """
+        Saves the value in memory and on disk.
+        """
+        item = (time.time() + self.ttl if self.ttl else 0, value)
+        self.remember(key, item)
+        if self.db is not None:
+            try:
+                self.db[self.disk_key(key)] = item
+            except Exception as error:
+                my_log.log2(f'my_cache:set: {error}')
+
+    def remember(self, key, item: tuple):
+        with self.lock:
+            self.items[key] = item
+            self.items.move_to_end(key)
+            while len(self.items) > self.max_items:
+                self.items.popitem(last=False)
+
+    def delete(self, key):
+        with self.lock:
+            self.items.pop(key, None)
+        if self.db is not None:
+            try:
+                self.db.pop(self.disk_key(key), None)
+            except Exception as error:
+                my_log.log2(f'my_cache:delete: {error}')
+
+    def purge_disk(self) -> int:
+        """
+        Removes the expired entries from the disk tier and the oldest ones above max_disk_items.
+        SqliteDict keeps the entries in the order they were saved.
+
+        Returns:
+            int: The number of the removed entries.
+        """
+        if self.db is None:
+            return 0
+        now = time.time()
+        expired = []
+        alive = []
+        for disk_key, item in self.db.items():
+            if item[0] and item[0] <= now:
+                expired.append(disk_key)
+            else:
+                alive.append(disk_key)
+        extra = alive[:max(0, len(alive) - self.max_disk_items)]
+        for disk_key in expired + extra:
+            self.db.pop(disk_key, None)
+        with self.lock:
+            self.stats['disk_purged'] += len(expired) + len(extra)
+        return len(expired) + len(extra)
+
+    def purge_daemon(self):
+        while 1:
+            try:
+                self.purge_disk()
+            except Exception as error:
+                my_log.log2(f'my_cache:purge_daemon: {error}')
+            time.sleep(DISK_PURGE_INTERVAL)
+
+    def get_or_compute(self, key, func):
+        """
+        Returns the cached value or computes it with func() and caches it.
+        Empty results ('', None, [] etc) are returned but not cached.
+
+        Args:
+            key: The key, any hashable value with a stable repr().
+            func: The function without arguments that computes the value.
+
+        Returns:
+            The value.
+        """
+        value = self.get(key)
+        if value is not None:
+            return value
+
+        with self.lock:
+            flight = self.inflight.get(key)
+            owner = flight is None
+            if owner:
+                flight = self.inflight[key] = [threading.Event(), None]
+            else:
+                self.stats['coalesced'] += 1
+        if not owner:
+            flight[0].wait()
+            return flight[1]
+
+        try:
+            value = func()
+            if value:
+                self.set(key, value)
+            flight[1] = value
+            return value
+        finally:
+            with self.lock:
+                del self.inflight[key]
+            flight[0].set()
+
+
+if __name__ == '__main__':
+    cache = Cache(max_items=2, ttl=1)
+    print(cache.get_or_compute('a', lambda: 1), cache.get_or_compute('a', lambda: 2))
+    time.sleep(1.1)
+    print(cache.get('a'), cache.stats)
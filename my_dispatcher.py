@@ -0,0 +1,153 @@
+#!/usr/bin/env python3
+# Runs the work of the telegram updates on a fixed pool of threads.
+# The tasks of a chat run one by one in the order they came, the chats take turns.
+
+
+import collections
+import concurrent.futures
+import heapq
+import itertools
+import threading
+import time
+
+import my_log
+import my_metrics
+
+
+METRIC_TASKS = my_metrics.counter('dispatcher_tasks_total', 'Tasks of the dispatcher', ('result', ))
+METRIC_WAIT_SECONDS = my_metrics.histogram('dispatcher_wait_seconds', 'Time of the tasks in the queue')
+
+
+class Dispatcher:
+    """
+    The pool of workers with a FIFO queue for every chat.
+
+    A chat has at most one task running, so its messages are answered in order.
+    After every task the chat goes to the end of the line of the pool, a busy chat
+    can not hold a worker while the other chats wait.
+    """
+    def __init__(self, max_workers: int = 16, max_chat_tasks: int = 10, max_tasks: int = 500):
+        """
+        Args:
+            max_workers (int, optional): The number of threads. Defaults to 16.
+            max_chat_tasks (int, optional): The maximum number of waiting and running tasks of a chat. Defaults to 10.
+            max_tasks (int, optional): The maximum number of waiting and running tasks of all chats. Defaults to 500.
+        """
+        self.max_chat_tasks = max_chat_tasks
+        self.max_tasks = max_tasks
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='dispatcher')
+        # {chat:deque([(func, args, kwargs, queued time), ])}, the first task of a chat is running or is about to
+        self.queues = {}
+        self.tasks = 0
+        self.running = 0
+        self.lock = threading.Lock()
+        my_metrics.gauge('dispatcher_tasks', 'Waiting and running tasks', func=lambda: self.tasks)
+        my_metrics.gauge('dispatcher_running', 'Running tasks', func=lambda: self.running)
+        my_metrics.gauge('dispatcher_chats', 'Chats with tasks', func=lambda: len(self.queues))
+
+    def submit(self, chat: str, func, *args, **kwargs) -> bool:
+        """
+        Puts the task to the queue of the chat.
+
+        Args:
+            chat (str): The chat, the tasks with the same chat run in order.
+            func: The function.
+            *args, **kwargs: Its arguments.
+
+        Returns:
+            bool: False if the queue is full and the task was rejected.
+        """
+        with self.lock:
+            queue = self.queues.get(chat)
+            if self.tasks >= self.max_tasks or (queue and len(queue) >= self.max_chat_tasks):
+                METRIC_TASKS.inc(result='rejected')
+                return False
+            if queue is None:
+                queue = self.queues[chat] = collections.deque()
+            queue.append((func, args, kwargs, time.time()))
+            self.tasks += 1
+            # the chat has no task running, it needs a worker
+            start = len(queue) == 1
+        if start:
+            self.executor.submit(self.run, chat)
+        return True
+
+    def run(self, chat: str):
+        """Runs the first task of the chat and queues the chat for the next one."""
+        with self.lock:
+            func, args, kwargs, queued_time = self.queues[chat][0]
+            self.running += 1
+        METRIC_WAIT_SECONDS.observe(time.time() - queued_time)
+        try:
+            func(*args, **kwargs)
+            METRIC_TASKS.inc(result='done')
+        except Exception as error:
+            METRIC_TASKS.inc(result='failed')
+            my_log.log2(f'my_dispatcher:run: {chat} {getattr(func, "__name__", func)} {error}')
+        finally:
+            with self.lock:
+                self.running -= 1
+                self.tasks -= 1
+                queue = self.queues[chat]
+                queue.popleft()
+                if not queue:
+                    del self.queues[chat]
+            if queue:
+                self.executor.submit(self.run, chat)
+
+    def size(self, chat: str = None) -> int:
+        """Returns the number of the tasks of the chat or of all chats."""
+        with self.lock:
+            if chat is None:
+                return self.tasks
+            return len(self.queues.get(chat, ()))
+
+
+class Scheduler:
+    """
+    One thread that calls short functions after a delay, for the windows where the bot
+    waits for more pieces of a message. The functions must not block, the slow work goes to the Dispatcher.
+    """
+    def __init__(self):
+        # [(time, order, func, args), ]
+        self.heap = []
+        self.order = itertools.count()
+        self.condition = threading.Condition()
+        self.thread = None
+
+    def call_later(self, delay: float, func, *args):
+        """
+        Calls func(*args) after delay seconds.
+        """
+        with self.condition:
+            heapq.heappush(self.heap, (time.time() + delay, next(self.order), func, args))
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run, daemon=True)
+                self.thread.start()
+            self.condition.notify()
+
+    def size(self) -> int:
+        """Returns the number of the waiting calls."""
+        with self.condition:
+            return len(self.heap)
+
+    def run(self):
+        while 1:
+            with self.condition:
+                while not self.heap or self.heap[0][0] > time.time():
+                    self.condition.wait(self.heap[0][0] - time.time() if self.heap else None)
+                _, _, func, args = heapq.heappop(self.heap)
+            try:
+                func(*args)
+            except Exception as error:
+                my_log.log2(f'my_dispatcher:Scheduler:run: {getattr(func, "__name__", func)} {error}')
+
+
+if __name__ == '__main__':
+    dispatcher = Dispatcher(max_workers=2, max_chat_tasks=3)
+    done = []
+    for i in range(5):
+        print(i, dispatcher.submit('a', lambda i=i: (time.sleep(0.1), done.append(('a', i)))),
+              dispatcher.submit('b', lambda i=i: done.append(('b', i))))
+    time.sleep(1)
+    print(done)
@@ -3,36 +3,85 @@
 # pip install Proxy-List-Scrapper
 
 
+import asyncio
+import atexit
+import collections
 import concurrent.futures
 import base64
+import bisect
+import errno
+import functools
+import json
+import os
 import pickle
+try:
+    import resource
+except ImportError:
+    # windows
+    resource = None
 import random
+import re
+import socket
+import tempfile
 import threading
 import time
 import traceback
+import unicodedata
 import requests
 
 import langcodes
 from Proxy_List_Scrapper import Scrapper
-from sqlitedict import SqliteDict
 
 import cfg
+import my_cache
+import my_history
 import my_log
+import my_metrics
+import my_trace
 
 
 # Blocking chats to avoid spoiling the history
 # {id:lock}
 LOCKS = {}
+# reads histories of the chats into the cache in advance
+PREFETCH_POOL = concurrent.futures.ThreadPoolExecutor(max_workers=4)
 
 # Do not accept more requests than this, this is a Telegram bot limitation, not used in this module
 MAX_REQUEST = 14000
 
 # Maximum chat history size (Google 32k limit?)
 MAX_CHAT_SIZE = 25000
-
-
-# Dialog storage {id:list(mem)}
-CHATS = SqliteDict('db/gemini_chats.db', autocommit=True)
+# How to count the chat history size: 'chars' - up to MAX_CHAT_SIZE characters,
+# 'tokens' - up to HISTORY_TOKEN_BUDGET estimated tokens of the model
+HISTORY_BUDGET_MODE = cfg.gemini_history_budget_mode if hasattr(cfg, 'gemini_history_budget_mode') else 'chars'
+# gemini-pro accepts 30720 tokens, the rest is left for the query
+HISTORY_TOKEN_BUDGET = {'gemini-pro': 24000}
+
+# Summarize the oldest turns of a chat in background instead of dropping them
+HISTORY_COMPACT = cfg.gemini_history_compact if hasattr(cfg, 'gemini_history_compact') else False
+# compaction starts when the history is over this part of the budget
+HISTORY_COMPACT_AT = 0.5
+# and summarizes the oldest turns until the rest is not over this part
+HISTORY_COMPACT_KEEP = 0.25
+HISTORY_SUMMARY_PREFIX = '[Summary of our earlier conversation]'
+COMPACT_POOL = concurrent.futures.ThreadPoolExecutor(max_workers=2)
+# chats being compacted
+COMPACTING = set()
+COMPACTING_LOCK = threading.Lock()
+# after a failed summary the chat is not compacted for so many seconds, doubles with every failure
+COMPACT_RETRY = 60
+COMPACT_RETRY_MAX = 60*30
+# {chat_id:(time of the next try, delay)} of the chats whose last compaction failed
+COMPACT_FAILED = {}
+
+# Send only the last turns and the older ones relevant to the query instead of the whole history
+HISTORY_RETRIEVAL = cfg.gemini_history_retrieval if hasattr(cfg, 'gemini_history_retrieval') else False
+# the history is stored up to this many budgets, the request is still built within one budget
+HISTORY_RETRIEVAL_STORE = 10
+# the last turns that are always sent
+HISTORY_RETRIEVAL_RECENT = 4
+# no more than so many relevant older turns
+HISTORY_RETRIEVAL_TOP_K = 6
 
 
 # If no proxies are specified in the config, then we first try to work directly
@@ -51,16 +100,654 @@ PROXY_POOL_DB_FILE = 'db/gemini_proxy_pool.pkl'
 PROXY_POLL_SPEED_DB_FILE = 'db/gemini_proxy_pool_speed.pkl'
 # PROXY_POOL_REMOVED_DB_FILE = 'db/gemini_proxy_pool_removed.pkl'
 SAVE_LOCK = threading.Lock()
+# the proxy pool is kept in memory and saved to disk in background
+# not more often than once in SAVE_DEBOUNCE seconds
+SAVE_EVENT = threading.Event()
+SAVE_DEBOUNCE = 10
 POOL_MAX_WORKERS = 50
 
+# Proxy search, the candidates are checked in stages, see check_proxies()
+# how many connections to open at once on the handshake stage
+# but not more than the limit of open files minus the sockets and files of the bot itself
+PROXY_CHECK_CONCURRENCY = 2000
+PROXY_CHECK_FD_RESERVE = 300
+PROXY_CHECK_TIMEOUT = 5
+# the handshake is repeated after this pause if there were no free file descriptors, seconds
+PROXY_CHECK_FD_RETRY_DELAY = 1
+PROXY_CHECK_FD_RETRIES = 10
+# how many candidates to check at once on the https stage
+PROXY_CHECK_HTTPS_WORKERS = POOL_MAX_WORKERS
+PROXY_CHECK_HTTPS_TIMEOUT = 10
+# how many candidates to check at once with real Gemini requests
+PROXY_CHECK_GEMINI_WORKERS = 20
+# counters of the last search {stage:{'checked':n, 'passed':n}}
+PROXY_CHECK_STATS = {}
+
+# Gemini api, can be changed to a local fake server for tests and benchmarks (see bench_gemini.py)
+GEMINI_HOST = cfg.gemini_host if hasattr(cfg, 'gemini_host') else 'https://generativelanguage.googleapis.com'
+# how long to wait for an answer of Gemini, seconds
+REQUEST_TIMEOUT = 60
+
+# Warm keep-alive sessions, one per route, '' is a direct connection
+# {route: [session, last_used_time]}
+SESSIONS = {}
+SESSIONS_LOCK = threading.Lock()
+# how many connections to keep open per route
+SESSION_POOL_SIZE = 10
+# close sessions that were not used for so many seconds
+SESSION_IDLE_TIMEOUT = 60*5
+# how many of the fastest routes to keep warm
+SESSION_WARM_UP = 3
+# how often to check idle sessions and warm up the best routes
+SESSION_WARM_UP_INTERVAL = 60
+
+# Hedged requests: if the answer is late, send a duplicate through the next route
+# and take the first answer
+HEDGE_REQUESTS = cfg.gemini_hedge_requests if hasattr(cfg, 'gemini_hedge_requests') else False
+# how many requests can be in flight at once for one user request
+HEDGE_MAX_FANOUT = 2
+# how many duplicates can be sent for one user request
+HEDGE_BUDGET = 2
+# wait so long before the first duplicate if the route latency is unknown
+HEDGE_DEFAULT_DELAY = 10
+# never send a duplicate sooner than this
+HEDGE_MIN_DELAY = 2
+# the p90 latency of the route is trusted after so many samples
+HEDGE_MIN_SAMPLES = 5
+HEDGE_POOL = concurrent.futures.ThreadPoolExecutor(max_workers=POOL_MAX_WORKERS)
+
+# Proxy scoreboard, statistics of the proxies in the pool {proxy:ProxyStats}
+PROXY_STATS = {}
+# proxies sorted by score for every kind of request {kind:[(score, proxy),]}
+PROXY_RANKING = {'text': [], 'vision': []}
+PROXY_STATS_LOCK = threading.Lock()
+# weight of the last request in the average latency
+PROXY_EWMA_ALPHA = 0.3
+# how many last latencies to keep for percentiles
+PROXY_LATENCY_SAMPLES = 50
+# latency of a proxy that has not been used yet, seconds
+PROXY_DEFAULT_LATENCY = 5
+# latencies are divided by (1 + request size / PROXY_PAYLOAD_NORM)
+# so that big requests with pictures and long histories are comparable with short ones
+PROXY_PAYLOAD_NORM = 100000
+
+# Api keys scheduler
+# requests per minute allowed for one key {model:rpm}
+KEY_RPM = {'gemini-pro': 60, 'gemini-pro-vision': 60}
+# the key is not used for so many seconds after a key error (429/403), doubles with every failed probe
+KEY_COOLDOWN = 30
+KEY_COOLDOWN_MAX = 60*30
+# {(key, model):KeyState}
+KEYS_STATE = {}
+KEYS_LOCK = threading.Lock()
+
+# Kinds of errors, which part of the route is to blame for a failed request
+# the proxy is dead or broken, another proxy may help
+ERROR_PROXY = 'proxy'
+# the proxy is in a country where Gemini is not available, it will never work
+ERROR_BLOCKED = 'blocked'
+# the key is out of quota or invalid, another key may help
+ERROR_KEY = 'key'
+# the request itself is wrong or blocked, other routes will not help
+ERROR_REQUEST = 'request'
+# Gemini is overloaded or failed, another route may help, nobody is to blame
+ERROR_OVERLOAD = 'overload'
+# the route was not tried, its circuit breaker is open
+ERROR_SKIPPED = 'skipped'
+# the caller stopped reading the streaming answer, nothing is known about the route
+ERROR_CANCELLED = 'cancelled'
+
+# Circuit breakers of the proxies, a proxy is not used after so many proxy errors in a row
+PROXY_BREAKER_THRESHOLD = 3
+# for so many seconds, then one probe request goes through it, doubles with every failed probe
+PROXY_BREAKER_TIMEOUT = 60
+PROXY_BREAKER_TIMEOUT_MAX = 60*15
+# the proxy is removed from the pool when its breaker opens so many times in a row
+PROXY_BREAKER_MAX_TRIPS = 3
+# {proxy:CircuitBreaker}
+PROXY_BREAKERS = {}
+PROXY_BREAKERS_LOCK = threading.Lock()
+
+# Translations cache {(text, from_lang, to_lang, help):translation}, '' in the file name turns off the disk tier
+TRANSLATE_CACHE_FILE = cfg.translate_cache_file if hasattr(cfg, 'translate_cache_file') else 'db/gemini_translate_cache.db'
+TRANSLATE_CACHE_TTL = cfg.translate_cache_ttl if hasattr(cfg, 'translate_cache_ttl') else 7 * 24 * 60 * 60
+TRANSLATE_CACHE = my_cache.Cache(max_items=2000, ttl=TRANSLATE_CACHE_TTL, file_name=TRANSLATE_CACHE_FILE)
+
+# Translations requested within this window are sent in one request, seconds
+TRANSLATE_BATCH_WINDOW = 0.1
+# no more than so many texts and characters in one request
+TRANSLATE_BATCH_MAX = 20
+TRANSLATE_BATCH_MAX_CHARS = 8000
+TRANSLATE_BATCH_MARK_RE = re.compile(r'^[ \t]*<<<(\d+)>>>[ \t]*$', re.MULTILINE)
+# {(from_lang, to_lang, help):[{'text':text, 'done':threading.Event(), 'result':translation}, ]}
+TRANSLATE_BATCH_QUEUE = {}
+TRANSLATE_BATCH_LOCK = threading.Lock()
+
+# Metrics
+METRIC_REQUESTS = my_metrics.counter('gemini_requests_total', 'Requests to Gemini by route and result',
+                                     ('model', 'key', 'proxy', 'result'))
+METRIC_REQUEST_SECONDS = my_metrics.histogram('gemini_request_seconds', 'Latency of the requests to Gemini by key',
+                                              ('model', 'key'))
+METRIC_PROXY_SECONDS = my_metrics.histogram('gemini_proxy_request_seconds', 'Latency of the requests to Gemini by proxy',
+                                            ('proxy', ))
+METRIC_USER_REQUESTS = my_metrics.counter('gemini_user_requests_total', 'Calls of ai(), ai_stream() and img2txt() by result',
+                                          ('function', 'result'))
+METRIC_USER_SECONDS = my_metrics.histogram('gemini_user_request_seconds', 'Time of ai(), ai_stream() and img2txt() with all retries',
+                                           ('function', ))
+METRIC_HEDGES = my_metrics.counter('gemini_hedges_total', 'Duplicate requests sent because the first route was late')
+my_metrics.gauge('gemini_proxy_pool_size', 'Proxies in the pool', func=lambda: len(PROXY_POOL))
+my_metrics.gauge('gemini_sessions', 'Warm sessions of the routes', func=lambda: len(SESSIONS))
+my_metrics.gauge('gemini_open_breakers', 'Keys and proxies with open circuit breakers', ('component', ),
+                 func=lambda: {'key': sum(x.breaker.state != 'closed' for x in list(KEYS_STATE.values())),
+                               'proxy': sum(x.state != 'closed' for x in list(PROXY_BREAKERS.values()))})
+my_metrics.gauge('gemini_keys_in_flight', 'Requests in flight with the keys', func=lambda: sum(x.in_flight for x in list(KEYS_STATE.values())))
+my_metrics.counter('gemini_translate_cache_total', 'Translation cache lookups by result and removed disk entries', ('result', ), func=lambda: TRANSLATE_CACHE.stats)
+my_metrics.gauge('gemini_compactions_running', 'Chats being summarized', func=lambda: len(COMPACTING))
+
+
+def get_session(proxy: str = '') -> requests.Session:
+    """
+    Returns a warm keep-alive session for the given route, creating it if needed.
+
+    Args:
+        proxy (str, optional): The proxy of the route, '' for a direct connection.
+
+    Returns:
+        requests.Session: The pooled session for the route.
+    """
+    now = time.time()
+    expired = None
+    with SESSIONS_LOCK:
+        if proxy in SESSIONS:
+            session, last_used = SESSIONS[proxy]
+            if now - last_used < SESSION_IDLE_TIMEOUT:
+                SESSIONS[proxy][1] = now
+                return session
+            # idle connections are most likely already closed by the other side
+            expired = session
+        session = new_session(proxy)
+        SESSIONS[proxy] = [session, now]
+    if expired:
+        expired.close()
+    return session
+
+
+def new_session(proxy: str = '', pool_size: int = SESSION_POOL_SIZE) -> requests.Session:
+    """
+    Creates a new session with a connection pool for the given route.
+
+    Args:
+        proxy (str, optional): The proxy of the route, '' for a direct connection.
+        pool_size (int, optional): How many connections to keep open. Defaults to SESSION_POOL_SIZE.
+
+    Returns:
+        requests.Session: The new session.
+    """
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    if proxy:
+        session.proxies = {"http": proxy, "https": proxy}
+    return session
+
+
+def drop_session(proxy: str):
+    """
+    Closes the session of the given route and forgets it.
+
+    Args:
+        proxy (str): The proxy of the route, '' for a direct connection.
+    """
+    with SESSIONS_LOCK:
+        item = SESSIONS.pop(proxy, None)
+    if item:
+        item[0].close()
+
+
+def cleanup_sessions():
+    """
+    Closes sessions that were not used for more than SESSION_IDLE_TIMEOUT seconds.
+    """
+    now = time.time()
+    with SESSIONS_LOCK:
+        expired = [x for x in SESSIONS if now - SESSIONS[x][1] > SESSION_IDLE_TIMEOUT]
+        sessions = [SESSIONS.pop(x)[0] for x in expired]
+    for session in sessions:
+        session.close()
+
+
+def warm_up_sessions():
+    """
+    Opens (or keeps open) connections to Gemini on the fastest routes,
+    so the next request does not pay for the TCP, TLS and proxy handshakes.
+    """
+    if PROXY_POOL:
+        routes = get_ranked_proxies()[:SESSION_WARM_UP]
+    else:
+        routes = ['']
+
+    def warm_up(route: str):
+        try:
+            get_session(route).head(GEMINI_HOST, timeout=10)
+        except Exception as error:
+            my_log.log3(f'my_gemini:warm_up_sessions: {error}\n\n{route}')
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=SESSION_WARM_UP) as executor:
+        executor.map(warm_up, routes)
+
+
+def sessions_daemon():
+    """
+    Periodically closes idle sessions and keeps the best routes warm.
+    """
+    while 1:
+        try:
+            cleanup_sessions()
+            warm_up_sessions()
+        except Exception as error:
+            my_log.log2(f'my_gemini:sessions_daemon: {error}')
+        time.sleep(SESSION_WARM_UP_INTERVAL)
+
+
+class ProxyStats:
+    """Latency and success statistics of one proxy."""
+    def __init__(self, latency: float = PROXY_DEFAULT_LATENCY):
+        # normalized latencies {kind:seconds}
+        self.ewma = {}
+        self.samples = {}
+        self.prior = latency
+        self.ok = 0
+        self.failed = 0
+        # scores under which the proxy is in the rankings {kind:score}
+        self.ranked = {}
+
+    def add(self, kind: str, latency: float):
+        if kind in self.ewma:
+            self.ewma[kind] += PROXY_EWMA_ALPHA * (latency - self.ewma[kind])
+        else:
+            self.ewma[kind] = latency
+            self.samples[kind] = collections.deque(maxlen=PROXY_LATENCY_SAMPLES)
+        self.samples[kind].append(latency)
+        self.ok += 1
+
+    def latency(self, kind: str) -> float:
+        # vision requests through a new proxy are expected to be as fast as text ones and vice versa
+        if kind in self.ewma:
+            return self.ewma[kind]
+        if self.ewma:
+            return list(self.ewma.values())[0]
+        return self.prior
+
+    def percentile(self, kind: str, p: int) -> float:
+        samples = sorted(self.samples.get(kind, []))
+        if len(samples) < HEDGE_MIN_SAMPLES:
+            return None
+        return samples[min(len(samples) - 1, int(len(samples) * p / 100))]
+
+    def success_rate(self) -> float:
+        return (self.ok + 1) / (self.ok + self.failed + 2)
+
+    def score(self, kind: str) -> float:
+        return self.latency(kind) / self.success_rate()
+
+
+def rank_proxy(proxy: str, stats: ProxyStats):
+    """
+    Puts the proxy to its place in the rankings, PROXY_STATS_LOCK must be held.
+    """
+    unrank_proxy(proxy, stats)
+    for kind, ranking in PROXY_RANKING.items():
+        score = stats.score(kind)
+        bisect.insort(ranking, (score, proxy))
+        stats.ranked[kind] = score
+
+
+def unrank_proxy(proxy: str, stats: ProxyStats):
+    """
+    Removes the proxy from the rankings, PROXY_STATS_LOCK must be held.
+    """
+    for kind, score in stats.ranked.items():
+        ranking = PROXY_RANKING[kind]
+        i = bisect.bisect_left(ranking, (score, proxy))
+        if i < len(ranking) and ranking[i][1] == proxy:
+            del ranking[i]
+    stats.ranked = {}
+
+
+def add_proxy_stats(proxy: str, latency: float = PROXY_DEFAULT_LATENCY):
+    """
+    Starts tracking the proxy that was added to the pool.
+
+    Args:
+        proxy (str): The proxy.
+        latency (float, optional): The latency measured when the proxy was found.
+    """
+    with PROXY_STATS_LOCK:
+        if proxy not in PROXY_STATS:
+            PROXY_STATS[proxy] = ProxyStats(latency)
+        rank_proxy(proxy, PROXY_STATS[proxy])
+
+
+def remove_proxy_stats(proxy: str):
+    """
+    Stops tracking the proxy that was removed from the pool.
+    """
+    with PROXY_STATS_LOCK:
+        if proxy in PROXY_STATS:
+            unrank_proxy(proxy, PROXY_STATS.pop(proxy))
+    # the metrics of the proxies that are gone would pile up with the churn of the free proxies
+    METRIC_REQUESTS.remove(proxy=my_metrics.proxy_label(proxy))
+    METRIC_PROXY_SECONDS.remove(proxy=my_metrics.proxy_label(proxy))
+
+
+def report_proxy(proxy: str, model: str, ok: bool, total_time: float = 0, size: int = 0):
+    """
+    Updates the scoreboard after a request through the proxy.
+
+    Args:
+        proxy (str): The proxy.
+        model (str): The model, 'gemini-pro' or 'gemini-pro-vision'.
+        ok (bool): The request was successful.
+        total_time (float, optional): The time of the successful request in seconds.
+        size (int, optional): The size of the request body in bytes.
+    """
+    kind = 'vision' if 'vision' in model else 'text'
+    with PROXY_STATS_LOCK:
+        stats = PROXY_STATS.get(proxy)
+        # the proxy was removed from the pool while the request was running
+        if not stats:
+            return
+        if ok:
+            stats.add(kind, total_time / (1 + size / PROXY_PAYLOAD_NORM))
+            if kind == 'text':
+                PROXY_POLL_SPEED[proxy] = stats.ewma[kind]
+        else:
+            stats.failed += 1
+        rank_proxy(proxy, stats)
+
+
+def get_ranked_proxies(kind: str = 'text') -> list:
+    """
+    Returns the proxies of the pool, best first.
+
+    Args:
+        kind (str, optional): 'text' or 'vision'. Defaults to 'text'.
+
+    Returns:
+        list: The proxies.
+    """
+    with PROXY_STATS_LOCK:
+        return [x[1] for x in PROXY_RANKING[kind]]
+
+
+class CircuitBreaker:
+    """
+    Circuit breaker of a key or a proxy.
+
+    Closed - requests go through. After threshold failures in a row it opens - requests
+    are skipped until the timeout. Then it is half-open - one probe request goes through,
+    its success closes the breaker, its failure opens it again for twice as long.
+    """
+    def __init__(self, threshold: int, timeout: float, max_timeout: float):
+        self.threshold = threshold
+        self.base_timeout = timeout
+        self.max_timeout = max_timeout
+        self.timeout = timeout
+        self.state = 'closed'
+        self.failures = 0
+        self.open_until = 0
+        # how many times it opened since the last success
+        self.trips = 0
+
+    def available(self, now: float) -> bool:
+        """Returns True if a request can go through, without taking the probe."""
+        return self.state == 'closed' or (self.state == 'open' and now >= self.open_until)
+
+    def allow(self, now: float) -> bool:
+        """Returns True if a request can go through, the first request after the timeout is the probe."""
+        if self.state == 'open' and now >= self.open_until:
+            self.state = 'half-open'
+            return True
+        return self.state == 'closed'
+
+    def success(self):
+        self.state = 'closed'
+        self.failures = 0
+        self.timeout = self.base_timeout
+        self.trips = 0
+
+    def failure(self, now: float):
+        if self.state == 'half-open':
+            self.timeout = min(self.timeout * 2, self.max_timeout)
+            self.trip(now)
+        elif self.state == 'closed':
+            self.failures += 1
+            if self.failures >= self.threshold:
+                self.trip(now)
+
+    def neutral(self):
+        """The request neither proved nor disproved anything, the next one will be the probe."""
+        if self.state == 'half-open':
+            self.state = 'open'
+
+    def trip(self, now: float):
+        self.state = 'open'
+        self.open_until = now + self.timeout
+        self.failures = 0
+        self.trips += 1
+
+
+class KeyState:
+    """Token bucket and circuit breaker of one api key for one model."""
+    def __init__(self, rpm: int):
+        self.rpm = rpm
+        self.tokens = rpm
+        self.updated = time.time()
+        # one key error is enough, it means the quota is over
+        self.breaker = CircuitBreaker(1, KEY_COOLDOWN, KEY_COOLDOWN_MAX)
+        self.in_flight = 0
+
+    def refill(self, now: float):
+        self.tokens = min(self.rpm, self.tokens + (now - self.updated) * self.rpm / 60)
+        self.updated = now
+
+
+def get_key_state(key: str, model: str) -> KeyState:
+    """
+    Returns the state of the api key for the model, KEYS_LOCK must be held.
+    """
+    if (key, model) not in KEYS_STATE:
+        KEYS_STATE[(key, model)] = KeyState(KEY_RPM.get(model, 60))
+    return KEYS_STATE[(key, model)]
+
+
+def get_keys(model: str) -> list:
+    """
+    Returns the api keys in the order they should be tried for the model.
+
+    Keys with open circuit breakers or empty buckets are skipped, the rest are sorted by
+    the number of requests in flight and the remaining per minute quota.
+    If no key has a token, only the one that refills first is returned,
+    if all keys are open, only the one that will be probed first.
+
+    Args:
+        model (str): The model, 'gemini-pro' or 'gemini-pro-vision'.
+
+    Returns:
+        list: The api keys, best first.
+    """
+    keys = cfg.gemini_keys[:]
+    random.shuffle(keys)
+    now = time.time()
+    ready = []
+    empty = []
+    cooling = []
+    with KEYS_LOCK:
+        for key in keys:
+            state = get_key_state(key, model)
+            state.refill(now)
+            if not state.breaker.available(now):
+                cooling.append((state.breaker.open_until, key))
+            elif state.tokens < 1:
+                empty.append((-state.tokens, state.in_flight, key))
+            else:
+                ready.append((state.in_flight, -state.tokens, key))
+    if ready:
+        return [x[-1] for x in sorted(ready)]
+    if empty:
+        return [min(empty)[-1], ]
+    if cooling:
+        return [min(cooling)[1], ]
+    return []
+
 
-def img2txt(data_: bytes, prompt: str = "What is in the image, in detail?") -> str:
+def acquire_key(key: str, model: str):
+    """
+    Takes a token from the bucket of the key before the request.
+    """
+    with KEYS_LOCK:
+        state = get_key_state(key, model)
+        state.refill(time.time())
+        state.tokens = max(0, state.tokens - 1)
+        state.in_flight += 1
+
+
+def release_key(key: str, model: str, error: str):
+    """
+    Updates the state of the key after the request.
+
+    Args:
+        key (str): The api key.
+        model (str): The model.
+        error (str): The kind of the error, '' if the request was successful.
+    """
+    with KEYS_LOCK:
+        state = get_key_state(key, model)
+        state.in_flight = max(0, state.in_flight - 1)
+        if error == ERROR_KEY:
+            trips = state.breaker.trips
+            state.breaker.failure(time.time())
+            state.tokens = 0
+            if state.breaker.trips > trips:
+                my_log.log_json('my_gemini:key_breaker_open', level='warning', key=my_metrics.key_label(key),
+                                model=model, timeout=state.breaker.timeout)
+        elif error in ('', ERROR_REQUEST):
+            # Gemini accepted the key
+            state.breaker.success()
+        else:
+            state.breaker.neutral()
+
+
+def release_proxy(proxy: str, model: str, error: str):
+    """
+    Updates the circuit breaker and the scoreboard of the proxy after the request.
+    The proxy is removed from the pool if it is blocked by Google or its breaker
+    opened PROXY_BREAKER_MAX_TRIPS times in a row.
+
+    Args:
+        proxy (str): The proxy.
+        model (str): The model.
+        error (str): The kind of the error, '' if the request was successful.
+    """
+    if error == ERROR_BLOCKED:
+        remove_proxy(proxy)
+        return
+    with PROXY_BREAKERS_LOCK:
+        breaker = get_proxy_breaker(proxy)
+        if error == ERROR_PROXY:
+            trips = breaker.trips
+            breaker.failure(time.time())
+            dead = breaker.trips >= PROXY_BREAKER_MAX_TRIPS
+            if breaker.trips > trips:
+                my_log.log_json('my_gemini:proxy_breaker_open', level='warning', proxy=my_metrics.proxy_label(proxy),
+                                trips=breaker.trips, timeout=breaker.timeout)
+        elif error == ERROR_CANCELLED:
+            breaker.neutral()
+            dead = False
+        else:
+            # Gemini answered through the proxy
+            breaker.success()
+            dead = False
+    if error == ERROR_PROXY:
+        report_proxy(proxy, model, False)
+    if dead:
+        remove_proxy(proxy)
+
+
+def get_proxy_breaker(proxy: str) -> CircuitBreaker:
+    """
+    Returns the circuit breaker of the proxy, PROXY_BREAKERS_LOCK must be held.
+    """
+    if proxy not in PROXY_BREAKERS:
+        PROXY_BREAKERS[proxy] = CircuitBreaker(PROXY_BREAKER_THRESHOLD, PROXY_BREAKER_TIMEOUT, PROXY_BREAKER_TIMEOUT_MAX)
+    return PROXY_BREAKERS[proxy]
+
+
+def route_allowed(key: str, model: str, proxy: str = '') -> bool:
+    """
+    Checks the circuit breakers of the key and the proxy, and takes their probes if they are half-open.
+
+    Args:
+        key (str): The api key.
+        model (str): The model.
+        proxy (str, optional): The proxy, '' for a direct connection or a proxy that is not in the pool.
+
+    Returns:
+        bool: True if the request can be sent.
+    """
+    now = time.time()
+    with KEYS_LOCK, PROXY_BREAKERS_LOCK:
+        key_breaker = get_key_state(key, model).breaker
+        proxy_breaker = get_proxy_breaker(proxy) if proxy else None
+        if not key_breaker.available(now) or (proxy_breaker and not proxy_breaker.available(now)):
+            return False
+        key_breaker.allow(now)
+        if proxy_breaker:
+            proxy_breaker.allow(now)
+        return True
+
+
+def classify_error(response: requests.Response = None, error: Exception = None, proxy: str = '') -> str:
+    """
+    Finds out which part of the route is to blame for the failed request.
+
+    Args:
+        response (requests.Response, optional): The answer if there was one.
+        error (Exception, optional): The exception if there was no answer.
+        proxy (str, optional): The proxy of the route.
+
+    Returns:
+        str: ERROR_PROXY, ERROR_BLOCKED, ERROR_KEY, ERROR_REQUEST or ERROR_OVERLOAD.
+    """
+    if response is None:
+        # no answer, with a direct connection it is Google or the network
+        return ERROR_PROXY if proxy else ERROR_OVERLOAD
+
+    status = response.status_code
+    try:
+        message = str(response.json()['error'])
+    except Exception:
+        # Gemini always answers errors with json, the rest are the pages of the proxy
+        return ERROR_PROXY if proxy else ERROR_OVERLOAD
+    if 'location is not supported' in message:
+        return ERROR_BLOCKED if proxy else ERROR_REQUEST
+    if status in (401, 403, 429) or 'API_KEY_INVALID' in message or 'API key not valid' in message:
+        return ERROR_KEY
+    if status >= 500:
+        return ERROR_OVERLOAD
+    return ERROR_REQUEST
+
+
+@my_trace.traced('gemini.img2txt')
+def img2txt(data_, prompt: str = "What is in the image, in detail?", mime_type: str = 'image/jpeg') -> str:
     """
     Generates a textual description of an image based on its contents.
 
     Args:
-        data_: The image data as bytes.
+        data_: The image data as bytes, or a list of (data, mime_type) to send several images in one request.
         prompt: The prompt to provide for generating the description. Defaults to "Что на картинке, подробно?".
+        mime_type: The type of the image. Defaults to 'image/jpeg'.
 
     Returns:
         A textual description of the image.
@@ -70,72 +757,76 @@ def img2txt(data_: bytes, prompt: str = "What is in the image, in detail?") -> s
     """
     global PROXY_POOL
 
+    img_start_time = time.time()
     try:
-        img_data = base64.b64encode(data_).decode("utf-8")
-        data = {
-            "contents": [
-                {
-                "parts": [
-                    {"text": prompt},
-                    {
-                    "inline_data": {
-                        "mime_type": "image/jpeg",
-                        "data": img_data
-                    }
-                    }
-                ]
-                }
-            ]
-            }
+        images = data_ if isinstance(data_, list) else [(data_, mime_type), ]
+        data = make_image_request_body(images, prompt)
 
         result = ''
-        keys = cfg.gemini_keys[:]
-        random.shuffle(keys)
-
-        proxies = PROXY_POOL[:]
-        random.shuffle(proxies)
-
-        for api_key in keys:
-            url = f"https://generativelanguage.googleapis.com/v1beta/models/gemini-pro-vision:generateContent?key={api_key}"
-
-            if proxies:
-                sort_proxies_by_speed(proxies)
-                for proxy in proxies:
-                    start_time = time.time()
-                    session = requests.Session()
-                    session.proxies = {"http": proxy, "https": proxy}
-                    try:
-                        response = session.post(url, json=data, timeout=60).json()
-                        result = response['candidates'][0]['content']['parts'][0]['text']
-                        if result:
-                            end_time = time.time()
-                            total_time = end_time - start_time
-                            if total_time > 45:
-                                remove_proxy(proxy)
-                            # не участвовать в рейтинге скорости прокси так как ответы всегда заметно более долгие
-                            # else:
-                            #     PROXY_POLL_SPEED[proxy] = total_time
-                            break
-                    except (requests.exceptions.ProxyError, requests.exceptions.ConnectionError) as error:
-                        remove_proxy(proxy)
-                        continue
-            else:
-                try:
-                    response = requests.post(url, json=data, timeout=60).json()
-                    try:
-                        result = response['candidates'][0]['content']['parts'][0]['text']
-                    except AttributeError:
-                        my_log.log2(f'img2txt:{api_key} {str(response)} {response.text}')
-                except Exception as error:
-                    my_log.log2(f'img2txt:{error}')
+        keys = get_keys('gemini-pro-vision')
+
+        proxies = get_ranked_proxies('vision')
+
+        bad_keys = set()
+        for key, proxy in [(key, proxy) for key in keys for proxy in (proxies or ['', ])]:
+            if key in bad_keys:
+                continue
+            start_time = time.time()
+            result, error = ai_request('gemini-pro-vision', key, data, proxy)
+            if error == ERROR_KEY:
+                bad_keys.add(key)
+            if error == ERROR_REQUEST:
+                break
             if result:
+                # не участвовать в рейтинге скорости прокси так как ответы всегда заметно более долгие
+                if proxy and time.time() - start_time > 45:
+                    remove_proxy(proxy)
                 break
+        observe_user_request('img2txt', img_start_time, bool(result))
         return result.strip()
     except Exception as unknown_error:
         my_log.log2(f'my_gemini:img2txt:{unknown_error}')
+        observe_user_request('img2txt', img_start_time, False)
         return ''
 
 
+def make_image_request_body(images: list, prompt: str) -> bytes:
+    """
+    Makes the json body of a vision request. The images are base64 encoded right into
+    the body, without extra copies of them as str.
+
+    Args:
+        images (list): The images, [(data, mime_type), ].
+        prompt (str): The question about the images.
+
+    Returns:
+        bytes: The request body.
+    """
+    mark = '@IMAGE@'
+    while mark in prompt:
+        mark += '@'
+    template = {
+        "contents": [
+            {
+            "parts": [{"text": prompt}] + [
+                {
+                "inline_data": {
+                    "mime_type": mime_type,
+                    "data": mark
+                }
+                } for _, mime_type in images
+            ]
+            }
+        ]
+        }
+    parts = json.dumps(template).split(mark)
+    body = [parts[0].encode('utf-8')]
+    for (data_, _), part in zip(images, parts[1:]):
+        body.append(base64.b64encode(data_))
+        body.append(part.encode('utf-8'))
+    return b''.join(body)
+
+
 def update_mem(query: str, resp: str, mem) -> list:
     """
     Update the memory with the given query and response.
@@ -148,31 +839,247 @@ def update_mem(query: str, resp: str, mem) -> list:
     Returns:
         list: The updated memory object.
     """
-    chat_id = ''
     if isinstance(mem, str): # if mem - chat_id
         chat_id = mem
-        if mem not in CHATS:
-            CHATS[mem] = []
-        mem = CHATS[mem]
+        if not resp:
+            return
+        with get_lock(chat_id):
+            history = load_history(chat_id)
+            save_turn(chat_id, history, query, resp)
+            return history.to_list()
 
     if resp:
-        mem.append({"role": "user", "parts": [{"text": query}]})
-        mem.append({"role": "model", "parts": [{"text": resp}]})
-        size = 0
-        for x in mem:
-            text = x['parts'][0]['text']
-            size += len(text)
-        while size > MAX_CHAT_SIZE:
-            mem = mem[2:]
-            size = 0
-            for x in mem:
-                text = x['parts'][0]['text']
-                size += len(text)
-        if chat_id:
-            CHATS[chat_id] = mem
-        return mem
+        history = my_history.ChatMemory(mem, history_cost)
+        history.add_turn(query, resp)
+        history.trim(history_budget())
+        return history.to_list()
 
 
+def get_lock(chat_id: str) -> threading.Lock:
+    """
+    Returns the lock of the chat, the history of a chat is changed by one thread at a time.
+    """
+    if chat_id not in LOCKS:
+        LOCKS[chat_id] = threading.Lock()
+    return LOCKS[chat_id]
+
+
+@my_trace.traced('gemini.load_history')
+def load_history(chat_id: str) -> my_history.ChatMemory:
+    """
+    Reads the history of the chat that fits the budget.
+
+    Args:
+        chat_id (str): The ID of the chat.
+
+    Returns:
+        my_history.ChatMemory: The history.
+    """
+    history = my_history.get_history(chat_id, history_cost)
+    history.trim(history_budget())
+    return history
+
+
+def prefetch_history(chat_id: str):
+    """
+    Starts reading the history of the chat into the cache in background,
+    so it is ready when the request of the chat is about to be sent.
+
+    Args:
+        chat_id (str): The ID of the chat.
+    """
+    if my_history.is_cached(chat_id):
+        return
+
+    def prefetch():
+        lock = get_lock(chat_id)
+        # the chat is busy, it is loading its history itself
+        if not lock.acquire(blocking=False):
+            return
+        try:
+            my_history.get_history(chat_id, history_cost)
+        except Exception as error:
+            my_log.log2(f'my_gemini:prefetch_history: {error}')
+        finally:
+            lock.release()
+
+    PREFETCH_POOL.submit(prefetch)
+
+
+@my_trace.traced('gemini.save_turn')
+def save_turn(chat_id: str, history: my_history.ChatMemory, query: str, resp: str):
+    """
+    Adds the question and the answer to the history of the chat, drops the old messages
+    that do not fit the budget and writes only the changes to the store.
+
+    Args:
+        chat_id (str): The ID of the chat.
+        history (my_history.ChatMemory): The loaded history of the chat.
+        query (str): The question.
+        resp (str): The answer.
+    """
+    seq = history.next_seq
+    history.add_turn(query, resp)
+    history.trim(history_budget())
+    my_history.save(chat_id, seq, list(history.messages)[-2:], history.first_seq)
+    my_history.cache_put(chat_id, history)
+    if HISTORY_COMPACT and history.size > request_budget() * HISTORY_COMPACT_AT:
+        start_compaction(chat_id, history)
+
+
+def start_compaction(chat_id: str, history: my_history.ChatMemory):
+    """
+    Starts summarizing the oldest turns of the chat in background.
+    Must be called under the lock of the chat.
+
+    Args:
+        chat_id (str): The ID of the chat.
+        history (my_history.ChatMemory): The loaded history of the chat.
+    """
+    with COMPACTING_LOCK:
+        if chat_id in COMPACTING or COMPACT_FAILED.get(chat_id, (0, 0))[0] > time.time():
+            return
+        COMPACTING.add(chat_id)
+
+    # the oldest pairs to summarize, the rest must fit HISTORY_COMPACT_KEEP
+    keep = request_budget() * HISTORY_COMPACT_KEEP
+    size = history.size
+    n = 0
+    costs = list(history.costs)
+    while n + 2 < len(costs) and size > keep:
+        size -= costs[n] + costs[n + 1]
+        n += 2
+    messages = list(history.messages)[:n]
+    first_seq = history.first_seq
+
+    def compact():
+        ok = False
+        try:
+            ok = n <= 2 or compact_history(chat_id, first_seq, messages)
+        except Exception as error:
+            error_traceback = traceback.format_exc()
+            my_log.log2(f'my_gemini:compact: {error}\n\n{error_traceback}')
+        finally:
+            with COMPACTING_LOCK:
+                COMPACTING.discard(chat_id)
+                if ok:
+                    COMPACT_FAILED.pop(chat_id, None)
+                else:
+                    # do not ask Gemini for a summary on every turn while it fails
+                    delay = min(COMPACT_FAILED[chat_id][1] * 2, COMPACT_RETRY_MAX) if chat_id in COMPACT_FAILED else COMPACT_RETRY
+                    COMPACT_FAILED[chat_id] = (time.time() + delay, delay)
+
+    COMPACT_POOL.submit(compact)
+
+
+def compact_history(chat_id: str, first_seq: int, messages: list):
+    """
+    Summarizes the messages and replaces them with the summary in the history of the chat.
+    Nothing is changed if the history was trimmed or reset meanwhile.
+
+    Args:
+        chat_id (str): The ID of the chat.
+        first_seq (int): The number of the first message when the compaction started.
+        messages (list): The oldest messages to summarize.
+
+    Returns:
+        bool: False if Gemini did not make the summary.
+    """
+    dialog = '\n\n'.join(f'{"User" if x["role"] == "user" else "Assistant"}: {x["parts"][0]["text"]}' for x in messages)
+    query = ('Summarize this conversation between a user and an assistant so that it can be continued '
+             'without the original. Keep the facts, names, numbers, decisions, the wishes of the user and '
+             'the open questions, skip the small talk. Write in the language of the conversation, '
+             f'no more than 300 words.\n\n{dialog}')
+    summary = ai(query, temperature=0.1)
+    if not summary:
+        return False
+    summary = [{"role": "user", "parts": [{"text": f'{HISTORY_SUMMARY_PREFIX}\n\n{summary}'}]},
+               {"role": "model", "parts": [{"text": 'OK, I remember it.'}]}]
+
+    with get_lock(chat_id):
+        history = my_history.get_history(chat_id, history_cost)
+        if history.first_seq != first_seq or list(history.messages)[:len(messages)] != messages:
+            return True
+        history.compact(len(messages), summary)
+        my_history.save(chat_id, history.first_seq, summary, history.first_seq)
+        my_history.cache_put(chat_id, history)
+    return True
+
+
+def history_cost(text: str) -> int:
+    """
+    Returns the size of the text in the units of the chat history budget.
+    """
+    if HISTORY_BUDGET_MODE == 'tokens':
+        return my_history.estimate_tokens(text)
+    return len(text)
+
+
+def history_budget(model: str = 'gemini-pro') -> int:
+    """
+    Returns the maximum size of the stored chat history for the model.
+    """
+    if HISTORY_RETRIEVAL:
+        return request_budget(model) * HISTORY_RETRIEVAL_STORE
+    return request_budget(model)
+
+
+def request_budget(model: str = 'gemini-pro') -> int:
+    """
+    Returns the maximum size of the chat history sent with a request to the model.
+    """
+    if HISTORY_BUDGET_MODE == 'tokens':
+        return HISTORY_TOKEN_BUDGET.get(model, HISTORY_TOKEN_BUDGET['gemini-pro'])
+    return MAX_CHAT_SIZE
+
+
+def request_history(history: my_history.ChatMemory, query: str) -> list:
+    """
+    Returns the messages of the chat history to send with the query.
+    Normally it is the whole history, in the retrieval mode it is the summary of the chat
+    if there is one, the last turns and the older turns most relevant to the query
+    that fit the request budget, in the order they were said.
+
+    Args:
+        history (my_history.ChatMemory): The loaded history of the chat.
+        query (str): The question.
+
+    Returns:
+        list: The messages.
+    """
+    if not HISTORY_RETRIEVAL or history.size <= request_budget():
+        return history.to_list()
+
+    messages = list(history.messages)
+    costs = list(history.costs)
+    budget = request_budget()
+    # {index of the question:cost of the pair}
+    chosen = {}
+
+    def choose(i: int, limit: int = budget) -> bool:
+        if i in chosen or i < 0 or i + 1 >= len(messages):
+            return True
+        cost = costs[i] + costs[i + 1]
+        if cost > limit - sum(chosen.values()):
+            return False
+        chosen[i] = cost
+        return True
+
+    if messages[0]['parts'][0]['text'].startswith(HISTORY_SUMMARY_PREFIX):
+        choose(0)
+    # the last turn always goes, the other recent ones leave the room for the relevant ones
+    choose(len(messages) - 2)
+    for i in range(len(messages) - 4, max(-1, len(messages) - 2 * HISTORY_RETRIEVAL_RECENT - 2), -2):
+        if not choose(i, budget // 2):
+            break
+    exclude = {history.first_seq + i for i in chosen}
+    for _, seq in history.enable_index().search(query, HISTORY_RETRIEVAL_TOP_K, exclude):
+        choose(seq - history.first_seq)
+
+    return [x for i in sorted(chosen) for x in messages[i:i + 2]]
+
+
+@my_trace.traced('gemini.ai')
 def ai(q: str, mem = [], temperature: float = 0.1, proxy_str: str = '') -> str:
     """
     Generate the response from an AI model based on a user query.
@@ -189,7 +1096,250 @@ def ai(q: str, mem = [], temperature: float = 0.1, proxy_str: str = '') -> str:
     """
     global PROXY_POOL
 
-    mem_ = {"contents": mem + [{"role": "user", "parts": [{"text": q}]}],
+    ai_start_time = time.time()
+    mem_ = make_request_body(q, mem, temperature)
+
+    keys = get_keys('gemini-pro')
+    result = ''
+
+    if proxy_str:
+        proxies = [proxy_str, ]
+    else:
+        proxies = get_ranked_proxies('text')
+
+    try:
+        routes = [(key, proxy) for key in keys for proxy in (proxies or ['', ])]
+
+        if HEDGE_REQUESTS and not proxy_str and len(routes) > 1:
+            result = ai_hedged(routes, mem_)
+            observe_user_request('ai', ai_start_time, bool(result))
+            return result.strip()
+
+        bad_keys = set()
+        for key, proxy in routes:
+            # do not try the other proxies with the key that is out of quota
+            if key in bad_keys:
+                continue
+            start_time = time.time()
+            # candidates from the proxy search are not pooled, most of them are useless
+            result, error = ai_request('gemini-pro', key, mem_, proxy, pooled=not proxy_str)
+            if error == ERROR_KEY:
+                bad_keys.add(key)
+            # the request itself is wrong, no need to try the other routes
+            if error == ERROR_REQUEST:
+                break
+            if result:
+                if proxy:
+                    report_proxy_speed(proxy, time.time() - start_time)
+                break
+    except Exception as unknown_error:
+        my_log.log2(f'my_gemini:ai:{unknown_error}')
+
+    # the proxy search tries the candidates with ai(), they are not user requests
+    if not proxy_str:
+        observe_user_request('ai', ai_start_time, bool(result))
+    return result.strip()
+
+
+def ai_request(model: str, key: str, data: dict, proxy: str = '', pooled: bool = True) -> tuple:
+    """
+    Makes a single request to Gemini through the given route.
+
+    Args:
+        model (str): The model, 'gemini-pro' or 'gemini-pro-vision'.
+        key (str): The api key.
+        data (dict): The request body, or its json as bytes.
+        proxy (str, optional): The proxy to use, '' for a direct connection.
+        pooled (bool, optional): Use the warm session of the route instead of a new one. Defaults to True.
+
+    Returns:
+        tuple: The generated text or '' if the request failed, and the kind of the error ('' if there was none).
+    """
+    # candidates from the proxy search are not in the scoreboard and have no breakers
+    report = proxy and pooled
+    if not route_allowed(key, model, proxy if report else ''):
+        METRIC_REQUESTS.inc(model=model, key=my_metrics.key_label(key), proxy=metric_proxy_label(proxy, pooled), result=ERROR_SKIPPED)
+        return '', ERROR_SKIPPED
+    url = f'{GEMINI_HOST}/v1beta/models/{model}:generateContent?key={key}'
+    session = get_session(proxy) if pooled else new_session(proxy, pool_size=1)
+    acquire_key(key, model)
+    error = ERROR_OVERLOAD
+    result = ''
+    start_time = time.time()
+    try:
+        if isinstance(data, bytes):
+            response = session.post(url, data=data, headers={'Content-Type': 'application/json'}, timeout=REQUEST_TIMEOUT)
+        else:
+            response = session.post(url, json=data, timeout=REQUEST_TIMEOUT)
+        if response.status_code == 200:
+            try:
+                result = response.json()['candidates'][0]['content']['parts'][0]['text']
+                error = ''
+            except Exception as parse_error:
+                # the answer was blocked or the proxy changed it
+                error = ERROR_REQUEST if 'promptFeedback' in response.text or 'finishReason' in response.text else ERROR_PROXY
+                my_log.log2(f'my_gemini:ai_request:{proxy} {parse_error} {response.text}')
+        else:
+            error = classify_error(response, proxy=proxy)
+            my_log.log2(f'my_gemini:ai_request:{proxy} {key} {error} {str(response)} {response.text}')
+    except Exception as request_error:
+        error = classify_error(error=request_error, proxy=proxy)
+        my_log.log3(f'{request_error}\n\n{proxy}')
+    finally:
+        release_key(key, model, error)
+        if report:
+            release_proxy(proxy, model, error)
+        if not pooled:
+            session.close()
+        observe_request(model, key, proxy, error, time.time() - start_time, pooled)
+
+    if not error and report:
+        report_proxy(proxy, model, True, time.time() - start_time, len(response.request.body or b''))
+    return result, error
+
+
+def ai_stream_request(model: str, key: str, data: dict, proxy: str = ''):
+    """
+    Makes a single streaming request to Gemini through the given route.
+
+    Args:
+        model (str): The model, 'gemini-pro' or 'gemini-pro-vision'.
+        key (str): The api key.
+        data (dict): The request body.
+        proxy (str, optional): The proxy to use, '' for a direct connection.
+
+    Yields:
+        str: The pieces of the generated text.
+
+    Returns:
+        str: The kind of the error, '' if there was none.
+    """
+    if not route_allowed(key, model, proxy):
+        METRIC_REQUESTS.inc(model=model, key=my_metrics.key_label(key), proxy=my_metrics.proxy_label(proxy), result=ERROR_SKIPPED)
+        return ERROR_SKIPPED
+    url = f'{GEMINI_HOST}/v1beta/models/{model}:streamGenerateContent?alt=sse&key={key}'
+    session = get_session(proxy)
+    acquire_key(key, model)
+    error = ERROR_OVERLOAD
+    pieces = 0
+    start_time = time.time()
+    try:
+        with session.post(url, json=data, timeout=REQUEST_TIMEOUT, stream=True) as response:
+            if response.status_code != 200:
+                error = classify_error(response, proxy=proxy)
+                my_log.log2(f'my_gemini:ai_stream_request:{proxy} {key} {error} {str(response)} {response.text}')
+                return error
+            for line in response.iter_lines(decode_unicode=True):
+                if not line or not line.startswith('data: '):
+                    continue
+                try:
+                    text = json.loads(line[6:])['candidates'][0]['content']['parts'][0]['text']
+                except Exception as parse_error:
+                    my_log.log2(f'my_gemini:ai_stream_request:{proxy} {parse_error} {line}')
+                    continue
+                if text:
+                    pieces += 1
+                    yield text
+            # Gemini answered but there was no text, the answer was blocked
+            error = '' if pieces else ERROR_REQUEST
+            if proxy and pieces:
+                report_proxy(proxy, model, True, time.time() - start_time, len(response.request.body or b''))
+    except GeneratorExit:
+        # the caller closed the generator, the request did not end
+        error = ERROR_CANCELLED
+        raise
+    except Exception as request_error:
+        # an error in the middle of the answer is not a reason to try another route,
+        # the caller keeps what it got
+        error = classify_error(error=request_error, proxy=proxy)
+        my_log.log3(f'{request_error}\n\n{proxy}')
+    finally:
+        release_key(key, model, error)
+        if proxy:
+            release_proxy(proxy, model, error)
+        observe_request(model, key, proxy, error, time.time() - start_time)
+    return error
+
+
+def observe_request(model: str, key: str, proxy: str, error: str, total_time: float, pooled: bool = True):
+    """
+    Counts the request to Gemini in the metrics and adds it to the trace of the user request.
+    """
+    my_trace.record('gemini.request', total_time, model=model, key=my_metrics.key_label(key),
+                    proxy=my_metrics.proxy_label(proxy), result=error or 'ok')
+    METRIC_REQUESTS.inc(model=model, key=my_metrics.key_label(key), proxy=metric_proxy_label(proxy, pooled), result=error or 'ok')
+    METRIC_REQUEST_SECONDS.observe(total_time, model=model, key=my_metrics.key_label(key))
+    METRIC_PROXY_SECONDS.observe(total_time, proxy=metric_proxy_label(proxy, pooled))
+
+
+def metric_proxy_label(proxy: str, pooled: bool = True) -> str:
+    """
+    Returns the proxy label of the metrics. The candidates from the proxy search share one label,
+    only the proxies of the pool get their own, and it is removed with the proxy.
+    """
+    return my_metrics.proxy_label(proxy) if pooled else 'candidate'
+
+
+def observe_user_request(function: str, start_time: float, ok: bool):
+    """
+    Counts the call of ai(), ai_stream() or img2txt() in the metrics.
+    """
+    METRIC_USER_REQUESTS.inc(function=function, result='ok' if ok else 'failed')
+    METRIC_USER_SECONDS.observe(time.time() - start_time, function=function)
+
+
+def ai_stream(q: str, mem = [], temperature: float = 0.1):
+    """
+    Generates the response like ai() but yields the text by pieces as soon as Gemini sends them.
+    The next route is tried only if the current one failed before the first piece.
+
+    Args:
+        q (str): The user query.
+        mem (list, optional): The list of previous queries and responses. Defaults to an empty list.
+        temperature (float, optional): The temperature parameter for generating the response.
+
+    Yields:
+        str: The pieces of the generated text.
+    """
+    start_time = time.time()
+    data = make_request_body(q, mem, temperature)
+    proxies = get_ranked_proxies('text')
+    bad_keys = set()
+    for key, proxy in [(key, proxy) for key in get_keys('gemini-pro') for proxy in (proxies or ['', ])]:
+        if key in bad_keys:
+            continue
+        pieces = 0
+        stream = ai_stream_request('gemini-pro', key, data, proxy)
+        try:
+            while 1:
+                piece = next(stream)
+                pieces += 1
+                yield piece
+        except StopIteration as stop:
+            error = stop.value
+        finally:
+            stream.close()
+        if pieces or error == ERROR_REQUEST:
+            observe_user_request('ai_stream', start_time, bool(pieces))
+            return
+        if error == ERROR_KEY:
+            bad_keys.add(key)
+    observe_user_request('ai_stream', start_time, False)
+
+
+def make_request_body(q: str, mem: list, temperature: float) -> dict:
+    """
+    Makes the body of a text request.
+
+    Args:
+        q (str): The user query.
+        mem (list): The list of previous queries and responses.
+        temperature (float): The temperature parameter for generating the response.
+
+    Returns:
+        dict: The request body.
+    """
+    return {"contents": mem + [{"role": "user", "parts": [{"text": q}]}],
             "safetySettings": [
                 {
                     "category": "HARM_CATEGORY_HARASSMENT",
@@ -219,63 +1369,116 @@ def ai(q: str, mem = [], temperature: float = 0.1, proxy_str: str = '') -> str:
                 }
             }
 
-    keys = cfg.gemini_keys[:]
-    random.shuffle(keys)
-    result = ''
 
-    if proxy_str:
-        proxies = [proxy_str, ]
-    else:
-        proxies = PROXY_POOL[:]
-        # random.shuffle(proxies)
+def ai_hedged(routes: list, data: dict) -> str:
+    """
+    Sends the request to the first route and, if it is slower than usual for that route,
+    sends duplicates to the next routes. The first successful answer wins, the others are cancelled.
 
-    proxy = ''
-    try:
-        for key in keys:
-            url = "https://generativelanguage.googleapis.com/v1beta/models/gemini-pro:generateContent?key=" + key
-
-            if proxies:
-                sort_proxies_by_speed(proxies)
-                for proxy in proxies:
-                    start_time = time.time()
-                    session = requests.Session()
-                    session.proxies = {"http": proxy, "https": proxy}
-                    try:
-                        response = session.post(url, json=mem_, timeout=60)
-                    except (requests.exceptions.ProxyError, requests.exceptions.ConnectionError) as error:
-                        reasons = ['Connection aborted', 'Max retries exceeded with url',]
-                        if any(x in str(error) for x in reasons):
-                            remove_proxy(proxy)
-                        else:
-                            my_log.log3(f'{error}\n\n{proxy}')
-                        continue
-
-                    if response.status_code == 200:
-                        result = response.json()['candidates'][0]['content']['parts'][0]['text']
-                        end_time = time.time()
-                        total_time = end_time - start_time
-                        if total_time > 50:
-                            remove_proxy(proxy)
-                        else:
-                            PROXY_POLL_SPEED[proxy] = total_time
-                            save_proxy_pool()
-                        break
-                    else:
-                        remove_proxy(proxy)
-                        my_log.log2(f'my_gemini:ai:{proxy} {key} {str(response)} {response.text}')
-            else:
-                response = requests.post(url, json=mem_, timeout=60)
-                if response.status_code == 200:
-                    result = response.json()['candidates'][0]['content']['parts'][0]['text']
-                else:
-                    my_log.log2(f'my_gemini:ai:{key} {str(response)} {response.text}')
+    The requests are streamed, so a cancelled duplicate closes its connection and releases
+    its key as soon as the next piece of its answer arrives.
 
-            if result:
+    Args:
+        routes (list): The list of (key, proxy) pairs, best first.
+        data (dict): The request body.
+
+    Returns:
+        str: The generated text or '' if all routes failed.
+    """
+    cancel = threading.Event()
+
+    def request(key: str, proxy: str):
+        start_time = time.time()
+        pieces = []
+        stream = ai_stream_request('gemini-pro', key, data, proxy)
+        try:
+            while not cancel.is_set():
+                pieces.append(next(stream))
+        except StopIteration as stop:
+            error = stop.value
+            # the pieces of a broken answer are not an answer
+            return '' if error else ''.join(pieces), error, time.time() - start_time
+        # another route has answered
+        stream.close()
+        return '', ERROR_CANCELLED, time.time() - start_time
+
+    try:
+        size = len(json.dumps(data))
+        routes = routes[:]
+        in_flight = {}
+        bad_keys = set()
+        hedges = 0
+        delay = None
+        while routes or in_flight:
+            # do not try the other proxies with the key that is out of quota
+            routes = [x for x in routes if x[0] not in bad_keys]
+            if not routes and not in_flight:
                 break
-    except Exception as unknown_error:
-        my_log.log2(f'my_gemini:ai:{unknown_error}')
+            # start the next route if nothing is running or the running ones are too slow
+            if routes and (not in_flight or (delay is not None and hedges < HEDGE_BUDGET and len(in_flight) < HEDGE_MAX_FANOUT)):
+                if in_flight:
+                    hedges += 1
+                    METRIC_HEDGES.inc()
+                key, proxy = routes.pop(0)
+                in_flight[HEDGE_POOL.submit(my_trace.bind(request), key, proxy)] = (key, proxy)
+                delay = hedge_delay(proxy, size) if len(in_flight) < HEDGE_MAX_FANOUT else None
+
+            done, _ = concurrent.futures.wait(in_flight, timeout=delay, return_when=concurrent.futures.FIRST_COMPLETED)
+            if not done:
+                continue
+            # a route failed or answered, the next hedge waits for a new threshold
+            delay = None
+            for future in done:
+                key, proxy = in_flight.pop(future)
+                result, error, total_time = future.result()
+                if error == ERROR_KEY:
+                    bad_keys.add(key)
+                # the request itself is wrong, the duplicates will fail the same way
+                if error == ERROR_REQUEST:
+                    return ''
+                if result:
+                    if proxy:
+                        report_proxy_speed(proxy, total_time)
+                    return result
+            if in_flight and routes and len(in_flight) < HEDGE_MAX_FANOUT:
+                delay = min(hedge_delay(x[1], size) for x in in_flight.values())
+        return ''
+    finally:
+        # the slower duplicates stop at their next piece
+        cancel.set()
 
-    return result.strip()
+
+def hedge_delay(proxy: str, size: int) -> float:
+    """
+    Returns how long to wait for an answer from the route before sending a duplicate request.
+
+    Args:
+        proxy (str): The proxy of the route.
+        size (int): The size of the request body in bytes.
+
+    Returns:
+        float: The p90 latency of the route in seconds or HEDGE_DEFAULT_DELAY if it is unknown.
+    """
+    with PROXY_STATS_LOCK:
+        stats = PROXY_STATS.get(proxy)
+        p90 = stats.percentile('text', 90) if stats else None
+    if p90 is None:
+        return HEDGE_DEFAULT_DELAY
+    return max(HEDGE_MIN_DELAY, p90 * (1 + size / PROXY_PAYLOAD_NORM))
+
+
+def report_proxy_speed(proxy: str, total_time: float):
+    """
+    Removes the proxy from the pool if the answer was too slow, otherwise saves the new speed rating.
+
+    Args:
+        proxy (str): The proxy.
+        total_time (float): The time of the request in seconds.
+    """
+    if total_time > 50:
+        remove_proxy(proxy)
+    else:
+        save_proxy_pool()
 
 
 def chat(query: str, chat_id: str, temperature: float = 0.1, update_memory: bool = True) -> str:
@@ -291,22 +1494,38 @@ def chat(query: str, chat_id: str, temperature: float = 0.1, update_memory: bool
     Returns:
         str: The response generated by the chat model.
     """
-    if chat_id in LOCKS:
-        lock = LOCKS[chat_id]
-    else:
-        lock = threading.Lock()
-        LOCKS[chat_id] = lock
-    with lock:
-        if chat_id not in CHATS:
-            CHATS[chat_id] = []
-        mem = CHATS[chat_id]
-        r = ai(query, mem, temperature)
+    with get_lock(chat_id):
+        history = load_history(chat_id)
+        r = ai(query, request_history(history, query), temperature)
         if r and update_memory:
-            mem = update_mem(query, r, mem)
-            CHATS[chat_id] = mem
+            save_turn(chat_id, history, query, r)
         return r
 
 
+def chat_stream(query: str, chat_id: str, temperature: float = 0.1, update_memory: bool = True):
+    """
+    Executes a chat query like chat() but yields the response by pieces as they arrive.
+
+    Args:
+        query (str): The query string.
+        chat_id (str): The ID of the chat.
+        temperature (float, optional): The temperature value for the chat response. Defaults to 0.1.
+        update_memory (bool, optional): Indicates whether to update the chat memory. Defaults to True.
+
+    Yields:
+        str: The pieces of the response.
+    """
+    with get_lock(chat_id):
+        history = load_history(chat_id)
+        r = ''
+        for piece in ai_stream(query, request_history(history, query), temperature):
+            r += piece
+            yield piece
+        r = r.strip()
+        if r and update_memory:
+            save_turn(chat_id, history, query, r)
+
+
 def reset(chat_id: str):
     """
     Resets the chat history for the given ID.
@@ -317,7 +1536,7 @@ def reset(chat_id: str):
     Returns:
         None
     """
-    CHATS[chat_id] = []
+    my_history.reset(chat_id)
 
 
 def get_mem_as_string(chat_id: str) -> str:
@@ -330,9 +1549,7 @@ def get_mem_as_string(chat_id: str) -> str:
     Returns:
         str: The chat history as a string.
     """
-    if chat_id not in CHATS:
-        CHATS[chat_id] = []
-    mem = CHATS[chat_id]
+    mem = my_history.get_tail(chat_id)[1]
     result = ''
     for x in mem:
         role = x['role']
@@ -351,9 +1568,11 @@ def get_mem_as_string(chat_id: str) -> str:
     return result 
 
 
+@my_trace.traced('gemini.translate')
 def translate(text: str, from_lang: str = '', to_lang: str = '', help: str = '') -> str:
     """
     Translates the given text from one language to another.
+    The translations are cached, the same concurrent translations make only one request.
     
     Args:
         text (str): The text to be translated.
@@ -364,21 +1583,150 @@ def translate(text: str, from_lang: str = '', to_lang: str = '', help: str = '')
     Returns:
         str: The translated text.
     """
-    if from_lang == '':
-        from_lang = 'autodetect'
-    if to_lang == '':
-        to_lang = 'ru'
-    try:
-        from_lang = langcodes.Language.make(language=from_lang).display_name(language='en') if from_lang != 'autodetect' else 'autodetect'
-    except Exception as error1:
-        error_traceback = traceback.format_exc()
-        my_log.log2(f'my_gemini:translate:error1: {error1}\n\n{error_traceback}')
-        
+    from_lang, to_lang = from_lang or 'autodetect', to_lang or 'ru'
+    key = translate_key(text, from_lang, to_lang, help)
+    return TRANSLATE_CACHE.get_or_compute(key, lambda: translate_request(text, from_lang, to_lang, help)) or ''
+
+
+def translate_key(text: str, from_lang: str, to_lang: str, help: str) -> tuple:
+    return (normalize_text(text), from_lang.lower(), to_lang.lower(), help)
+
+
+def translate_batch(texts: list, from_lang: str = '', to_lang: str = '', help: str = '') -> list:
+    """
+    Translates many texts with as few requests as possible. The texts that are not in the cache
+    are packed into one numbered prompt (several if there are too many of them), the texts that
+    can not be found in the answer are translated one by one.
+
+    Args:
+        texts (list): The texts to be translated.
+        from_lang (str, optional): The language of the texts, autodetect if not specified.
+        to_lang (str, optional): The language to translate the texts into, russian if not specified.
+        help (str, optional): Help text for tranlator.
+
+    Returns:
+        list: The translated texts in the same order, '' for the failed ones.
+    """
+    from_lang, to_lang = from_lang or 'autodetect', to_lang or 'ru'
+    results = {}
+    todo = []
+    for text in texts:
+        key = translate_key(text, from_lang, to_lang, help)
+        if key in results:
+            continue
+        results[key] = TRANSLATE_CACHE.get(key)
+        if results[key] is None:
+            todo.append(text)
+
+    batch = []
+    size = 0
+    for text in todo + [None]:
+        if batch and (text is None or len(batch) >= TRANSLATE_BATCH_MAX or size + len(text) > TRANSLATE_BATCH_MAX_CHARS):
+            if len(batch) == 1:
+                # a single text needs no markers, translate() makes the only request and caches it
+                results[translate_key(batch[0], from_lang, to_lang, help)] = translate(batch[0], from_lang, to_lang, help)
+            else:
+                for x, translated in zip(batch, translate_packed(batch, from_lang, to_lang, help)):
+                    key = translate_key(x, from_lang, to_lang, help)
+                    if translated:
+                        TRANSLATE_CACHE.set(key, translated)
+                        results[key] = translated
+                    else:
+                        results[key] = translate(x, from_lang, to_lang, help)
+            batch = []
+            size = 0
+        if text is None:
+            break
+        if TRANSLATE_BATCH_MARK_RE.search(text):
+            results[translate_key(text, from_lang, to_lang, help)] = translate(text, from_lang, to_lang, help)
+        else:
+            batch.append(text)
+            size += len(text)
+
+    return [results[translate_key(text, from_lang, to_lang, help)] or '' for text in texts]
+
+
+def translate_packed(texts: list, from_lang: str, to_lang: str, help: str = '') -> list:
+    """
+    Translates the texts with one request, each text is marked with its number.
+
+    Returns:
+        list: The translated texts, '' for the ones missing in the answer.
+    """
+    from_lang_name = language_name(from_lang) if from_lang != 'autodetect' else 'autodetect'
+    to_lang_name = language_name(to_lang)
+    query = f'Translate each numbered fragment from language [{from_lang_name}] to language [{to_lang_name}]'
+    if help:
+        query += f', this can help you to translate better [{help}]'
+    query += '. Put the marker <<<N>>> of each fragment on its own line before its translation, ' \
+             'keep the markers as they are and do not add anything else:\n\n'
+    query += '\n'.join(f'<<<{i}>>>\n{text}' for i, text in enumerate(texts, 1))
+
+    answer = ai(query, temperature=0.1)
+    results = [''] * len(texts)
+    if not answer:
+        return results
+    parts = TRANSLATE_BATCH_MARK_RE.split(answer)
+    # ['text before the first marker', '1', 'translation 1', '2', 'translation 2', ...]
+    seen = set()
+    for n, translated in zip(parts[1::2], parts[2::2]):
+        i = int(n) - 1
+        translated = translated.strip()
+        if 0 <= i < len(texts) and i not in seen and translated:
+            results[i] = translated
+        elif i in seen:
+            results[i] = ''
+        seen.add(i)
+    return results
+
+
+@my_trace.traced('gemini.translate_batched')
+def translate_batched(text: str, from_lang: str = '', to_lang: str = '', help: str = '') -> str:
+    """
+    Translates the text like translate() but waits TRANSLATE_BATCH_WINDOW seconds
+    for other translations with the same languages and help, and translates them
+    all together with translate_batch().
+
+    Returns:
+        str: The translated text.
+    """
+    from_lang, to_lang = from_lang or 'autodetect', to_lang or 'ru'
+    cached = TRANSLATE_CACHE.get(translate_key(text, from_lang, to_lang, help))
+    if cached is not None:
+        return cached
+
+    group = (from_lang, to_lang, help)
+    item = {'text': text, 'done': threading.Event(), 'result': ''}
+    with TRANSLATE_BATCH_LOCK:
+        batch = TRANSLATE_BATCH_QUEUE.setdefault(group, [])
+        batch.append(item)
+        leader = len(batch) == 1
+
+    if not leader:
+        item['done'].wait()
+        return item['result']
+
+    time.sleep(TRANSLATE_BATCH_WINDOW)
+    with TRANSLATE_BATCH_LOCK:
+        batch = TRANSLATE_BATCH_QUEUE.pop(group)
     try:
-        to_lang = langcodes.Language.make(language=to_lang).display_name(language='en')
-    except Exception as error2:
+        for x, translated in zip(batch, translate_batch([x['text'] for x in batch], from_lang, to_lang, help)):
+            x['result'] = translated
+    except Exception as error:
         error_traceback = traceback.format_exc()
-        my_log.log2(f'my_gemini:translate:error2: {error2}\n\n{error_traceback}')
+        my_log.log2(f'my_gemini:translate_batched: {error}\n\n{error_traceback}')
+    finally:
+        for x in batch:
+            x['done'].set()
+    return item['result']
+
+
+def translate_request(text: str, from_lang: str, to_lang: str, help: str = '') -> str:
+    """
+    Asks Gemini to translate the text, see translate().
+    """
+    from_lang = language_name(from_lang) if from_lang != 'autodetect' else 'autodetect'
+    to_lang = language_name(to_lang)
 
     if help:
         query = f'Translate from language [{from_lang}] to language [{to_lang}], this can help you to translate better [{help}]:\n\n{text}'
@@ -389,25 +1737,96 @@ def translate(text: str, from_lang: str = '', to_lang: str = '', help: str = '')
     return translated
 
 
+@functools.lru_cache(maxsize=1000)
+def language_name(lang: str) -> str:
+    """
+    Returns the english name of the language by its code, or the code itself if it is unknown.
+    """
+    try:
+        return langcodes.Language.make(language=lang).display_name(language='en')
+    except Exception as error:
+        error_traceback = traceback.format_exc()
+        my_log.log2(f'my_gemini:language_name: {lang} {error}\n\n{error_traceback}')
+        return lang
+
+
+def normalize_text(text: str) -> str:
+    """
+    Normalizes the text for the cache keys, the spaces at the ends and repeated spaces inside do not matter.
+    """
+    return re.sub(r'[ \t]+', ' ', unicodedata.normalize('NFC', text.strip()))
+
+
 def save_proxy_pool():
+    """
+    Marks the proxy pool as changed, it will be saved to disk by proxy_pool_writer_daemon().
+    """
+    SAVE_EVENT.set()
+
+
+def flush_proxy_pool():
     """
     Saves the proxy pool to disk.
     """
-    global PROXY_POLL_SPEED
     with SAVE_LOCK:
-        s = {}
-        for x in PROXY_POOL:
-            try:
-                s[x] = PROXY_POLL_SPEED[x]
-            except:
-                pass
-        PROXY_POLL_SPEED = s
-        with open(PROXY_POOL_DB_FILE, 'wb') as f:
-            pickle.dump(PROXY_POOL, f)
-        with open(PROXY_POLL_SPEED_DB_FILE, 'wb') as f:
-            pickle.dump(PROXY_POLL_SPEED, f)
-        # with open(PROXY_POOL_REMOVED_DB_FILE, 'wb') as f:
-        #     pickle.dump(PROXY_POOL_REMOVED, f)
+        pool = PROXY_POOL[:]
+        # report_proxy() writes to the same dict, it is cleaned in place
+        with PROXY_STATS_LOCK:
+            for x in set(PROXY_POLL_SPEED) - set(pool):
+                del PROXY_POLL_SPEED[x]
+            s = dict(PROXY_POLL_SPEED)
+        dump_atomic(pool, PROXY_POOL_DB_FILE)
+        dump_atomic(s, PROXY_POLL_SPEED_DB_FILE)
+        # dump_atomic(PROXY_POOL_REMOVED, PROXY_POOL_REMOVED_DB_FILE)
+
+
+def dump_atomic(obj, file_name: str):
+    """
+    Pickles the object to a temporary file and then renames it,
+    so the file is never left half-written. The file keeps its permissions,
+    a new one gets 0644 instead of 0600 of the temporary file.
+
+    Args:
+        obj: The object to save.
+        file_name (str): The file name.
+    """
+    try:
+        mode = os.stat(file_name).st_mode & 0o777
+    except FileNotFoundError:
+        mode = 0o644
+    with tempfile.NamedTemporaryFile('wb', dir=os.path.dirname(file_name) or '.', delete=False) as f:
+        try:
+            pickle.dump(obj, f)
+            f.flush()
+            os.fsync(f.fileno())
+        except:
+            f.close()
+            os.unlink(f.name)
+            raise
+    os.chmod(f.name, mode)
+    os.replace(f.name, file_name)
+
+
+def proxy_pool_writer_daemon():
+    """
+    Saves the proxy pool to disk not more often than once in SAVE_DEBOUNCE seconds.
+    """
+    while 1:
+        SAVE_EVENT.wait()
+        time.sleep(SAVE_DEBOUNCE)
+        SAVE_EVENT.clear()
+        try:
+            flush_proxy_pool()
+        except Exception as error:
+            my_log.log2(f'my_gemini:proxy_pool_writer_daemon: {error}')
+
+
+def flush_proxy_pool_on_exit():
+    """
+    Saves the unsaved changes of the proxy pool when the program exits.
+    """
+    if SAVE_EVENT.is_set():
+        flush_proxy_pool()
 
 
 def remove_proxy(proxy: str):
@@ -433,30 +1852,13 @@ def remove_proxy(proxy: str):
 
     PROXY_POOL_REMOVED.append(proxy)
     PROXY_POOL_REMOVED = list(set(PROXY_POOL_REMOVED))
-    
-    save_proxy_pool()
 
+    drop_session(proxy)
+    remove_proxy_stats(proxy)
+    with PROXY_BREAKERS_LOCK:
+        PROXY_BREAKERS.pop(proxy, None)
 
-def sort_proxies_by_speed(proxies):
-    """
-    Sort proxies by speed.
-
-    Args:
-        proxies (list): The list of proxies to be sorted.
-
-    Returns:
-        list: The sorted list of proxies.
-    """
-    # неопробованные прокси считаем что имеют скорость как было при поиске = 5 секунд(или менее)
-    for x in PROXY_POOL:
-        if x not in PROXY_POLL_SPEED:
-            PROXY_POLL_SPEED[x] = 5
-
-    try:
-        proxies.sort(key=lambda x: PROXY_POLL_SPEED[x])
-    except KeyError as key_error:
-        # my_log.log2(f'sort_proxies_by_speed: {key_error}')
-        pass
+    save_proxy_pool()
 
 
 def test_proxy_for_gemini(proxy: str = '') -> bool:
@@ -506,7 +1908,9 @@ def test_proxy_for_gemini(proxy: str = '') -> bool:
         if answer and answer not in PROXY_POOL_REMOVED:
             if total_time < 5:
                 PROXY_POOL.append(proxy)
-                PROXY_POLL_SPEED[proxy] = total_time
+                with PROXY_STATS_LOCK:
+                    PROXY_POLL_SPEED[proxy] = total_time
+                add_proxy_stats(proxy, total_time)
                 save_proxy_pool()
 
 
@@ -538,26 +1942,178 @@ def get_proxies():
         except Exception as error:
             my_log.log2(f'my_gemini:get_proxies: {error}')
 
-        n = 0
-        maxn = len(proxies)
-        step = POOL_MAX_WORKERS
+        proxies = [x for x in dict.fromkeys(proxies) if x not in PROXY_POOL and x not in PROXY_POOL_REMOVED]
+        print(f'Proxies found: {len(PROXY_POOL)} (candidates {len(proxies)})')
+        asyncio.run(check_proxies(proxies))
+    except Exception as error:
+        my_log.log2(f'my_gemini:get_proxies: {error}')
+
+
+async def check_proxies(proxies: list):
+    """
+    Checks the candidates in stages and adds the good ones to the pool.
+
+    1. handshake - a TCP connection and a CONNECT/SOCKS request to the Gemini host,
+       thousands of candidates at once with asyncio.
+    2. https - a request to the Gemini host through the proxy, a few dozen at once.
+    3. gemini - a real answer from Gemini with test_proxy_for_gemini(), it spends the keys quota.
 
-        while n < maxn:
-            if len(PROXY_POOL) > MAX_PROXY_POOL:
+    Every candidate goes to the next stage as soon as it passes the previous one,
+    the search stops as soon as the pool is full.
+
+    Args:
+        proxies (list): The candidates.
+    """
+    loop = asyncio.get_running_loop()
+    https_executor = concurrent.futures.ThreadPoolExecutor(max_workers=PROXY_CHECK_HTTPS_WORKERS)
+    gemini_executor = concurrent.futures.ThreadPoolExecutor(max_workers=PROXY_CHECK_GEMINI_WORKERS)
+    semaphore = asyncio.Semaphore(proxy_check_concurrency())
+    pool_is_full = asyncio.Event()
+
+    PROXY_CHECK_STATS.clear()
+    for stage in ('handshake', 'https', 'gemini'):
+        PROXY_CHECK_STATS[stage] = {'checked': 0, 'passed': 0}
+    start_time = time.time()
+
+    host = GEMINI_HOST.split('://')[1]
+    try:
+        # socks4 proxies do not resolve names, the same as in requests
+        host_ip = (await loop.getaddrinfo(host, 443, family=socket.AF_INET))[0][4][0]
+    except Exception as error:
+        my_log.log2(f'my_gemini:check_proxies: {error}')
+        host_ip = ''
+
+    def passed(stage: str, ok: bool) -> bool:
+        PROXY_CHECK_STATS[stage]['checked'] += 1
+        if ok:
+            PROXY_CHECK_STATS[stage]['passed'] += 1
+        return ok and not pool_is_full.is_set()
+
+    async def check(proxy: str):
+        for _ in range(PROXY_CHECK_FD_RETRIES):
+            async with semaphore:
+                if pool_is_full.is_set():
+                    return
+                ok = await proxy_handshake(proxy, host, host_ip)
+            if ok is not None:
                 break
-            if len(PROXY_POOL) == 0:
-                step = 500
-            else:
-                step = POOL_MAX_WORKERS
-            chunk = proxies[n:n+step]
-            n += step
-            print(f'Proxies found: {len(PROXY_POOL)} (processing {n} of {maxn})')
-            with concurrent.futures.ThreadPoolExecutor(max_workers=step) as executor:
-                futures = [executor.submit(test_proxy_for_gemini, proxy) for proxy in chunk]
-                for future in futures:
-                    future.result()
+            # out of file descriptors, the proxy is not to blame
+            await asyncio.sleep(PROXY_CHECK_FD_RETRY_DELAY)
+        if not passed('handshake', bool(ok)):
+            return
+        ok = await loop.run_in_executor(https_executor, proxy_https_check, proxy)
+        if not passed('https', ok):
+            return
+        size = len(PROXY_POOL)
+        await loop.run_in_executor(gemini_executor, test_proxy_for_gemini, proxy)
+        passed('gemini', len(PROXY_POOL) > size)
+        if len(PROXY_POOL) > MAX_PROXY_POOL:
+            pool_is_full.set()
+
+    async def report():
+        while 1:
+            await asyncio.sleep(10)
+            seconds = time.time() - start_time
+            rates = ', '.join(f'{stage} {x["checked"]/seconds:.1f}/s passed {x["passed"]}' for stage, x in PROXY_CHECK_STATS.items())
+            print(f'Proxies found: {len(PROXY_POOL)} (candidates {len(proxies)}: {rates})')
+
+    tasks = [asyncio.create_task(check(x)) for x in proxies]
+    reporter = asyncio.create_task(report())
+    waiter = asyncio.create_task(pool_is_full.wait())
+    try:
+        await asyncio.wait([asyncio.gather(*tasks, return_exceptions=True), waiter], return_when=asyncio.FIRST_COMPLETED)
+    finally:
+        for task in tasks + [reporter, waiter]:
+            task.cancel()
+        # the requests that are already running can not be stopped, they just finish in background
+        https_executor.shutdown(wait=False, cancel_futures=True)
+        gemini_executor.shutdown(wait=False, cancel_futures=True)
+    my_log.log2(f'my_gemini:check_proxies: {len(proxies)} candidates in {time.time() - start_time:.0f}s {PROXY_CHECK_STATS}')
+
+
+def proxy_check_concurrency() -> int:
+    """
+    Returns how many handshakes can run at once, PROXY_CHECK_CONCURRENCY
+    limited by the soft limit of open files (ulimit -n, 1024 for a systemd service by default).
+    """
+    if resource is None:
+        return PROXY_CHECK_CONCURRENCY
+    try:
+        soft_limit = resource.getrlimit(resource.RLIMIT_NOFILE)[0]
     except Exception as error:
-        my_log.log2(f'my_gemini:get_proxies: {error}')
+        my_log.log2(f'my_gemini:proxy_check_concurrency: {error}')
+        return PROXY_CHECK_CONCURRENCY
+    if soft_limit == resource.RLIM_INFINITY:
+        return PROXY_CHECK_CONCURRENCY
+    return max(1, min(PROXY_CHECK_CONCURRENCY, soft_limit - PROXY_CHECK_FD_RESERVE))
+
+
+async def proxy_handshake(proxy: str, host: str, host_ip: str = ''):
+    """
+    Checks that the proxy accepts connections and agrees to connect to the host.
+
+    Args:
+        proxy (str): The proxy, http://, socks4:// or socks5(h)://.
+        host (str): The host to connect to through the proxy, port 443.
+        host_ip (str, optional): The IPv4 address of the host for socks4 proxies.
+
+    Returns:
+        bool: True if the proxy has connected to the host,
+              None if there were no free file descriptors and the check has to be repeated.
+    """
+    try:
+        scheme, address = proxy.split('://', maxsplit=1)
+        proxy_host, proxy_port = address.rsplit(':', maxsplit=1)
+        reader, writer = await asyncio.wait_for(asyncio.open_connection(proxy_host, int(proxy_port)), PROXY_CHECK_TIMEOUT)
+    except OSError as error:
+        if error.errno in (errno.EMFILE, errno.ENFILE):
+            return None
+        return False
+    except Exception:
+        return False
+
+    port = (443).to_bytes(2, 'big')
+    try:
+        if scheme.startswith('http'):
+            writer.write(f'CONNECT {host}:443 HTTP/1.1\r\nHost: {host}:443\r\n\r\n'.encode())
+            answer = await asyncio.wait_for(reader.readline(), PROXY_CHECK_TIMEOUT)
+            return answer.split(b' ')[1:2] == [b'200']
+        elif scheme.startswith('socks5'):
+            writer.write(b'\x05\x01\x00')
+            if await asyncio.wait_for(reader.readexactly(2), PROXY_CHECK_TIMEOUT) != b'\x05\x00':
+                return False
+            writer.write(b'\x05\x01\x00\x03' + bytes([len(host)]) + host.encode() + port)
+            answer = await asyncio.wait_for(reader.readexactly(2), PROXY_CHECK_TIMEOUT)
+            return answer == b'\x05\x00'
+        elif scheme == 'socks4' and host_ip:
+            writer.write(b'\x04\x01' + port + socket.inet_aton(host_ip) + b'\x00')
+            answer = await asyncio.wait_for(reader.readexactly(8), PROXY_CHECK_TIMEOUT)
+            return answer[1] == 0x5a
+        return False
+    except Exception:
+        return False
+    finally:
+        writer.close()
+
+
+def proxy_https_check(proxy: str) -> bool:
+    """
+    Checks that the Gemini host answers through the proxy (any http answer is ok).
+
+    Args:
+        proxy (str): The proxy.
+
+    Returns:
+        bool: True if there was an answer.
+    """
+    session = new_session(proxy, pool_size=1)
+    try:
+        session.head(GEMINI_HOST, timeout=PROXY_CHECK_HTTPS_TIMEOUT)
+        return True
+    except Exception:
+        return False
+    finally:
+        session.close()
 
 
 def update_proxy_pool_daemon():
@@ -628,12 +2184,22 @@ def run_proxy_pool_daemon():
             #     PROXY_POOL_REMOVED = pickle.load(f)
         except:
             pass
-        thread = threading.Thread(target=update_proxy_pool_daemon)
+        thread = threading.Thread(target=update_proxy_pool_daemon, daemon=True)
         thread.start()
         # Waiting until at least 1 proxy is found
         # while len(PROXY_POOL) < 1:
         #     time.sleep(1)
 
+    for proxy in PROXY_POOL[:]:
+        add_proxy_stats(proxy, PROXY_POLL_SPEED.get(proxy, PROXY_DEFAULT_LATENCY))
+
+    thread = threading.Thread(target=sessions_daemon, daemon=True)
+    thread.start()
+
+    thread = threading.Thread(target=proxy_pool_writer_daemon, daemon=True)
+    thread.start()
+    atexit.register(flush_proxy_pool_on_exit)
+
 
 def chat_cli():
     """
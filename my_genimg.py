@@ -13,10 +13,15 @@ import requests
 import cfg
 import my_gemini
 import my_log
+import my_metrics
+import my_trace
 
 
 DEBUG = False
 
+METRIC_REQUESTS = my_metrics.counter('hf_requests_total', 'Hugging Face image requests', ('model', 'result'))
+METRIC_SECONDS = my_metrics.histogram('hf_request_seconds', 'Time of the Hugging Face image requests', ('model', ))
+
 
 def translate_prompt_to_en(prompt: str) -> str:
     """
@@ -30,7 +35,7 @@ def translate_prompt_to_en(prompt: str) -> str:
     """
     detected_lang = langdetect.detect(prompt)
     if detected_lang != 'en':
-        prompt_translated = my_gemini.translate(prompt, to_lang='en', help='This is a prompt for image generation. Users can write it in their own language, but only English is supported.')
+        prompt_translated = my_gemini.translate_batched(prompt, to_lang='en', help='This is a prompt for image generation. Users can write it in their own language, but only English is supported.')
         if prompt_translated:
             prompt = prompt_translated
     return prompt
@@ -52,6 +57,7 @@ def rewrite_prompt_for_open_dalle(prompt: str) -> str:
     return translate_prompt_to_en(prompt_translated)
 
 
+@my_trace.traced('hf.generate')
 def huggin_face_api(prompt: str) -> bytes:
     """
     Calls the Hugging Face API to generate text based on a given prompt.
@@ -91,18 +97,23 @@ def huggin_face_api(prompt: str) -> bytes:
                 proxy = None
             api_key = random.choice(cfg.huggin_face_api)
             headers = {"Authorization": f"Bearer {api_key}"}
+            model = url.split('/models/')[-1]
 
             try:
-                response = requests.post(url, headers=headers, json=p, timeout=120, proxies=proxy)
+                with METRIC_SECONDS.time(model=model), my_trace.span('hf.request', model=model):
+                    response = requests.post(url, headers=headers, json=p, timeout=120, proxies=proxy)
             except Exception as error:
+                METRIC_REQUESTS.inc(model=model, result='error')
                 my_log.log2(f'my_genimg:huggin_face_api: {error}\nPrompt: {prompt}\nAPI key: {api_key}\nProxy: {proxy}\nURL: {url}')
                 continue
 
             resp_text = str(response.content)[:300]
             # print(resp_text[:60])
             if 'read timeout=' in resp_text: # и так долго ждали
+                METRIC_REQUESTS.inc(model=model, result='timeout')
                 return []
             if response.content and '{"error"' not in resp_text:
+                METRIC_REQUESTS.inc(model=model, result='ok')
                 result.append(response.content)
                 return result
 
@@ -110,15 +121,18 @@ def huggin_face_api(prompt: str) -> bytes:
                 '"error":"Internal Server Error"' in str(resp_text) or \
                 '"CUDA out of memory' in str(resp_text) or \
                 '"error":"Service Unavailable"' in str(resp_text):
+                METRIC_REQUESTS.inc(model=model, result='busy')
                 if DEBUG:
                     my_log.log2(f'my_genimg:huggin_face_api: {resp_text} | {proxy} | {url}')
             else: # unknown error
+                METRIC_REQUESTS.inc(model=model, result='failed')
                 my_log.log2(f'my_genimg:huggin_face_api: {resp_text} | {proxy} | {url}')
             time.sleep(10)
 
         return result
 
     pool = ThreadPool(processes=6)
+    request_img = my_trace.bind(request_img)
     async_result1 = pool.apply_async(request_img, (prompt, API_URL[6], payload,))
     async_result2 = pool.apply_async(request_img, (prompt, API_URL[6], payload,))
     async_result3 = pool.apply_async(request_img, (prompt, API_URL[3], payload,))
@@ -0,0 +1,373 @@
+#!/usr/bin/env python3
+
+
+import collections
+import os
+import re
+import sqlite3
+import sys
+import threading
+
+import my_log
+import my_metrics
+import my_retrieval
+
+
+# Chat histories, one row per message
+HISTORY_DB_FILE = 'db/gemini_history.db'
+# the old storage with the whole history of a chat pickled in one value
+OLD_CHATS_DB_FILE = 'db/gemini_chats.db'
+CON = None
+LOCK = threading.Lock()
+# read no more than so many last messages of a chat
+MAX_TAIL = 500
+
+# Hot chats are kept in memory, least recently used are evicted {chat_id:ChatMemory}
+CACHE = collections.OrderedDict()
+CACHE_MAX_CHATS = 1000
+# total length of the cached texts, characters
+CACHE_MAX_CHARS = 50000000
+CACHE_CHARS = 0
+# {chat_id:chars} as accounted in CACHE_CHARS
+CACHE_SIZES = {}
+CACHE_STATS = {'hits': 0, 'misses': 0, 'evictions': 0}
+CACHE_LOCK = threading.Lock()
+my_metrics.gauge('history_cache_chats', 'Chats in the history cache', func=lambda: len(CACHE))
+my_metrics.gauge('history_cache_chars', 'Characters in the history cache', func=lambda: CACHE_CHARS)
+my_metrics.counter('history_cache_events_total', 'History cache hits, misses and evictions', ('event', ), func=lambda: CACHE_STATS)
+
+# Offline estimate of the number of tokens, characters per token for each model
+# ascii - english and code, cjk - chinese, japanese, korean, other - cyrillic, greek etc
+CHARS_PER_TOKEN = {
+    'gemini-pro': {'ascii': 4.0, 'cjk': 1.0, 'other': 2.5},
+}
+
+CJK_RE = re.compile('[\u2e80-\u9fff\uac00-\ud7af\uf900-\ufaff\U00020000-\U0003ffff]')
+
+
+def estimate_tokens(text: str, model: str = 'gemini-pro') -> int:
+    """
+    Estimates the number of tokens in the text without a tokenizer.
+    The estimate is rather high than low, so the history never exceeds the model limit.
+
+    Args:
+        text (str): The text.
+        model (str, optional): The model. Defaults to 'gemini-pro'.
+
+    Returns:
+        int: The estimated number of tokens.
+    """
+    ratio = CHARS_PER_TOKEN.get(model) or CHARS_PER_TOKEN['gemini-pro']
+    ascii_chars = len(text.encode('ascii', 'ignore'))
+    cjk_chars = len(CJK_RE.findall(text)) if ascii_chars < len(text) else 0
+    other_chars = len(text) - ascii_chars - cjk_chars
+    return int(ascii_chars / ratio['ascii'] + cjk_chars / ratio['cjk'] + other_chars / ratio['other']) + 1
+
+
+class ChatMemory:
+    """
+    Chat history that keeps its running size, so adding a turn and
+    dropping the oldest ones does not recount the whole history.
+
+    Messages are in the Gemini format {"role": "user", "parts": [{"text": "..."}]}.
+    """
+    def __init__(self, mem: list = None, cost = len, first_seq: int = 0):
+        """
+        Args:
+            mem (list, optional): The messages to start with.
+            cost (optional): The function that returns the size of a text, len() or estimate_tokens().
+            first_seq (int, optional): The number of the first message in the store.
+        """
+        self.cost = cost
+        self.messages = collections.deque()
+        self.costs = collections.deque()
+        self.size = 0
+        # length of all texts in characters, for the cache limits
+        self.chars = 0
+        # numbers of the first message and of the next one in the store
+        self.first_seq = first_seq
+        self.next_seq = first_seq
+        # search index of the question-answer pairs {seq of the question:text}, built on demand
+        self.index = None
+        for x in mem or []:
+            self.append(x)
+
+    def append(self, message: dict):
+        text = message['parts'][0]['text']
+        cost = self.cost(text)
+        self.messages.append(message)
+        self.costs.append(cost)
+        self.size += cost
+        self.chars += len(text)
+        self.next_seq += 1
+        if self.index is not None and message['role'] == 'model' and len(self.messages) > 1:
+            self.index.add(self.next_seq - 2, self.messages[-2]['parts'][0]['text'] + '\n' + text)
+
+    def add_turn(self, query: str, resp: str):
+        self.append({"role": "user", "parts": [{"text": query}]})
+        self.append({"role": "model", "parts": [{"text": resp}]})
+
+    def trim(self, budget: int) -> int:
+        """
+        Drops the oldest question-answer pairs until the history fits the budget.
+
+        Returns:
+            int: The number of dropped messages.
+        """
+        dropped = 0
+        while self.size > budget and self.messages:
+            for _ in range(min(2, len(self.messages))):
+                message = self.messages.popleft()
+                self.size -= self.costs.popleft()
+                self.chars -= len(message['parts'][0]['text'])
+                if self.index is not None:
+                    self.index.remove(self.first_seq)
+                self.first_seq += 1
+                dropped += 1
+        return dropped
+
+    def compact(self, n: int, summary: list):
+        """
+        Replaces the oldest n messages with the summary of them.
+        The summary takes the last numbers of the replaced messages in the store.
+
+        Args:
+            n (int): The number of the replaced messages, not less than len(summary).
+            summary (list): The messages of the summary.
+        """
+        for i in range(n):
+            message = self.messages.popleft()
+            self.size -= self.costs.popleft()
+            self.chars -= len(message['parts'][0]['text'])
+            if self.index is not None:
+                self.index.remove(self.first_seq + i)
+        self.first_seq += n - len(summary)
+        for message in reversed(summary):
+            text = message['parts'][0]['text']
+            cost = self.cost(text)
+            self.messages.appendleft(message)
+            self.costs.appendleft(cost)
+            self.size += cost
+            self.chars += len(text)
+        if self.index is not None:
+            self.index_turns(self.first_seq, len(summary))
+
+    def enable_index(self) -> my_retrieval.BM25Index:
+        """
+        Builds the search index of the question-answer pairs if there is none yet,
+        then it is kept up to date with the history.
+        """
+        if self.index is None:
+            self.index = my_retrieval.BM25Index()
+            self.index_turns(self.first_seq, len(self.messages))
+        return self.index
+
+    def index_turns(self, seq: int, n: int):
+        """
+        Adds to the index the pairs among n messages starting with the number seq.
+        """
+        for i in range(seq - self.first_seq, seq - self.first_seq + n - 1):
+            if self.messages[i]['role'] == 'user' and self.messages[i + 1]['role'] == 'model':
+                self.index.add(self.first_seq + i, self.messages[i]['parts'][0]['text'] + '\n' +
+                               self.messages[i + 1]['parts'][0]['text'])
+
+    def to_list(self) -> list:
+        return list(self.messages)
+
+    def __len__(self) -> int:
+        return len(self.messages)
+
+    def __iter__(self):
+        return iter(self.messages)
+
+
+def get_history(chat_id: str, cost = len) -> ChatMemory:
+    """
+    Returns the history of the chat from the cache or reads it from the store.
+
+    The returned object is shared, it must be changed only under the lock of the chat
+    and then saved with save() and put back with cache_put().
+
+    Args:
+        chat_id (str): The chat.
+        cost (optional): The function that returns the size of a text.
+
+    Returns:
+        ChatMemory: The history.
+    """
+    with CACHE_LOCK:
+        history = CACHE.get(chat_id)
+        if history is not None:
+            CACHE.move_to_end(chat_id)
+            CACHE_STATS['hits'] += 1
+            return history
+        CACHE_STATS['misses'] += 1
+    first_seq, mem = get_tail(chat_id)
+    return cache_put(chat_id, ChatMemory(mem, cost, first_seq), replace=False)
+
+
+def cache_put(chat_id: str, history: ChatMemory, replace: bool = True) -> ChatMemory:
+    """
+    Puts the history of the chat to the cache and evicts the least recently used chats
+    if the cache is over CACHE_MAX_CHATS or CACHE_MAX_CHARS.
+
+    Args:
+        chat_id (str): The chat.
+        history (ChatMemory): The history.
+        replace (bool, optional): Replace the cached history if there is one. Defaults to True.
+
+    Returns:
+        ChatMemory: The cached history.
+    """
+    global CACHE_CHARS
+    with CACHE_LOCK:
+        if chat_id in CACHE and not replace:
+            return CACHE[chat_id]
+        CACHE_CHARS -= CACHE_SIZES.get(chat_id, 0)
+        CACHE[chat_id] = history
+        CACHE.move_to_end(chat_id)
+        CACHE_SIZES[chat_id] = history.chars
+        CACHE_CHARS += history.chars
+        while len(CACHE) > 1 and (len(CACHE) > CACHE_MAX_CHATS or CACHE_CHARS > CACHE_MAX_CHARS):
+            old_chat_id, _ = CACHE.popitem(last=False)
+            CACHE_CHARS -= CACHE_SIZES.pop(old_chat_id)
+            CACHE_STATS['evictions'] += 1
+    return history
+
+
+def cache_drop(chat_id: str):
+    """
+    Removes the chat from the cache.
+    """
+    global CACHE_CHARS
+    with CACHE_LOCK:
+        if CACHE.pop(chat_id, None) is not None:
+            CACHE_CHARS -= CACHE_SIZES.pop(chat_id)
+
+
+def is_cached(chat_id: str) -> bool:
+    return chat_id in CACHE
+
+
+def get_tail(chat_id: str, limit: int = MAX_TAIL) -> tuple:
+    """
+    Reads the last messages of the chat.
+
+    Args:
+        chat_id (str): The chat.
+        limit (int, optional): The maximum number of messages. Defaults to MAX_TAIL.
+
+    Returns:
+        tuple: The number of the first returned message and the list of messages.
+    """
+    with LOCK:
+        rows = CON.execute('SELECT seq, role, text FROM messages WHERE chat_id = ? ORDER BY seq DESC LIMIT ?',
+                           (chat_id, limit)).fetchall()
+    rows.reverse()
+    # the history must start with a question
+    if rows and rows[0][1] != 'user':
+        rows = rows[1:]
+    if not rows:
+        return next_seq(chat_id), []
+    return rows[0][0], [{"role": role, "parts": [{"text": text}]} for _, role, text in rows]
+
+
+def next_seq(chat_id: str) -> int:
+    """
+    Returns the number for the next message of the chat.
+    """
+    with LOCK:
+        row = CON.execute('SELECT MAX(seq) FROM messages WHERE chat_id = ?', (chat_id,)).fetchone()
+    return 0 if row[0] is None else row[0] + 1
+
+
+def save(chat_id: str, seq: int, messages: list, first_seq: int = None):
+    """
+    Appends the new messages of the chat and deletes the old ones in one transaction.
+
+    Args:
+        chat_id (str): The chat.
+        seq (int): The number of the first new message.
+        messages (list): The new messages.
+        first_seq (int, optional): Delete the messages with numbers before it.
+    """
+    rows = [(chat_id, seq + i, x['role'], x['parts'][0]['text']) for i, x in enumerate(messages)]
+    with LOCK, CON:
+        CON.executemany('INSERT OR REPLACE INTO messages (chat_id, seq, role, text) VALUES (?, ?, ?, ?)', rows)
+        if first_seq is not None:
+            CON.execute('DELETE FROM messages WHERE chat_id = ? AND seq < ?', (chat_id, first_seq))
+
+
+def reset(chat_id: str):
+    """
+    Deletes the history of the chat.
+    """
+    cache_drop(chat_id)
+    with LOCK, CON:
+        CON.execute('DELETE FROM messages WHERE chat_id = ?', (chat_id,))
+
+
+def migrate_from_sqlitedict(file_name: str = OLD_CHATS_DB_FILE) -> int:
+    """
+    Copies the chats from the old SqliteDict storage {chat_id:list(mem)}.
+    Does nothing if the file does not exist or was already migrated.
+
+    Args:
+        file_name (str, optional): The old database. Defaults to OLD_CHATS_DB_FILE.
+
+    Returns:
+        int: The number of migrated chats.
+    """
+    if not os.path.exists(file_name):
+        return 0
+    with LOCK:
+        if CON.execute('SELECT 1 FROM meta WHERE key = ?', (f'migrated:{file_name}',)).fetchone():
+            return 0
+
+    from sqlitedict import SqliteDict
+
+    n = 0
+    with SqliteDict(file_name, flag='r') as chats:
+        for chat_id, mem in chats.items():
+            try:
+                with LOCK:
+                    exists = CON.execute('SELECT 1 FROM messages WHERE chat_id = ? LIMIT 1', (chat_id,)).fetchone()
+                if not exists and mem:
+                    save(chat_id, 0, mem)
+                    n += 1
+            except Exception as error:
+                my_log.log2(f'my_history:migrate_from_sqlitedict: {chat_id} {error}')
+    with LOCK, CON:
+        CON.execute('INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)', (f'migrated:{file_name}', str(n)))
+    return n
+
+
+def init():
+    """
+    Opens the database and creates the tables.
+    """
+    global CON
+    CON = sqlite3.connect(HISTORY_DB_FILE, check_same_thread=False)
+    with LOCK, CON:
+        CON.execute('PRAGMA journal_mode=WAL')
+        CON.execute('PRAGMA synchronous=NORMAL')
+        CON.execute("""CREATE TABLE IF NOT EXISTS messages (
+                        chat_id TEXT NOT NULL,
+                        seq INTEGER NOT NULL,
+                        role TEXT NOT NULL,
+                        text TEXT NOT NULL,
+                        PRIMARY KEY (chat_id, seq)
+                    ) WITHOUT ROWID""")
+        CON.execute('CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)')
+
+
+init()
+
+
+if __name__ == '__main__':
+    # ./my_history.py migrate [db/gemini_chats.db]
+    if sys.argv[1:2] == ['migrate']:
+        file_name = sys.argv[2] if len(sys.argv) > 2 else OLD_CHATS_DB_FILE
+        print(f'Migrated {migrate_from_sqlitedict(file_name)} chats from {file_name}')
+    else:
+        print(estimate_tokens('Hello, how are you?'), estimate_tokens('Привет, как дела?'), estimate_tokens('你好吗'))
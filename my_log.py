@@ -1,43 +1,210 @@
 #!/usr/bin/env python3
+# The log records are put into a queue and written by a background thread,
+# so the threads that log never wait for the disk.
 
 
+import atexit
 import datetime
-import threading
+import json
 import os
+import queue
+import sys
+import threading
+
+
+LOG_FILE = 'logs/debug.log'
+LOG_FILE_REMOVE_PROXY = 'logs/debug_why_remove_proxy.log'
+# Structured records, one json per line
+LOG_FILE_JSON = 'logs/events.jsonl'
+
+# The file is renamed to file.1 when it is bigger than this, file.1 to file.2 and so on
+LOG_MAX_SIZE = 10000000
+LOG_BACKUPS = 3
 
+LEVELS = {'debug': 10, 'info': 20, 'warning': 30, 'error': 40}
+# Structured records below this level are not written
+LOG_LEVEL = 'info'
 
-lock = threading.Lock()
+# The records are dropped instead of blocking the caller if the writer is that far behind
+QUEUE_MAX_SIZE = 100000
+# How many records are written at once
+BATCH_SIZE = 1000
+
+QUEUE = queue.Queue(maxsize=QUEUE_MAX_SIZE)
+# Records that did not fit the queue since the last report, changed under WRITER_LOCK
+DROPPED = 0
+
+WRITER = None
+WRITER_LOCK = threading.Lock()
 
 
 def log2(text: str) -> None:
-    global lock
-    with lock:
-        time_now = datetime.datetime.now().strftime('%d-%m-%Y %H:%M:%S')
-        log_file_path = 'logs/debug.log'
-        # if no log file then create one
-        if not os.path.exists(log_file_path):
-            open(log_file_path, 'w', encoding="utf-8").write('NEW LOG FILE\n\n')
-        # if log file too big then create new one
-        if os.path.getsize(log_file_path) > 10000000:
-            open(log_file_path, 'w', encoding="utf-8").write(f'{time_now}\n\n{text}\n{"=" * 80}\n')
-        else:
-            open(log_file_path, 'a', encoding="utf-8").write(f'{time_now}\n\n{text}\n{"=" * 80}\n')
+    write(LOG_FILE, format_text(text))
 
 
 def log3(text: str) -> None:
-    global lock
-    with lock:
-        time_now = datetime.datetime.now().strftime('%d-%m-%Y %H:%M:%S')
-        log_file_path = 'logs/debug_why_remove_proxy.log'
-        if not os.path.exists(log_file_path):
-            open(log_file_path, 'w', encoding="utf-8").write('NEW LOG FILE\n\n')
-        # if log file too big then create new one
-        if os.path.getsize(log_file_path) > 10000000:
-            open(log_file_path, 'w', encoding="utf-8").write(f'{time_now}\n\n{text}\n{"=" * 80}\n')
+    write(LOG_FILE_REMOVE_PROXY, format_text(text))
+
+
+def log_json(event: str, level: str = 'info', **fields) -> None:
+    """
+    Writes a structured record to LOG_FILE_JSON.
+
+    Args:
+        event (str): What happened, 'module:event'.
+        level (str, optional): 'debug', 'info', 'warning' or 'error'. Defaults to 'info'.
+        **fields: The data of the record, values that are not json types are written as str.
+    """
+    if LEVELS.get(level, 0) < LEVELS[LOG_LEVEL]:
+        return
+    record = {'time': datetime.datetime.now().isoformat(timespec='milliseconds'), 'level': level, 'event': event}
+    record.update(fields)
+    write(LOG_FILE_JSON, json.dumps(record, ensure_ascii=False, default=str) + '\n')
+
+
+def format_text(text: str) -> str:
+    time_now = datetime.datetime.now().strftime('%d-%m-%Y %H:%M:%S')
+    return f'{time_now}\n\n{text}\n{"=" * 80}\n'
+
+
+def write(file_name: str, data: str) -> None:
+    """
+    Puts the text to the queue of the writer, it is appended to the file as is.
+
+    Args:
+        file_name (str): The file.
+        data (str): The text with its line ends.
+    """
+    global DROPPED
+    if WRITER is None:
+        start_writer()
+    try:
+        QUEUE.put_nowait((file_name, data))
+    except queue.Full:
+        with WRITER_LOCK:
+            DROPPED += 1
+
+
+def start_writer():
+    global WRITER
+    with WRITER_LOCK:
+        if WRITER is None:
+            WRITER = threading.Thread(target=writer_daemon, daemon=True)
+            WRITER.start()
+
+
+class LogFile:
+    """The open file, its size in bytes is counted to rotate it without asking the os."""
+    def __init__(self, file_name: str):
+        self.file_name = file_name
+        self.file = None
+        self.size = 0
+
+    def open(self):
+        is_new = not os.path.exists(self.file_name)
+        self.file = open(self.file_name, 'a', encoding='utf-8')
+        self.size = self.file.tell()
+        if is_new and not self.file_name.endswith('.jsonl'):
+            self.write('NEW LOG FILE\n\n')
+
+    def write(self, data: str):
+        if self.file is None:
+            self.open()
+        elif self.size > LOG_MAX_SIZE:
+            self.rotate()
+        self.file.write(data)
+        # bytes, not characters, the logs are mostly not ascii
+        self.size += len(data.encode('utf-8'))
+
+    def rotate(self):
+        self.close()
+        for i in range(LOG_BACKUPS - 1, 0, -1):
+            if os.path.exists(f'{self.file_name}.{i}'):
+                os.replace(f'{self.file_name}.{i}', f'{self.file_name}.{i + 1}')
+        if LOG_BACKUPS:
+            os.replace(self.file_name, f'{self.file_name}.1')
         else:
-            open(log_file_path, 'a', encoding="utf-8").write(f'{time_now}\n\n{text}\n{"=" * 80}\n')
+            os.remove(self.file_name)
+        self.open()
+
+    def flush(self):
+        if self.file is not None:
+            self.file.flush()
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+
+def writer_daemon():
+    """
+    Writes the records from the queue in batches, the files are kept open.
+    An event in the queue is set when everything before it is written.
+    """
+    global DROPPED
+    files = {}
+    while 1:
+        batch = [QUEUE.get()]
+        while len(batch) < BATCH_SIZE:
+            try:
+                batch.append(QUEUE.get_nowait())
+            except queue.Empty:
+                break
+        with WRITER_LOCK:
+            dropped, DROPPED = DROPPED, 0
+        if dropped:
+            batch.append((LOG_FILE, format_text(f'my_log: {dropped} records were dropped, the queue was full')))
+
+        events = []
+        touched = set()
+        for item in batch:
+            if isinstance(item, threading.Event):
+                events.append(item)
+                continue
+            file_name, data = item
+            log_file = files.get(file_name)
+            if log_file is None:
+                log_file = files[file_name] = LogFile(file_name)
+            try:
+                log_file.write(data)
+                touched.add(log_file)
+            except Exception as error:
+                # nowhere to log it
+                print(f'my_log:writer_daemon: {file_name} {error}', file=sys.stderr)
+                log_file.close()
+        for log_file in touched:
+            try:
+                log_file.flush()
+            except Exception as error:
+                print(f'my_log:writer_daemon: {log_file.file_name} {error}', file=sys.stderr)
+
+        for event in events:
+            event.set()
+
+
+def flush(timeout: float = 5) -> None:
+    """
+    Waits until the records that are in the queue now are written.
+
+    Args:
+        timeout (float, optional): The maximum time to wait, seconds. Defaults to 5.
+    """
+    if WRITER is None:
+        return
+    done = threading.Event()
+    try:
+        QUEUE.put(done, timeout=timeout)
+    except queue.Full:
+        return
+    done.wait(timeout)
+
 
+# after the atexit handlers of the other modules, they can log on exit too
+atexit.register(flush)
 
 
 if __name__ == '__main__':
     log2('test')
+    log_json('my_log:test', level='warning', n=1)
+    flush()
@@ -0,0 +1,290 @@
+#!/usr/bin/env python3
+# Metrics of the bot: counters, gauges and histograms,
+# exported in the Prometheus text format on a local http endpoint and as a text for /stats.
+
+
+import http.server
+import re
+import threading
+import time
+
+import my_log
+
+
+# {name:Metric}
+REGISTRY = {}
+LOCK = threading.Lock()
+
+# Latency buckets in seconds, from fast local calls to the slow free proxies
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60, 120)
+
+SERVER = None
+
+
+class Metric:
+    """
+    Base of the metrics, the values are kept for every combination of the labels
+    or are read from func() when exported.
+    """
+    kind = ''
+
+    def __init__(self, name: str, help: str, labels: tuple = (), func = None):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        # {label values:value}
+        self.values = {}
+        self.lock = threading.Lock()
+        self.func = func
+
+    def key(self, labels: dict) -> tuple:
+        return tuple(str(labels.get(x, '')) for x in self.labels)
+
+    def remove(self, **labels):
+        """Forgets the values of all combinations of the labels that have these values, for the things that are gone."""
+        match = [(self.labels.index(k), str(v)) for k, v in labels.items()]
+        with self.lock:
+            for key in [k for k in self.values if all(k[i] == v for i, v in match)]:
+                del self.values[key]
+
+    def samples(self) -> list:
+        """Returns [(name suffix, {label:value}, value), ]."""
+        if self.func is None:
+            with self.lock:
+                return [('', dict(zip(self.labels, k)), v) for k, v in self.values.items()]
+        try:
+            value = self.func()
+        except Exception as error:
+            my_log.log2(f'my_metrics:Metric:{self.name}: {error}')
+            return []
+        # the function returns a number or {label value:number} for the first label
+        if isinstance(value, dict):
+            return [('', {self.labels[0]: k}, v) for k, v in list(value.items())]
+        return [('', {}, value)]
+
+
+class Counter(Metric):
+    """A value that only grows, func() must return a growing value too."""
+    kind = 'counter'
+
+    def inc(self, amount: float = 1, **labels):
+        key = self.key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    """A value that goes up and down."""
+    kind = 'gauge'
+
+    def set(self, value: float, **labels):
+        with self.lock:
+            self.values[self.key(labels)] = value
+
+    def inc(self, amount: float = 1, **labels):
+        key = self.key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def dec(self, amount: float = 1, **labels):
+        self.inc(-amount, **labels)
+
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, name: str, help: str, labels: tuple = (), buckets: tuple = LATENCY_BUCKETS):
+        super().__init__(name, help, labels)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value: float, **labels):
+        key = self.key(labels)
+        with self.lock:
+            counts = self.values.get(key)
+            if counts is None:
+                # [count for every bucket, +Inf, sum]
+                counts = self.values[key] = [0] * (len(self.buckets) + 1) + [0.0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+                    break
+            else:
+                counts[len(self.buckets)] += 1
+            counts[-1] += value
+
+    def time(self, **labels):
+        """Context manager that observes the time of its block."""
+        return Timer(self, labels)
+
+    def samples(self) -> list:
+        result = []
+        with self.lock:
+            items = [(k, v[:]) for k, v in self.values.items()]
+        for k, counts in items:
+            labels = dict(zip(self.labels, k))
+            total = 0
+            for bound, n in zip(self.buckets + ('+Inf', ), counts):
+                total += n
+                result.append(('_bucket', dict(labels, le=str(bound)), total))
+            result.append(('_sum', labels, counts[-1]))
+            result.append(('_count', labels, total))
+        return result
+
+    def quantile(self, q: float, **labels) -> float:
+        """Returns the upper bound of the bucket with the q quantile, 0 if there is no data."""
+        with self.lock:
+            counts = self.values.get(self.key(labels))
+            counts = counts[:] if counts else None
+        if not counts:
+            return 0
+        total = sum(counts[:-1])
+        n = 0
+        for bound, count in zip(self.buckets + (float('inf'), ), counts):
+            n += count
+            if n >= q * total:
+                return bound
+        return float('inf')
+
+
+class Timer:
+    def __init__(self, histogram: Histogram, labels: dict):
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self):
+        self.start_time = time.time()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.histogram.observe(time.time() - self.start_time, **self.labels)
+
+
+def register(cls, name: str, *args, **kwargs) -> Metric:
+    """
+    Returns the metric with the name, creates it if there is none.
+    """
+    with LOCK:
+        if name not in REGISTRY:
+            REGISTRY[name] = cls(name, *args, **kwargs)
+        return REGISTRY[name]
+
+
+def counter(name: str, help: str, labels: tuple = (), func = None) -> Counter:
+    return register(Counter, name, help, labels, func)
+
+
+def gauge(name: str, help: str, labels: tuple = (), func = None) -> Gauge:
+    return register(Gauge, name, help, labels, func)
+
+
+def histogram(name: str, help: str, labels: tuple = (), buckets: tuple = LATENCY_BUCKETS) -> Histogram:
+    return register(Histogram, name, help, labels, buckets)
+
+
+def key_label(key: str) -> str:
+    """
+    Returns the label of an api key, only its last characters, the keys must not leak to the metrics.
+    """
+    return f'...{key[-4:]}' if key else ''
+
+
+def proxy_label(proxy: str) -> str:
+    """
+    Returns the label of a proxy without the user name and the password.
+    """
+    return re.sub(r'//[^/@]*@', '//', proxy) if proxy else 'direct'
+
+
+def escape(value: str) -> str:
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def render() -> str:
+    """
+    Returns all metrics in the Prometheus text format.
+    """
+    with LOCK:
+        metrics = list(REGISTRY.values())
+    lines = []
+    for metric in metrics:
+        lines.append(f'# HELP {metric.name} {metric.help}')
+        lines.append(f'# TYPE {metric.name} {metric.kind}')
+        for suffix, labels, value in metric.samples():
+            labels = ','.join(f'{k}="{escape(v)}"' for k, v in labels.items())
+            lines.append(f'{metric.name}{suffix}{{{labels}}} {value}' if labels else f'{metric.name}{suffix} {value}')
+    return '\n'.join(lines) + '\n'
+
+
+def summary() -> str:
+    """
+    Returns a short human readable text with the metrics for the admins.
+    Counters and gauges are summed up over their labels, histograms show count, average, p50 and p95.
+    """
+    with LOCK:
+        metrics = list(REGISTRY.values())
+    lines = []
+    for metric in metrics:
+        if isinstance(metric, Histogram):
+            with metric.lock:
+                keys = list(metric.values)
+            for key in keys:
+                labels = dict(zip(metric.labels, key))
+                with metric.lock:
+                    counts = metric.values[key][:]
+                count = sum(counts[:-1])
+                if not count:
+                    continue
+                name = metric.name + (' ' + ' '.join(v for v in labels.values() if v) if labels else '')
+                lines.append(f'{name}: {count} avg {counts[-1] / count:.2f} '
+                             f'p50 {metric.quantile(0.5, **labels)} p95 {metric.quantile(0.95, **labels)}')
+        else:
+            samples = metric.samples()
+            if samples:
+                total = sum(x[2] for x in samples)
+                lines.append(f'{metric.name}: {total:g}')
+    return '\n'.join(lines)
+
+
+class MetricsHandler(http.server.BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split('?')[0] != '/metrics':
+            self.send_error(404)
+            return
+        data = render().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_server(port: int, host: str = '127.0.0.1'):
+    """
+    Starts the http endpoint /metrics in a daemon thread.
+
+    Args:
+        port (int): The port.
+        host (str, optional): The address to listen on. Defaults to '127.0.0.1'.
+    """
+    global SERVER
+    if SERVER:
+        return
+    try:
+        SERVER = http.server.ThreadingHTTPServer((host, port), MetricsHandler)
+        SERVER.daemon_threads = True
+        threading.Thread(target=SERVER.serve_forever, daemon=True).start()
+    except Exception as error:
+        my_log.log2(f'my_metrics:start_server: {error}')
+
+
+if __name__ == '__main__':
+    requests_total = counter('test_requests_total', 'Test requests', ('result', ))
+    latency = histogram('test_request_seconds', 'Test latency')
+    requests_total.inc(result='ok')
+    latency.observe(0.3)
+    latency.observe(7)
+    print(render())
+    print(summary())
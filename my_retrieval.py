@@ -0,0 +1,100 @@
+#!/usr/bin/env python3
+
+
+import collections
+import math
+import re
+
+
+# Words and numbers, the words are cut to their first letters as a poor man's stemmer,
+# the last letter of a short word is dropped too as it is often an ending
+TOKEN_RE = re.compile(r'\w+')
+STEM_LENGTH = 5
+
+
+def tokenize(text: str) -> list:
+    """
+    Splits the text into the terms of the index.
+
+    Args:
+        text (str): The text.
+
+    Returns:
+        list: The terms.
+    """
+    return [x[:max(4, min(STEM_LENGTH, len(x) - 1))] for x in TOKEN_RE.findall(text.lower()) if len(x) > 1 or not x.isascii()]
+
+
+class BM25Index:
+    """
+    Inverted index of documents ranked with Okapi BM25.
+    Documents can be added and removed one by one, the statistics are kept up to date.
+    """
+    def __init__(self, k1: float = 1.5, b: float = 0.75):
+        self.k1 = k1
+        self.b = b
+        # {term:{doc_id:term frequency}}
+        self.postings = collections.defaultdict(dict)
+        # {doc_id:[terms]}
+        self.docs = {}
+        self.total_length = 0
+
+    def add(self, doc_id, text: str):
+        self.remove(doc_id)
+        terms = collections.Counter(tokenize(text))
+        length = sum(terms.values())
+        self.docs[doc_id] = (list(terms), length)
+        self.total_length += length
+        for term, tf in terms.items():
+            self.postings[term][doc_id] = tf
+
+    def remove(self, doc_id):
+        if doc_id not in self.docs:
+            return
+        terms, length = self.docs.pop(doc_id)
+        self.total_length -= length
+        for term in terms:
+            postings = self.postings[term]
+            postings.pop(doc_id, None)
+            if not postings:
+                del self.postings[term]
+
+    def search(self, query: str, k: int = 5, exclude = ()) -> list:
+        """
+        Finds the documents most relevant to the query.
+
+        Args:
+            query (str): The query.
+            k (int, optional): The maximum number of documents. Defaults to 5.
+            exclude (optional): The ids of the documents to skip.
+
+        Returns:
+            list: [(score, doc_id), ] the best first, only the documents with some of the query terms.
+        """
+        n = len(self.docs)
+        if not n:
+            return []
+        avg_length = self.total_length / n or 1
+        scores = collections.defaultdict(float)
+        for term in set(tokenize(query)):
+            postings = self.postings.get(term)
+            if not postings:
+                continue
+            idf = math.log(1 + (n - len(postings) + 0.5) / (len(postings) + 0.5))
+            for doc_id, tf in postings.items():
+                if doc_id in exclude:
+                    continue
+                length = self.docs[doc_id][1]
+                scores[doc_id] += idf * tf * (self.k1 + 1) / (tf + self.k1 * (1 - self.b + self.b * length / avg_length))
+        return sorted(((score, doc_id) for doc_id, score in scores.items()), reverse=True)[:k]
+
+    def __len__(self) -> int:
+        return len(self.docs)
+
+
+if __name__ == '__main__':
+    index = BM25Index()
+    index.add(1, 'How to cook pasta with tomatoes?')
+    index.add(2, 'What is the capital of France? Paris.')
+    index.add(3, 'Как приготовить пасту с томатами?')
+    print(index.search('pasta tomatoes'), index.search('пасты'))
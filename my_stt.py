@@ -8,11 +8,16 @@ import threading
 import speech_recognition as sr
 
 import my_log
+import my_metrics
+import my_trace
 
 
 # locks for chat_ids
 LOCKS = {}
 
+METRIC_REQUESTS = my_metrics.counter('stt_requests_total', 'Speech recognition requests', ('engine', 'result'))
+METRIC_SECONDS = my_metrics.histogram('stt_seconds', 'Time of the speech recognition', ('engine', ))
+
 
 def convert_to_wave_with_ffmpeg(audio_file: str) -> str:
     """
@@ -57,6 +62,7 @@ def stt_google(audio_file: str, language: str = 'ru') -> str:
     return text
 
 
+@my_trace.traced('stt')
 def stt(input_file: str, lang: str = 'ru', chat_id: str = '_') -> str:
     """
     Generate the function comment for the given function body in a markdown code block with the correct language syntax.
@@ -75,11 +81,13 @@ def stt(input_file: str, lang: str = 'ru', chat_id: str = '_') -> str:
         text = ''
 
         try:
-            text = stt_google(input_file, lang)
+            with METRIC_SECONDS.time(engine='google'):
+                text = stt_google(input_file, lang)
         except AssertionError:
             pass
         except Exception as unknown_value_error:
             my_log.log2(f'my_stt:stt:{unknown_value_error}')
+        METRIC_REQUESTS.inc(engine='google', result='ok' if text else 'failed')
 
         return text
 
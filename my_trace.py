@@ -0,0 +1,229 @@
+#!/usr/bin/env python3
+# Tracing of the requests: a trace is started by a telegram handler, the stages of the work
+# are recorded as nested spans and the finished slow traces are saved to a jsonl file.
+
+
+import contextvars
+import functools
+import json
+import random
+import threading
+import time
+import uuid
+
+import cfg
+import my_log
+
+
+# Finished traces, one json per line, written and rotated by my_log
+TRACE_FILE = cfg.trace_file if hasattr(cfg, 'trace_file') else 'logs/traces.jsonl'
+# Traces longer than this are always saved, seconds; the traces with errors too
+TRACE_SLOW_THRESHOLD = cfg.trace_slow_threshold if hasattr(cfg, 'trace_slow_threshold') else 10
+# Part of the other traces that is saved, 0 - none
+TRACE_SAMPLE_RATE = cfg.trace_sample_rate if hasattr(cfg, 'trace_sample_rate') else 0
+
+# The span of the current request in this thread or asyncio task
+CURRENT_SPAN = contextvars.ContextVar('CURRENT_SPAN', default=None)
+
+
+class Trace:
+    """All spans of one request."""
+    def __init__(self, name: str):
+        self.trace_id = uuid.uuid4().hex[:16]
+        self.name = name
+        self.start_time = time.time()
+        self.spans = []
+        self.lock = threading.Lock()
+
+    def add(self, span):
+        with self.lock:
+            self.spans.append(span)
+
+
+class Span:
+    """
+    A stage of the work, used as a context manager.
+    The span becomes the parent of the spans started inside its block.
+    """
+    def __init__(self, trace: Trace, name: str, parent = None, attrs: dict = None):
+        """
+        Args:
+            trace (Trace): The trace of the span.
+            name (str): The name of the stage, 'module.stage'.
+            parent (Span, optional): The parent span, None for the root span of the trace.
+            attrs (dict, optional): The attributes of the span.
+        """
+        self.trace = trace
+        self.name = name
+        self.parent = parent
+        self.span_id = uuid.uuid4().hex[:8]
+        self.attrs = attrs or {}
+        self.error = ''
+        self.start_time = 0
+        self.duration = 0
+        self.token = None
+
+    def set(self, **attrs):
+        self.attrs.update(attrs)
+
+    def __enter__(self):
+        self.start_time = time.time()
+        self.token = CURRENT_SPAN.set(self)
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.duration = time.time() - self.start_time
+        if exc_val is not None and not isinstance(exc_val, GeneratorExit):
+            self.error = f'{exc_type.__name__}: {exc_val}'
+        CURRENT_SPAN.reset(self.token)
+        self.trace.add(self)
+        if self.parent is None:
+            export(self.trace, self)
+
+    def to_dict(self) -> dict:
+        result = {'id': self.span_id, 'parent': self.parent.span_id if self.parent else '', 'name': self.name,
+                  'start': round(self.start_time - self.trace.start_time, 3), 'duration': round(self.duration, 3)}
+        if self.attrs:
+            result['attrs'] = self.attrs
+        if self.error:
+            result['error'] = self.error
+        return result
+
+
+class NoSpan:
+    """The span outside of a trace, does nothing."""
+    def set(self, **attrs):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        pass
+
+
+NO_SPAN = NoSpan()
+
+
+def trace(name: str, **attrs) -> Span:
+    """
+    Starts a new trace, the returned root span must be used as a context manager.
+    The trace is saved when the root span ends.
+
+    Args:
+        name (str): The name of the request, usually the handler.
+        **attrs: The attributes of the root span.
+
+    Returns:
+        Span: The root span.
+    """
+    return Span(Trace(name), name, attrs=attrs)
+
+
+def span(name: str, **attrs):
+    """
+    Starts a span in the current trace, the returned span must be used as a context manager.
+    Outside of a trace it does nothing.
+    Do not yield inside its block, the span would stay current in the caller of the generator.
+
+    Args:
+        name (str): The name of the stage, 'module.stage'.
+        **attrs: The attributes of the span.
+
+    Returns:
+        Span: The span.
+    """
+    parent = CURRENT_SPAN.get()
+    if parent is None:
+        return NO_SPAN
+    return Span(parent.trace, name, parent, attrs)
+
+
+def record(name: str, duration: float, **attrs):
+    """
+    Adds a stage that has just finished to the current trace, for the code that measures its time itself
+    and for the generators.
+
+    Args:
+        name (str): The name of the stage, 'module.stage'.
+        duration (float): How long it took, seconds.
+        **attrs: The attributes of the span.
+    """
+    parent = CURRENT_SPAN.get()
+    if parent is None:
+        return
+    finished = Span(parent.trace, name, parent, attrs)
+    finished.start_time = time.time() - duration
+    finished.duration = duration
+    parent.trace.add(finished)
+
+
+def traced(name: str):
+    """The decorator that records every call of the function as a span."""
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with span(name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def annotate(**attrs):
+    """Sets the attributes of the current span."""
+    current = CURRENT_SPAN.get()
+    if current is not None:
+        current.set(**attrs)
+
+
+def trace_id() -> str:
+    """Returns the id of the current trace, '' outside of a trace."""
+    current = CURRENT_SPAN.get()
+    return current.trace.trace_id if current is not None else ''
+
+
+def bind(func):
+    """
+    Returns the function that runs in the trace of the caller, for the thread pools.
+    Every call gets its own copy of the context, so the calls can run in parallel.
+    """
+    context = contextvars.copy_context()
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        return context.copy().run(func, *args, **kwargs)
+    return wrapper
+
+
+def export(current: Trace, root: Span):
+    """
+    Saves the finished trace if it was slow, had errors or got into the sample.
+    """
+    with current.lock:
+        spans = current.spans[:]
+    failed = any(x.error for x in spans) or root.attrs.get('error')
+    if root.duration < TRACE_SLOW_THRESHOLD and not failed and random.random() >= TRACE_SAMPLE_RATE:
+        return
+    spans.sort(key=lambda x: x.start_time)
+    record = {'trace_id': current.trace_id, 'name': current.name,
+              'time': time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(current.start_time)),
+              'duration': round(root.duration, 3), 'spans': [x.to_dict() for x in spans]}
+    try:
+        my_log.write(TRACE_FILE, json.dumps(record, ensure_ascii=False, default=str) + '\n')
+    except Exception as error:
+        my_log.log2(f'my_trace:export: {error}')
+
+
+if __name__ == '__main__':
+    TRACE_SLOW_THRESHOLD = 0
+    with trace('test', chat='123'):
+        with span('test.stage', n=1):
+            time.sleep(0.1)
+        def work():
+            with span('test.thread'):
+                time.sleep(0.1)
+        t = threading.Thread(target=bind(work))
+        t.start()
+        t.join()
+    my_log.flush()
+    print(open(TRACE_FILE).read().splitlines()[-1])
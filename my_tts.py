@@ -8,7 +8,14 @@ import tempfile
 
 import edge_tts
 
+import my_metrics
+import my_trace
 
+
+METRIC_REQUESTS = my_metrics.counter('tts_requests_total', 'Text to speech requests', ('result', ))
+METRIC_SECONDS = my_metrics.histogram('tts_seconds', 'Time of the text to speech')
+
+@my_trace.traced('tts')
 def tts(text: str, voice: str = 'ru', rate: str = '+0%', gender: str = 'female') -> bytes:
     """Генерирует аудио из текста с помощью edge-tts и возвращает байтовый поток
 
@@ -37,7 +44,13 @@ def tts(text: str, voice: str = 'ru', rate: str = '+0%', gender: str = 'female')
 
     # Запускаем edge-tts для генерации аудио
     com = edge_tts.Communicate(text, voice, rate=rate)
-    asyncio.run(com.save(filename))
+    try:
+        with METRIC_SECONDS.time():
+            asyncio.run(com.save(filename))
+    except Exception:
+        METRIC_REQUESTS.inc(result='error')
+        raise
+    METRIC_REQUESTS.inc(result='ok')
 
     # Читаем аудио из временного файла 
     with open(filename, "rb") as f: 
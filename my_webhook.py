@@ -0,0 +1,198 @@
+#!/usr/bin/env python3
+# Receives the telegram updates with a webhook instead of the long polling.
+# A small asyncio http server checks the secret token, answers at once
+# and passes the new updates in order to the handler in another thread.
+
+
+import asyncio
+import collections
+import concurrent.futures
+import hmac
+import json
+import threading
+import urllib.error
+import urllib.request
+
+import my_log
+import my_metrics
+
+
+# The biggest update body that is accepted, bytes
+MAX_BODY_SIZE = 1000000
+# The connection is closed if no request comes in this time, seconds
+IDLE_TIMEOUT = 60
+# How many last update ids are remembered to drop the updates that telegram sends again
+DEDUP_SIZE = 10000
+
+METRIC_UPDATES = my_metrics.counter('webhook_updates_total', 'Updates received with the webhook', ('result', ))
+
+STATUS_TEXT = {200: 'OK', 400: 'Bad Request', 403: 'Forbidden', 404: 'Not Found', 405: 'Method Not Allowed',
+               413: 'Payload Too Large'}
+
+
+class WebhookServer:
+    """
+    The http server of the webhook, runs its event loop in a daemon thread.
+    """
+    def __init__(self, handler, secret: str, host: str = '127.0.0.1', port: int = 8443, path: str = '/telegram'):
+        """
+        Args:
+            handler: The function that gets every new update as a dict, it is called in one thread in the order of the updates.
+            secret (str): The secret token that telegram sends in the X-Telegram-Bot-Api-Secret-Token header, '' - no check.
+            host (str, optional): The address to listen on. Defaults to '127.0.0.1'.
+            port (int, optional): The port. Defaults to 8443.
+            path (str, optional): The path of the webhook. Defaults to '/telegram'.
+        """
+        self.handler = handler
+        self.secret = secret
+        self.host = host
+        self.port = port
+        self.path = path
+        # one thread keeps the order of the updates
+        self.handoff = concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix='webhook')
+        self.seen = set()
+        self.seen_order = collections.deque()
+        self.loop = None
+        self.server = None
+        self.started = threading.Event()
+
+    def start(self):
+        """
+        Starts the server in a daemon thread and waits until it listens.
+
+        Raises:
+            RuntimeError: The server could not listen on the address.
+        """
+        threading.Thread(target=self.run, daemon=True).start()
+        self.started.wait(10)
+        if self.server is None:
+            raise RuntimeError(f'my_webhook: can not listen on {self.host}:{self.port}')
+
+    def run(self):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        try:
+            self.server = self.loop.run_until_complete(asyncio.start_server(self.serve, self.host, self.port))
+            # the real port if it was 0
+            self.port = self.server.sockets[0].getsockname()[1]
+        except Exception as error:
+            my_log.log2(f'my_webhook:run: {self.host}:{self.port} {error}')
+            self.started.set()
+            return
+        self.started.set()
+        self.loop.run_forever()
+
+    def stop(self):
+        if self.loop is not None:
+            self.loop.call_soon_threadsafe(self.loop.stop)
+        self.handoff.shutdown(wait=True)
+
+    async def serve(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        """Serves the requests of one connection, telegram keeps it open for the next updates."""
+        try:
+            while 1:
+                try:
+                    head = await asyncio.wait_for(reader.readuntil(b'\r\n\r\n'), IDLE_TIMEOUT)
+                except (asyncio.IncompleteReadError, asyncio.TimeoutError, asyncio.LimitOverrunError):
+                    return
+                lines = head.decode('latin-1').split('\r\n')
+                method, path, _ = (lines[0].split(' ', 2) + ['', ''])[:3]
+                headers = {}
+                for line in lines[1:]:
+                    if ':' in line:
+                        name, value = line.split(':', 1)
+                        headers[name.strip().lower()] = value.strip()
+                size = int(headers.get('content-length', 0) or 0)
+                if size > MAX_BODY_SIZE:
+                    await self.respond(writer, 413, close=True)
+                    return
+                body = await reader.readexactly(size) if size else b''
+
+                status = self.check(method, path, headers)
+                # telegram does not need anything but 200, the update is handled after the answer
+                await self.respond(writer, status)
+                if status == 200:
+                    self.accept(body)
+                if headers.get('connection', '').lower() == 'close':
+                    return
+        except Exception as error:
+            my_log.log2(f'my_webhook:serve: {error}')
+        finally:
+            writer.close()
+
+    def check(self, method: str, path: str, headers: dict) -> int:
+        """Returns the http status of the request."""
+        if path.split('?')[0] != self.path:
+            return 404
+        if method != 'POST':
+            return 405
+        if self.secret and not hmac.compare_digest(headers.get('x-telegram-bot-api-secret-token', ''), self.secret):
+            METRIC_UPDATES.inc(result='forbidden')
+            return 403
+        return 200
+
+    async def respond(self, writer: asyncio.StreamWriter, status: int, close: bool = False):
+        connection = 'close' if close else 'keep-alive'
+        writer.write(f'HTTP/1.1 {status} {STATUS_TEXT.get(status, "")}\r\nContent-Length: 0\r\n'
+                     f'Connection: {connection}\r\n\r\n'.encode('latin-1'))
+        await writer.drain()
+
+    def accept(self, body: bytes):
+        """Passes the update to the handler if it was not received before."""
+        try:
+            update = json.loads(body)
+            update_id = update['update_id']
+        except Exception as error:
+            METRIC_UPDATES.inc(result='bad_request')
+            my_log.log2(f'my_webhook:accept: {error} {body[:300]}')
+            return
+        if update_id in self.seen:
+            METRIC_UPDATES.inc(result='duplicate')
+            return
+        self.seen.add(update_id)
+        self.seen_order.append(update_id)
+        if len(self.seen_order) > DEDUP_SIZE:
+            self.seen.discard(self.seen_order.popleft())
+        METRIC_UPDATES.inc(result='accepted')
+        self.handoff.submit(self.handle, update)
+
+    def handle(self, update: dict):
+        try:
+            self.handler(update)
+        except Exception as error:
+            my_log.log2(f'my_webhook:handle: {error}')
+
+
+def post_update(url: str, update: dict, secret: str = '') -> int:
+    """
+    Sends the update to the webhook like telegram does, for the tests.
+
+    Args:
+        url (str): The url of the webhook.
+        update (dict): The update.
+        secret (str, optional): The secret token. Defaults to ''.
+
+    Returns:
+        int: The http status of the answer.
+    """
+    request = urllib.request.Request(url, data=json.dumps(update).encode('utf-8'), method='POST',
+                                     headers={'Content-Type': 'application/json',
+                                              'X-Telegram-Bot-Api-Secret-Token': secret})
+    try:
+        with urllib.request.urlopen(request, timeout=10) as response:
+            return response.status
+    except urllib.error.HTTPError as error:
+        return error.code
+
+
+if __name__ == '__main__':
+    received = []
+    server = WebhookServer(received.append, secret='test_secret', port=0)
+    server.start()
+    url = f'http://127.0.0.1:{server.port}/telegram'
+    update = {'update_id': 1, 'message': {'message_id': 1, 'text': 'hi'}}
+    print(post_update(url, update, 'test_secret'), post_update(url, update, 'test_secret'),
+          post_update(url, dict(update, update_id=2), 'wrong'), post_update(url.replace('telegram', 'x'), update))
+    server.stop()
+    print(received)
+    print(my_metrics.summary())
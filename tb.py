@@ -37,18 +37,31 @@ if not os.path.exists('logs'):
 import io
 import pickle
 import re
+import secrets
+import signal
 import tempfile
 import datetime
+import functools
+import hashlib
+import html
+import itertools
 import threading
 import time
+import urllib.parse
 
 import telebot
 
+import my_cache
+import my_dispatcher
 import my_genimg
 import my_gemini
+import my_history
 import my_log
+import my_metrics
 import my_stt
+import my_trace
 import my_tts
+import my_webhook
 import utils
 
 
@@ -56,20 +69,201 @@ KEYS_DB_FILE = 'db/gemini_keys.pkl'
 HFKEYS_DB_FILE = 'db/hugginface_keys.pkl'
 USERS_DB_FILE = 'db/gemini_users.pkl'
 
-bot = telebot.TeleBot(cfg.token, skip_pending=True)
+# The updates that came while the bot was down are dropped on start, with the polling and with the webhook
+SKIP_PENDING = cfg.skip_pending if hasattr(cfg, 'skip_pending') else True
+
+bot = telebot.TeleBot(cfg.token, skip_pending=SKIP_PENDING)
 _bot_name = bot.get_me().username
 BOT_ID = bot.get_me().id
 
 
 # Saving incoming messages, if they are too long and
-# were sent by the client in pieces {id:[messages]}
-# Catching the message and waiting half a second to see if another piece arrives
+# were sent by the client in pieces {id:{'text':glued pieces, 'time':arrival of the last piece}}
+# Catching the message and waiting half a second to see if another piece arrives, the message goes
+# to the workers only when the pieces stop coming
 MESSAGE_QUEUE = {}
+MESSAGE_QUEUE_LOCK = threading.Lock()
+MESSAGE_PIECES_WINDOW = 0.5
+
+# The updates are handled by a fixed number of workers, the messages of a chat one by one in order.
+# If a chat or the whole bot has too many waiting messages the new ones get the busy reply
+WORKERS = cfg.workers if hasattr(cfg, 'workers') else 16
+CHAT_QUEUE_MAX = cfg.chat_queue_max if hasattr(cfg, 'chat_queue_max') else 10
+QUEUE_MAX = cfg.queue_max if hasattr(cfg, 'queue_max') else 500
+DISPATCHER = my_dispatcher.Dispatcher(max_workers=WORKERS, max_chat_tasks=CHAT_QUEUE_MAX, max_tasks=QUEUE_MAX)
+# Ends the windows of the pieces of messages and of the albums, the workers do not wait for them
+TIMERS = my_dispatcher.Scheduler()
+# The busy reply is sent to a chat once in this time, seconds {chat_id_full:time}
+BUSY_REPLY_INTERVAL = 30
+BUSY_REPLIES = {}
+BUSY_REPLIES_LOCK = threading.Lock()
+
+# Receive the updates with a webhook instead of the long polling if the url is set.
+# Telegram posts to the https url, the reverse proxy passes the requests to WEBHOOK_HOST:WEBHOOK_PORT with the same path
+WEBHOOK_URL = cfg.webhook_url if hasattr(cfg, 'webhook_url') else ''
+WEBHOOK_HOST = cfg.webhook_host if hasattr(cfg, 'webhook_host') else '127.0.0.1'
+WEBHOOK_PORT = cfg.webhook_port if hasattr(cfg, 'webhook_port') else 8443
+# Telegram sends it with every update, a new one is made on every start if it is not set
+WEBHOOK_SECRET = cfg.webhook_secret if hasattr(cfg, 'webhook_secret') else secrets.token_urlsafe(32)
+
+# Send the answer while it is being generated and edit it as new pieces arrive
+STREAM_ANSWERS = cfg.stream_answers if hasattr(cfg, 'stream_answers') else False
+# Telegram allows about one edit per second in a private chat and 20 messages per minute in a group
+STREAM_EDIT_INTERVAL = 1.5
+STREAM_EDIT_INTERVAL_GROUP = 3
+STREAM_CHUNK_SIZE = 3800
+# Longer answers are sent as a text file instead of many messages
+LONG_MESSAGE_MAX = 32000
+
+# Photos for the description are downloaded in the smallest size with this width or height, pixels
+PHOTO_MIN_SIDE = cfg.photo_min_side if hasattr(cfg, 'photo_min_side') else 1024
+
+# Descriptions of images {(file_unique_id or sha256, query):description}, '' in the file name turns off the disk tier
+IMG2TXT_CACHE_FILE = cfg.img2txt_cache_file if hasattr(cfg, 'img2txt_cache_file') else 'db/img2txt_cache.db'
+IMG2TXT_CACHE_TTL = cfg.img2txt_cache_ttl if hasattr(cfg, 'img2txt_cache_ttl') else 3 * 24 * 60 * 60
+IMG2TXT_CACHE = my_cache.Cache(max_items=500, ttl=IMG2TXT_CACHE_TTL, file_name=IMG2TXT_CACHE_FILE)
+
+# Photos of an album are collected during this time and described together, seconds
+ALBUM_WINDOW = 1.5
+# {media_group_id:[message, ]}
+ALBUMS = {}
+ALBUMS_LOCK = threading.Lock()
+
+# Metrics are exported on http://127.0.0.1:<metrics_port>/metrics if the port is set and shown by /stats
+METRICS_PORT = cfg.metrics_port if hasattr(cfg, 'metrics_port') else 0
+METRIC_UPDATES = my_metrics.counter('tb_updates_total', 'Handled telegram updates', ('handler', ))
+METRIC_HANDLER_SECONDS = my_metrics.histogram('tb_handler_seconds', 'Time of the handlers', ('handler', ))
+METRIC_TELEGRAM_SECONDS = my_metrics.histogram('telegram_request_seconds', 'Time of the telegram api requests', ('method', ))
+my_metrics.gauge('tb_threads', 'Running threads', func=threading.active_count)
+my_metrics.gauge('tb_chat_actions', 'Requests showing a chat action', func=lambda: CHAT_ACTIONS.size())
+METRIC_CHAT_ACTIONS = my_metrics.counter('tb_chat_actions_total', 'Sent chat actions', ('result', ))
+
+# Telegram shows a chat action for 5 seconds, it is sent again a bit earlier, seconds
+CHAT_ACTION_INTERVAL = 4.5
+# A request that shows its action longer than this is considered stuck, seconds
+CHAT_ACTION_MAX_TIME = 60 * 5
+my_metrics.gauge('tb_message_queue', 'Chats waiting for the rest of a long message', func=lambda: len(MESSAGE_QUEUE))
+my_metrics.gauge('tb_albums', 'Albums being collected', func=lambda: len(ALBUMS))
+
+
+class ChatActions:
+    """
+    One thread that shows the chat actions ("typing" etc) of all requests.
+
+    The requests take leases on (chat, topic, action), the same lease is shown once
+    while at least one request holds it. A chat gets at most one action every CHAT_ACTION_INTERVAL seconds,
+    if it has several leases they take turns. After 429 the chat waits as long as telegram asked.
+    """
+    def __init__(self):
+        # {chat_id:{(thread_id, action):{token:start time}}}, a token for every request
+        self.leases = {}
+        # {chat_id:[time of the next action, turn]}
+        self.chats = {}
+        self.tokens = itertools.count(1)
+        self.lock = threading.Lock()
+        self.wakeup = threading.Event()
+        self.thread = None
+
+    def acquire(self, chat_id: int, thread_id: int, action: str) -> int:
+        """Starts showing the action for a request, returns the token for release()."""
+        with self.lock:
+            token = next(self.tokens)
+            self.leases.setdefault(chat_id, {}).setdefault((thread_id, action), {})[token] = time.time()
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run, daemon=True)
+                self.thread.start()
+        self.wakeup.set()
+        return token
+
+    def release(self, chat_id: int, thread_id: int, action: str, token: int):
+        with self.lock:
+            chat = self.leases.get(chat_id)
+            # it could be dropped as stuck
+            if not chat or (thread_id, action) not in chat:
+                return
+            lease = chat[(thread_id, action)]
+            lease.pop(token, None)
+            if not lease:
+                del chat[(thread_id, action)]
+                if not chat:
+                    del self.leases[chat_id]
+
+    def size(self) -> int:
+        """Returns the number of the requests that show an action."""
+        with self.lock:
+            return sum(len(lease) for chat in self.leases.values() for lease in chat.values())
+
+    def run(self):
+        while 1:
+            now = time.time()
+            due = []
+            with self.lock:
+                for chat_id, chat in list(self.leases.items()):
+                    for key, lease in list(chat.items()):
+                        for token, start_time in list(lease.items()):
+                            if now - start_time > CHAT_ACTION_MAX_TIME:
+                                del lease[token]
+                                my_log.log2(f'tb:ChatActions:stopped after 5min [{chat_id}] {key}')
+                        if not lease:
+                            del chat[key]
+                    if not chat:
+                        del self.leases[chat_id]
+                        continue
+                    state = self.chats.setdefault(chat_id, [0, 0])
+                    if state[0] <= now:
+                        keys = list(chat)
+                        due.append((chat_id, ) + keys[state[1] % len(keys)])
+                        state[0] = now + CHAT_ACTION_INTERVAL
+                        state[1] += 1
+                # the chats without leases are forgotten when they can get an action again
+                for chat_id in [x for x, state in self.chats.items() if state[0] <= now and x not in self.leases]:
+                    del self.chats[chat_id]
+                timeout = min((self.chats[x][0] for x in self.leases), default=None)
+
+            for chat_id, thread_id, action in due:
+                self.send(chat_id, thread_id, action)
+
+            self.wakeup.wait(None if timeout is None else max(0, timeout - time.time()))
+            self.wakeup.clear()
+
+    def send(self, chat_id: int, thread_id: int, action: str):
+        try:
+            if thread_id:
+                bot.send_chat_action(chat_id, action, message_thread_id = thread_id)
+            else:
+                bot.send_chat_action(chat_id, action)
+            METRIC_CHAT_ACTIONS.inc(result='ok')
+        except Exception as error:
+            retry_after = get_retry_after(error)
+            if retry_after:
+                METRIC_CHAT_ACTIONS.inc(result='429')
+                with self.lock:
+                    if chat_id in self.chats:
+                        # the chat could be already waiting longer
+                        self.chats[chat_id][0] = max(self.chats[chat_id][0], time.time() + retry_after)
+            else:
+                METRIC_CHAT_ACTIONS.inc(result='error')
+                my_log.log2(f'tb:ChatActions:send: [{chat_id}] [{thread_id}] {action} {error}')
+
+
+def get_retry_after(error: Exception) -> float:
+    """
+    Returns how long telegram asked to wait after the 429 error, 0 for the other errors.
+    """
+    if getattr(error, 'error_code', None) != 429:
+        return 0
+    try:
+        return float(error.result_json['parameters']['retry_after'])
+    except Exception:
+        return CHAT_ACTION_INTERVAL
+
 
+CHAT_ACTIONS = ChatActions()
 
-class ShowAction(threading.Thread):
-    """A thread that can be stopped. Continuously sends a notification of activity to the chat.
-    Telegram automatically extinguishes the notification after 5 seconds, so it must be repeated.
+
+class ShowAction:
+    """Shows the notification of activity in the chat while the block runs.
+    Telegram automatically extinguishes the notification after 5 seconds, so it is repeated by CHAT_ACTIONS.
 
     To use in the code, you need to do something like this:
     with ShowAction(message, 'typing'):
@@ -83,51 +277,81 @@ class ShowAction(threading.Thread):
             action (_type_):  "typing", "upload_photo", "record_video", "upload_video", "record_audio", 
                               "upload_audio", "upload_document", "find_location", "record_video_note", "upload_video_note"
         """
-        super().__init__()
         self.actions = [  "typing", "upload_photo", "record_video", "upload_video", "record_audio",
                          "upload_audio", "upload_document", "find_location", "record_video_note", "upload_video_note"]
         assert action in self.actions, f'Допустимые actions = {self.actions}'
         self.chat_id = message.chat.id
-        self.thread_id = message.message_thread_id
         self.is_topic = True if message.is_topic_message else False
+        self.thread_id = message.message_thread_id if self.is_topic else None
         self.action = action
-        self.is_running = True
-        self.timerseconds = 1
-        self.started_time = time.time()
-
-    def run(self):
-        while self.is_running:
-            if time.time() - self.started_time > 60*5:
-                self.stop()
-                my_log.log2(f'tb:show_action:stoped after 5min [{self.chat_id}] [{self.thread_id}] is topic: {self.is_topic} action: {self.action}')
-                return
-            try:
-                if self.is_topic:
-                    bot.send_chat_action(self.chat_id, self.action, message_thread_id = self.thread_id)
-                else:
-                    bot.send_chat_action(self.chat_id, self.action)
-            except Exception as error:
-                if 'A request to the Telegram API was unsuccessful. Error code: 429. Description: Too Many Requests' not in str(error):
-                    my_log.log2(f'tb:show_action:run: {error}')
-            n = 50
-            while n > 0:
-                time.sleep(0.1)
-                n = n - self.timerseconds
-
-    def stop(self):
-        self.timerseconds = 50
-        self.is_running = False
-        try:
-            bot.send_chat_action(self.chat_id, 'cancel', message_thread_id = self.thread_id)
-        except Exception as error:
-            my_log.log2(f'tb:show_action: {error}')
+        self.token = None
 
     def __enter__(self):
-        self.start()
+        self.token = CHAT_ACTIONS.acquire(self.chat_id, self.thread_id, self.action)
         return self
 
     def __exit__(self, exc_type, exc_val, exc_tb):
-        self.stop()
+        CHAT_ACTIONS.release(self.chat_id, self.thread_id, self.action, self.token)
+
+def measure(func):
+    """Counts the calls of a handler, observes their time and traces them."""
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        METRIC_UPDATES.inc(handler=func.__name__)
+        # the callback query has the message inside
+        message = getattr(args[0], 'message', args[0]) if args else None
+        chat_id = message.chat.id if hasattr(message, 'chat') else ''
+        with METRIC_HANDLER_SECONDS.time(handler=func.__name__), my_trace.trace(func.__name__, chat=chat_id):
+            return func(*args, **kwargs)
+    return wrapper
+
+
+def measure_telegram_requests():
+    """Observes the time of every telegram api request by wrapping the request function of telebot."""
+    if not hasattr(telebot.apihelper, '_make_request'):
+        return
+    make_request = telebot.apihelper._make_request
+
+    @functools.wraps(make_request)
+    def wrapper(token, method_name, *args, **kwargs):
+        with METRIC_TELEGRAM_SECONDS.time(method=method_name), my_trace.span(f'telegram.{method_name}'):
+            return make_request(token, method_name, *args, **kwargs)
+    telebot.apihelper._make_request = wrapper
+
+
+def dispatch(message: telebot.types.Message, func, *args) -> bool:
+    """
+    Runs func(*args) on the workers after the earlier tasks of the chat of the message.
+
+    Args:
+        message (telebot.types.Message): The message, the task is queued in its chat.
+        func: The handler.
+        *args: Its arguments.
+
+    Returns:
+        bool: False if the queue was full, then the chat gets the busy reply
+              if the message was addressed to the bot, see addressed_to_bot().
+    """
+    chat_id_full = get_topic_id(message)
+    if DISPATCHER.submit(chat_id_full, func, *args):
+        return True
+    # the chatter of a group that the bot would not answer anyway is dropped silently
+    if not addressed_to_bot(message):
+        return False
+    now = time.time()
+    with BUSY_REPLIES_LOCK:
+        reply = now - BUSY_REPLIES.get(chat_id_full, 0) > BUSY_REPLY_INTERVAL
+        if reply:
+            # the chats that can get the reply again are forgotten
+            for chat in [x for x, reply_time in BUSY_REPLIES.items() if now - reply_time > BUSY_REPLY_INTERVAL]:
+                del BUSY_REPLIES[chat]
+            BUSY_REPLIES[chat_id_full] = now
+    if reply:
+        try:
+            bot.reply_to(message, 'Too many requests, please try again a bit later.')
+        except Exception as error:
+            my_log.log2(f'tb:dispatch: {error}')
+    return False
 
 
 def get_kbd(text: str) -> telebot.types.ReplyKeyboardMarkup:
@@ -153,8 +377,8 @@ def get_kbd(text: str) -> telebot.types.ReplyKeyboardMarkup:
 @bot.callback_query_handler(func=lambda call: True)
 def callback_inline(call: telebot.types.CallbackQuery):
     if authorized(call.message):
-        thread = threading.Thread(target=callback_inline_thread, args=(call,))
-        thread.start()
+        dispatch(call.message, callback_inline_thread, call)
+@measure
 def callback_inline_thread(call: telebot.types.CallbackQuery):
         message = call.message
         lang = message.from_user.language_code or 'en'
@@ -167,31 +391,49 @@ def callback_inline_thread(call: telebot.types.CallbackQuery):
             reset(message)
 
 
-def img2txt(text, lang: str, chat_id_full: str, query: str = '') -> str:
+@my_trace.traced('tb.img2txt')
+def img2txt(text, lang: str, chat_id_full: str, query: str = '', cache_key: str = '') -> str:
     """
-    Generate the text description of an image.
+    Generate the text description of an image or of several images with one request.
+    The descriptions are cached by the images and the query.
 
     Args:
-        text (str): The image file URL or downloaded data(bytes).
+        text (str): The image file URL, downloaded data(bytes) or a function that downloads it,
+            or a list of them.
         lang (str): The language code for the image description.
         chat_id_full (str): The full chat ID.
+        query (str, optional): The question about the image.
+        cache_key (str, optional): The id of the images for the cache, Telegram file_unique_id.
+            If not specified, the images are downloaded and the hash of their data is used.
 
     Returns:
         str: The text description of the image.
     """
-    if isinstance(text, bytes):
-        data = text
-    else:
-        data = utils.download_image_as_bytes(text)
+    images = text if isinstance(text, list) else [text, ]
     if not query:
-        query = 'What is depicted in the image? Give me a detailed description, and explain in detail what this could mean.'
-
-    text = ''
+        if len(images) > 1:
+            query = 'What is depicted in these images? Give me a detailed description, and explain in detail what this could mean.'
+        else:
+            query = 'What is depicted in the image? Give me a detailed description, and explain in detail what this could mean.'
+
+    data = None
+    if not cache_key:
+        data = [download_image(x) for x in images]
+        digest = hashlib.sha256()
+        for x in data:
+            digest.update(x)
+        cache_key = digest.hexdigest()
+
+    def describe() -> str:
+        data_ = data if data is not None else [download_image(x) for x in images]
+        data_ = [utils.prepare_image(x) for x in data_]
+        try:
+            return my_gemini.img2txt(data_, query)
+        except Exception as img_from_link_error2:
+            my_log.log2(f'tb:img2txt: {img_from_link_error2}')
+            return ''
 
-    try:
-        text = my_gemini.img2txt(data, query)
-    except Exception as img_from_link_error2:
-        my_log.log2(f'tb:img2txt: {img_from_link_error2}')
+    text = IMG2TXT_CACHE.get_or_compute((cache_key, query), describe) or ''
 
     if text:
         my_gemini.update_mem('User asked about a picture:' + ' ' + query, text, chat_id_full)
@@ -199,6 +441,18 @@ def img2txt(text, lang: str, chat_id_full: str, query: str = '') -> str:
     return text
 
 
+@my_trace.traced('tb.download_image')
+def download_image(image) -> bytes:
+    """
+    Returns the data of the image given as bytes, URL or a function that downloads it.
+    """
+    if isinstance(image, bytes):
+        return image
+    if callable(image):
+        return image()
+    return utils.download_image_as_bytes(image)
+
+
 def gemini_reset(chat_id: str):
     """
     Resets the Gemini state for the given chat ID.
@@ -267,11 +521,35 @@ def authorized(message: telebot.types.Message) -> bool:
         return True
 
 
+def addressed_to_bot(message: telebot.types.Message) -> bool:
+    """
+    Check if the message asks the bot for something: a private chat, a reply to the bot,
+    a command, a message that starts with the name of the bot or a photo with the '?' caption.
+    The buttons of the answers of the bot are in its own messages.
+
+    Parameters:
+        message (telebot.types.Message): The Telegram message object.
+
+    Returns:
+        bool: True if the message is addressed to the bot.
+    """
+    if message.chat.type == 'private':
+        return True
+    if message.from_user and message.from_user.id == BOT_ID:
+        return True
+    if message.reply_to_message and message.reply_to_message.from_user and message.reply_to_message.from_user.id == BOT_ID:
+        return True
+    if (message.caption or '').startswith('?'):
+        return True
+    text = (message.text or message.caption or '').lower()
+    return text.startswith(('/', cfg.bot_name.lower(), f'@{_bot_name}'.lower()))
+
+
 @bot.message_handler(content_types = ['voice', 'audio'])
 def handle_voice(message: telebot.types.Message):
     if authorized(message):
-        thread = threading.Thread(target=handle_voice_thread, args=(message,))
-        thread.start()
+        dispatch(message, handle_voice_thread, message)
+@measure
 def handle_voice_thread(message: telebot.types.Message):
     chat_id_full = get_topic_id(message)
     lang = get_lang(chat_id_full, message)
@@ -331,8 +609,8 @@ def hf_keys(message: telebot.types.Message):
 
 @bot.message_handler(commands=['image','img','i', 'imagine'])
 def image(message: telebot.types.Message):
-    thread = threading.Thread(target=image_thread, args=(message,))
-    thread.start()
+    dispatch(message, image_thread, message)
+@measure
 def image_thread(message: telebot.types.Message):
     """Generates a picture from a description"""
     # не обрабатывать команды к другому боту /cmd@botname args
@@ -380,12 +658,46 @@ def image_thread(message: telebot.types.Message):
         bot.reply_to(message, help)
 
 
+def get_photo_size(photos: list) -> telebot.types.PhotoSize:
+    """
+    Returns the smallest size of the photo that is not less than PHOTO_MIN_SIDE,
+    or the largest one if all of them are smaller.
+
+    Args:
+        photos (list): The sizes of the photo, message.photo.
+
+    Returns:
+        telebot.types.PhotoSize: The size to download.
+    """
+    for photo in sorted(photos, key=lambda x: x.width * x.height):
+        if max(photo.width, photo.height) >= PHOTO_MIN_SIDE:
+            return photo
+    return photos[-1]
+
+
 @bot.message_handler(content_types = ['photo'])
 def handle_photo(message: telebot.types.Message):
     if authorized(message):
-        thread = threading.Thread(target=handle_photo_thread, args=(message,))
-        thread.start()
-def handle_photo_thread(message: telebot.types.Message):
+        if message.media_group_id:
+            # the photos of an album come as separate messages, the first one starts the collection
+            with ALBUMS_LOCK:
+                album = ALBUMS.setdefault(message.media_group_id, [])
+                album.append(message)
+                if len(album) > 1:
+                    return
+            TIMERS.call_later(ALBUM_WINDOW, album_collected, message.media_group_id)
+        else:
+            dispatch(message, handle_photo_thread, message)
+def album_collected(media_group_id: str):
+    """Passes the album to the workers when its window ends, called by TIMERS."""
+    with ALBUMS_LOCK:
+        album = ALBUMS.pop(media_group_id)
+    album.sort(key=lambda x: x.message_id)
+    # the caption of an album is in one of its messages
+    message = next((x for x in album if x.caption), album[0])
+    dispatch(message, handle_photo_thread, message, album)
+@measure
+def handle_photo_thread(message: telebot.types.Message, album: list = None):
     chat_id_full = get_topic_id(message)
     lang = get_lang(chat_id_full, message)
 
@@ -406,11 +718,11 @@ def handle_photo_thread(message: telebot.types.Message):
 
     if state == 'describe':
         with ShowAction(message, 'typing'):
-            photo = message.photo[-1]
-            file_info = bot.get_file(photo.file_id)
-            image = bot.download_file(file_info.file_path)
-            
-            text = img2txt(image, lang, chat_id_full, message.caption)
+            photos = [get_photo_size(x.photo) for x in album or [message]]
+            images = [lambda photo=photo: bot.download_file(bot.get_file(photo.file_id).file_path) for photo in photos]
+            cache_key = '+'.join(photo.file_unique_id for photo in photos)
+
+            text = img2txt(images, lang, chat_id_full, message.caption, cache_key=cache_key)
             if text:
                 text = utils.bot_markdown_to_html(text)
                 reply_to_long_message(message, text, parse_mode='HTML', reply_markup=tts_button)
@@ -419,8 +731,8 @@ def handle_photo_thread(message: telebot.types.Message):
 @bot.message_handler(content_types = ['video', 'video_note'])
 def handle_video(message: telebot.types.Message):
     if authorized(message):
-        thread = threading.Thread(target=handle_video_thread, args=(message,))
-        thread.start()
+        dispatch(message, handle_video_thread, message)
+@measure
 def handle_video_thread(message: telebot.types.Message):
     chat_id_full = get_topic_id(message)
     lang = get_lang(chat_id_full, message)
@@ -489,8 +801,8 @@ def send_debug_history(message: telebot.types.Message):
 @bot.message_handler(commands=['tts'])
 def tts(message: telebot.types.Message, caption = None):
     if authorized(message):
-        thread = threading.Thread(target=tts_thread, args=(message,))
-        thread.start()
+        dispatch(message, tts_thread, message)
+@measure
 def tts_thread(message: telebot.types.Message):
     if is_for_me(message.text)[0]: message.text = is_for_me(message.text)[1]
     else: return
@@ -601,17 +913,20 @@ def proxy(message: telebot.types.Message):
     if not authorized(message):
         return
 
-    proxies = my_gemini.PROXY_POOL[:]
-    my_gemini.sort_proxies_by_speed(proxies)
+    proxies = my_gemini.get_ranked_proxies()
 
     msg = ''
 
     n = 0
     for x in proxies:
+        stats = my_gemini.PROXY_STATS.get(x)
+        if not stats:
+            continue
         n += 1
-        p1 = f'{int(my_gemini.PROXY_POLL_SPEED[x]):02}'
-        p2 = f'{round(my_gemini.PROXY_POLL_SPEED[x], 2):.2f}'.split('.')[1]
-        msg += f'[{n:02}] [{p1}.{p2}] {[x]}\n'
+        latency = stats.latency('text')
+        p1 = f'{int(latency):02}'
+        p2 = f'{round(latency, 2):.2f}'.split('.')[1]
+        msg += f'[{n:02}] [{p1}.{p2}] [{int(stats.success_rate() * 100):02}%] {[x]}\n'
 
     if not msg:
         msg = 'No proxies found'
@@ -620,6 +935,22 @@ def proxy(message: telebot.types.Message):
                  parse_mode='HTML', disable_web_page_preview=True)
 
 
+@bot.message_handler(commands=['stats'])
+def stats(message: telebot.types.Message):
+    # не обрабатывать команды к другому боту /cmd@botname args
+    if is_for_me(message.text)[0]: message.text = is_for_me(message.text)[1]
+    else: return
+
+    if hasattr(cfg, 'admins'):
+        if message.from_user.id not in cfg.admins:
+            return
+    elif not authorized(message):
+        return
+
+    msg = my_metrics.summary() or 'No metrics yet'
+    reply_to_long_message(message, f'<code>{html.escape(msg)}</code>', parse_mode='HTML', disable_web_page_preview=True)
+
+
 def send_long_message(message: telebot.types.Message, resp: str, parse_mode:str = None, disable_web_page_preview: bool = None,
                       reply_markup: telebot.types.InlineKeyboardMarkup = None):
     reply_to_long_message(message=message, resp=resp, parse_mode=parse_mode,
@@ -627,6 +958,7 @@ def send_long_message(message: telebot.types.Message, resp: str, parse_mode:str
                           reply_markup=reply_markup, send_message = True)
 
 
+@my_trace.traced('tb.reply')
 def reply_to_long_message(message: telebot.types.Message, resp: str, parse_mode: str = None,
                           disable_web_page_preview: bool = None,
                           reply_markup: telebot.types.InlineKeyboardMarkup = None, send_message: bool = False):
@@ -637,12 +969,13 @@ def reply_to_long_message(message: telebot.types.Message, resp: str, parse_mode:
 
     chat_id_full = get_topic_id(message)
 
-    if len(resp) < 32000:
+    if len(resp) < LONG_MESSAGE_MAX:
         if parse_mode == 'HTML':
             chunks = utils.split_html(resp, 3800)
         else:
             chunks = utils.split_text(resp, 3800)
         counter = len(chunks)
+        my_trace.annotate(chunks=counter)
         for chunk in chunks:
             try:
                 if send_message:
@@ -670,33 +1003,127 @@ def reply_to_long_message(message: telebot.types.Message, resp: str, parse_mode:
         bot.send_document(message.chat.id, document=buf, caption='resp.txt', visible_file_name = 'resp.txt')
 
 
+@my_trace.traced('tb.reply_streaming')
+def reply_streaming(message: telebot.types.Message, pieces, reply_markup: telebot.types.InlineKeyboardMarkup = None) -> str:
+    """
+    Replies with the answer while it is being generated. The first piece is sent at once,
+    then the message is edited as new pieces arrive, not more often than Telegram allows.
+    When the message gets too long the next one is started. In the end the answer
+    is formatted to HTML like in reply_to_long_message(), an answer longer than
+    LONG_MESSAGE_MAX replaces the messages with a text file like there.
+
+    Args:
+        message (telebot.types.Message): The message to reply to.
+        pieces: The iterator of the pieces of the answer.
+        reply_markup (telebot.types.InlineKeyboardMarkup, optional): The keyboard for the last message.
+
+    Returns:
+        str: The full answer.
+    """
+    interval = STREAM_EDIT_INTERVAL if message.chat.type == 'private' else STREAM_EDIT_INTERVAL_GROUP
+    sent = []
+    shown = []
+    next_edit = 0
+    text = ''
+
+    def show(parts: list, parse_mode: str = None, markup: telebot.types.InlineKeyboardMarkup = None):
+        for i, part in enumerate(parts):
+            markup_ = markup if i == len(parts) - 1 else None
+            if i < len(sent):
+                if shown[i] != part:
+                    bot.edit_message_text(part, message.chat.id, sent[i].message_id, parse_mode=parse_mode,
+                                          disable_web_page_preview=True, reply_markup=markup_)
+                    shown[i] = part
+            else:
+                sent.append(bot.reply_to(message, part, parse_mode=parse_mode,
+                                         disable_web_page_preview=True, reply_markup=markup_))
+                shown.append(part)
+
+    def wait_time(error: Exception) -> float:
+        if isinstance(error, telebot.apihelper.ApiTelegramException) and error.error_code == 429:
+            return error.result_json.get('parameters', {}).get('retry_after', interval)
+        my_log.log2(f'tb:reply_streaming: {error}')
+        return interval
+
+    for piece in pieces:
+        text += piece
+        # it will be a file, the messages stop growing
+        if not text.strip() or time.time() < next_edit or len(text) >= LONG_MESSAGE_MAX:
+            continue
+        try:
+            show([text[i:i + STREAM_CHUNK_SIZE] for i in range(0, len(text), STREAM_CHUNK_SIZE)])
+            next_edit = time.time() + interval
+        except Exception as error:
+            next_edit = time.time() + wait_time(error)
+
+    text = text.strip()
+    if not text:
+        return text
+
+    if len(text) >= LONG_MESSAGE_MAX:
+        for x in sent:
+            try:
+                bot.delete_message(message.chat.id, x.message_id)
+            except Exception as error:
+                my_log.log2(f'tb:reply_streaming: {error}')
+        reply_to_long_message(message, text, reply_markup=reply_markup)
+        return text
+
+    time.sleep(max(0, next_edit - time.time()))
+    parts = utils.split_html(utils.bot_markdown_to_html(text), STREAM_CHUNK_SIZE)
+    try:
+        show(parts, 'HTML', reply_markup)
+    except Exception as error:
+        time.sleep(wait_time(error))
+        parts = utils.split_text(text, STREAM_CHUNK_SIZE)
+        try:
+            show(parts, '', reply_markup)
+        except Exception as error2:
+            my_log.log2(f'tb:reply_streaming: {error2}')
+    for x in sent[len(parts):]:
+        try:
+            bot.delete_message(message.chat.id, x.message_id)
+        except Exception as error:
+            my_log.log2(f'tb:reply_streaming: {error}')
+    return text
+
+
 @bot.message_handler(func=lambda message: True)
 def echo_all(message: telebot.types.Message) -> None:
     if authorized(message):
-        thread = threading.Thread(target=do_task, args=(message,))
-        thread.start()
+        chat_id_full = get_topic_id(message)
+
+        # read the history of an idle chat while waiting for the rest of the message
+        my_gemini.prefetch_history(chat_id_full)
+
+        # Catching messages that are too long, the pieces are glued to the first one
+        # before they get to the queue of the chat
+        now = time.time()
+        with MESSAGE_QUEUE_LOCK:
+            pieces = MESSAGE_QUEUE.get(chat_id_full)
+            if pieces and now - pieces['time'] < MESSAGE_PIECES_WINDOW:
+                pieces['text'] += message.text + '\n\n'
+                pieces['time'] = now
+                return
+            pieces = MESSAGE_QUEUE[chat_id_full] = {'text': message.text, 'time': now}
+        TIMERS.call_later(MESSAGE_PIECES_WINDOW, message_collected, message, pieces)
+def message_collected(message: telebot.types.Message, pieces: dict):
+    """Passes the glued message to the workers when its pieces stop coming, called by TIMERS."""
+    chat_id_full = get_topic_id(message)
+    with MESSAGE_QUEUE_LOCK:
+        delay = pieces['time'] + MESSAGE_PIECES_WINDOW - time.time()
+        if delay > 0:
+            TIMERS.call_later(delay, message_collected, message, pieces)
+            return
+        if MESSAGE_QUEUE.get(chat_id_full) is pieces:
+            del MESSAGE_QUEUE[chat_id_full]
+    message.text = pieces['text']
+    dispatch(message, do_task, message)
+@measure
 def do_task(message: telebot.types.Message):
     chat_id_full = get_topic_id(message)
     lang = get_lang(chat_id_full, message)
 
-    # Catching messages that are too long
-    if chat_id_full not in MESSAGE_QUEUE:
-        MESSAGE_QUEUE[chat_id_full] = message.text
-        last_state = MESSAGE_QUEUE[chat_id_full]
-        n = 5
-        while n > 0:
-            n -= 1
-            time.sleep(0.1)
-            new_state = MESSAGE_QUEUE[chat_id_full]
-            if last_state != new_state:
-                last_state = new_state
-                n = 5
-        message.text = last_state
-        del MESSAGE_QUEUE[chat_id_full]
-    else:
-        MESSAGE_QUEUE[chat_id_full] += message.text + '\n\n'
-        return
-
     # unknown command
     if message.text.startswith('/'): return
 
@@ -760,6 +1187,11 @@ def do_task(message: telebot.types.Message):
 
         with ShowAction(message, 'typing'):
             try:
+                if STREAM_ANSWERS:
+                    answer = reply_streaming(message, my_gemini.chat_stream(helped_query, chat_id_full), reply_markup=tts_button)
+                    if not answer:
+                        bot.reply_to(message, 'No answer')
+                    return
                 answer = my_gemini.chat(helped_query, chat_id_full).strip()
                 if answer:
                     answer = utils.bot_markdown_to_html(answer)
@@ -776,6 +1208,25 @@ def do_task(message: telebot.types.Message):
             return
 
 
+def run_webhook():
+    """
+    Receives the updates with the webhook until the process is stopped.
+    The updates go to the usual handlers, they pass the work to the dispatcher.
+    The updates that came while the bot was down are dropped like with the polling, unless SKIP_PENDING is off.
+    """
+    server = my_webhook.WebhookServer(lambda update: bot.process_new_updates([telebot.types.Update.de_json(update)]),
+                                      WEBHOOK_SECRET, WEBHOOK_HOST, WEBHOOK_PORT, urllib.parse.urlparse(WEBHOOK_URL).path or '/')
+    # do not tell telegram about the webhook if nothing listens on it
+    server.start()
+    bot.remove_webhook()
+    bot.set_webhook(url=WEBHOOK_URL, secret_token=WEBHOOK_SECRET, drop_pending_updates=SKIP_PENDING)
+    try:
+        while 1:
+            time.sleep(1)
+    finally:
+        server.stop()
+
+
 if __name__ == '__main__':
     try:
         with open(KEYS_DB_FILE, 'rb') as f:
@@ -795,5 +1246,20 @@ if __name__ == '__main__':
     except Exception as load_keys_error:
         my_log.log2(f'tb:load_keys_error: {load_keys_error} {HFKEYS_DB_FILE}')
 
+    # chats from the old whole-list storage, only once
+    n = my_history.migrate_from_sqlitedict()
+    if n:
+        my_log.log2(f'tb:migrated {n} chats to {my_history.HISTORY_DB_FILE}')
+
     my_gemini.run_proxy_pool_daemon()
-    bot.polling(timeout=90, long_polling_timeout=90)
+    measure_telegram_requests()
+    if METRICS_PORT:
+        my_metrics.start_server(METRICS_PORT)
+    # stop on SIGTERM (systemctl stop) the same way as on Ctrl+C so the unsaved data is flushed on exit
+    signal.signal(signal.SIGTERM, signal.default_int_handler)
+    if WEBHOOK_URL:
+        run_webhook()
+    else:
+        # the webhook of the previous run would not let the polling get the updates
+        bot.remove_webhook()
+        bot.polling(timeout=90, long_polling_timeout=90)
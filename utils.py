@@ -2,6 +2,7 @@
 
 
 import html
+import io
 import random
 import re
 import string
@@ -14,8 +15,22 @@ from pylatexenc.latex2text import LatexNodes2Text
 from lingua import Language, LanguageDetectorBuilder
 
 import my_log
+import my_trace
 
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
 
+
+# Images for Gemini vision are downscaled to this size in pixels and bytes
+IMAGE_MAX_SIDE = 1600
+IMAGE_MAX_BYTES = 1000000
+# the formats Gemini accepts as they are, others are converted to jpeg
+GEMINI_IMAGE_TYPES = ('image/jpeg', 'image/png', 'image/webp', 'image/heic', 'image/heif')
+
+
+@my_trace.traced('utils.markdown_to_html')
 def bot_markdown_to_html(text: str) -> str:
     # переделывает маркдаун от чатботов в хтмл для телеграма
     # сначала делается полное экранирование
@@ -287,6 +302,72 @@ def download_image_as_bytes(url: str) -> bytes:
   return response.content
 
 
+def image_mime_type(data: bytes) -> str:
+    """
+    Detects the type of the image by its first bytes.
+
+    Parameters:
+        data (bytes): The image.
+
+    Returns:
+        str: The MIME type, 'image/jpeg' if it is unknown.
+    """
+    if data[:3] == b'\xff\xd8\xff':
+        return 'image/jpeg'
+    if data[:8] == b'\x89PNG\r\n\x1a\n':
+        return 'image/png'
+    if data[:4] == b'RIFF' and data[8:12] == b'WEBP':
+        return 'image/webp'
+    if data[:6] in (b'GIF87a', b'GIF89a'):
+        return 'image/gif'
+    if data[:2] == b'BM':
+        return 'image/bmp'
+    if data[4:8] == b'ftyp':
+        if data[8:12] in (b'heic', b'heix', b'hevc', b'hevx'):
+            return 'image/heic'
+        if data[8:12] in (b'mif1', b'msf1', b'heif'):
+            return 'image/heif'
+    return 'image/jpeg'
+
+
+@my_trace.traced('utils.prepare_image')
+def prepare_image(data: bytes, max_side: int = IMAGE_MAX_SIDE, max_bytes: int = IMAGE_MAX_BYTES) -> tuple:
+    """
+    Prepares the image for uploading to Gemini vision. Too big images and the formats
+    Gemini does not accept are downscaled and re-encoded to jpeg. Without Pillow
+    the image is returned as it is.
+
+    Parameters:
+        data (bytes): The image.
+        max_side (int, optional): The maximum width and height in pixels.
+        max_bytes (int, optional): The maximum size in bytes.
+
+    Returns:
+        tuple: The image and its MIME type.
+    """
+    mime = image_mime_type(data)
+    if Image is None:
+        return data, mime
+    try:
+        with Image.open(io.BytesIO(data)) as img:
+            if mime in GEMINI_IMAGE_TYPES and len(data) <= max_bytes and max(img.size) <= max_side:
+                return data, mime
+            # jpeg is decoded at a lower resolution right away
+            img.draft('RGB', (max_side, max_side))
+            if img.mode not in ('RGB', 'L'):
+                img = img.convert('RGB')
+            img.thumbnail((max_side, max_side))
+            for quality in (85, 70, 55, 40):
+                result = io.BytesIO()
+                img.save(result, format='JPEG', quality=quality, optimize=True)
+                if result.tell() <= max_bytes:
+                    break
+            return result.getvalue(), 'image/jpeg'
+    except Exception as error:
+        my_log.log2(f'utils:prepare_image: {error}')
+        return data, mime
+
+
 language_attributes = dir(Language)
 language_names = [f'Language.{attr}' for attr in language_attributes if isinstance(attr, str) and attr.isupper()]
 languages = [eval(attr) for attr in language_names]